@@ -0,0 +1,246 @@
+## This class contains the allocation profiler for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# In profiling mode a sample of requests is traced with 'tracemalloc'. Tracing starts when a sampled
+# request arrives and stops when its response has been sent, so requests that are not sampled run at
+# full speed. For every traced request the profiler records the peak and net traced bytes and the
+# sites (file and line) that allocated the memory still held when the request ended, and aggregates
+# them per route, e.g. "GET /chats/{chat_id}".
+#
+# 'tracemalloc' traces the whole process, so only one request is traced at a time, and allocations
+# of requests running concurrently on other threads are counted towards it. The aggregate is most
+# precise at low concurrency, and averages out over many samples otherwise.
+#
+# Independently of the sampling, an admin can take a baseline snapshot, which keeps tracing on, and
+# later compare snapshots against it to find where memory grew in between.
+
+import os
+import random
+import sysconfig
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+enabled = os.environ.get("ALLOCATION_PROFILER", default="0") == "1"
+sample_rate = float(os.environ.get("ALLOCATION_SAMPLE_RATE", default="0.01"))
+# frames kept per traced allocation; sites are grouped by their innermost frame
+trace_frames = int(os.environ.get("ALLOCATION_TRACE_FRAMES", default="1"))
+# number of allocation sites reported per route and per snapshot diff
+TOP_SITES = 10
+# number of allocation sites remembered per route, so rarely hit sites do not accumulate
+MAX_SITES = 100
+
+_STDLIB = sysconfig.get_paths()["stdlib"]
+# the profiler's own allocations and the tracing machinery are never reported as sites
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+)
+
+def short_path(filename: str) -> str:
+    """Shortens the path of a source file to its module path, e.g. "sqlalchemy/orm/loading.py" or "json/decoder.py"."""
+    if "site-packages" in filename:
+        return filename.split("site-packages", 1)[1].lstrip(os.sep)
+    if filename.startswith(_STDLIB):
+        return os.path.relpath(filename, _STDLIB)
+    if filename.startswith(os.getcwd()):
+        return os.path.relpath(filename)
+    return filename
+
+def _site(trace: tracemalloc.Traceback) -> str:
+    frame = trace[0]
+    return f"{short_path(frame.filename)}:{frame.lineno}"
+
+class _Measurement:
+    __slots__ = ("started_bytes", "owns_trace")
+
+    def __init__(self, started_bytes: int, owns_trace: bool):
+        self.started_bytes = started_bytes
+        self.owns_trace = owns_trace
+
+class _RouteAllocations:
+    __slots__ = ("count", "peak_total", "peak_max", "net_total", "net_max", "sites")
+
+    def __init__(self):
+        self.count = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        self.net_total = 0
+        self.net_max = 0
+        self.sites = Counter()
+
+class AllocationProfiler:
+    """Traces a sample of requests with 'tracemalloc' and aggregates their allocations per route."""
+
+    def __init__(self, enabled: bool = enabled, sample_rate: float = sample_rate, frames: int = trace_frames):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._routes: dict[str, _RouteAllocations] = {}
+        self._busy = False
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_at: Optional[datetime] = None
+        # whether the profiler started the running trace; tracing started by others (PYTHONTRACEMALLOC) is left on
+        self._owns_trace = False
+        self.profiled = 0
+        self.skipped = 0
+
+    def begin(self) -> Optional[_Measurement]:
+        """
+        Decides whether the current request is sampled, and starts tracing it if so.
+
+        :return - the measurement to pass to 'end', or None if the request is not traced.
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        with self._lock:
+            if self._busy:
+                self.skipped += 1
+                return None
+            self._busy = True
+            owns_trace = not tracemalloc.is_tracing()
+            if owns_trace:
+                tracemalloc.start(self.frames)
+                self._owns_trace = True
+            started_bytes, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        return _Measurement(started_bytes, owns_trace)
+
+    def end(self, measurement: _Measurement, route: str):
+        """
+        Stops tracing a request and adds its allocations to the aggregate of its route. While a
+        baseline snapshot keeps tracing on, only the peak and net bytes of the request are recorded,
+        since its allocations cannot be told apart from the ones the baseline is tracking.
+
+        :param measurement - the measurement returned by 'begin'.
+        :param route - the method and path template of the request.
+        """
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        sites = []
+        if measurement.owns_trace:
+            snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+            sites = [(_site(statistic.traceback), statistic.size) for statistic in snapshot.statistics("lineno")]
+
+        with self._lock:
+            if self._baseline is None and self._owns_trace:
+                tracemalloc.stop()
+                self._owns_trace = False
+            self._busy = False
+            self.profiled += 1
+            allocations = self._routes.get(route)
+            if allocations is None:
+                allocations = self._routes[route] = _RouteAllocations()
+            peak, net = peak_bytes - measurement.started_bytes, current_bytes - measurement.started_bytes
+            allocations.count += 1
+            allocations.peak_total += peak
+            allocations.peak_max = max(allocations.peak_max, peak)
+            allocations.net_total += net
+            allocations.net_max = max(allocations.net_max, net)
+            for site, size in sites:
+                allocations.sites[site] += size
+            if len(allocations.sites) > MAX_SITES:
+                allocations.sites = Counter(dict(allocations.sites.most_common(MAX_SITES // 2)))
+
+    def routes(self, limit: int = 50) -> list[dict]:
+        """
+        :param limit - the maximum number of routes returned.
+        :return - the aggregate of each profiled route, by descending largest peak, with the sites
+        holding the most memory at the end of its requests, averaged per request.
+        """
+        with self._lock:
+            routes = sorted(self._routes.items(), key=lambda item: item[1].peak_max, reverse=True)[:limit]
+            return [{
+                "route": route,
+                "count": allocations.count,
+                "avg_peak_bytes": allocations.peak_total // allocations.count,
+                "max_peak_bytes": allocations.peak_max,
+                "avg_net_bytes": allocations.net_total // allocations.count,
+                "max_net_bytes": allocations.net_max,
+                "top_sites": [{"site": site, "avg_bytes": size // allocations.count}
+                              for site, size in allocations.sites.most_common(TOP_SITES)],
+            } for route, allocations in routes]
+
+    def snapshot(self) -> dict:
+        """
+        Takes a snapshot of the traced memory. The first snapshot becomes the baseline and starts
+        tracing; later ones are compared against it.
+
+        :return - the baseline time, the traced bytes, and the sites whose memory grew the most since the baseline.
+        """
+        with self._lock:
+            if self._baseline is None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(self.frames)
+                    self._owns_trace = True
+                self._baseline = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+                self._baseline_at = datetime.now()
+                return {"baseline_at": self._baseline_at, "traced_bytes": tracemalloc.get_traced_memory()[0], "sites": []}
+            baseline, baseline_at = self._baseline, self._baseline_at
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        differences = [difference for difference in snapshot.compare_to(baseline, "lineno") if difference.size_diff > 0]
+        return {
+            "baseline_at": baseline_at,
+            "traced_bytes": tracemalloc.get_traced_memory()[0],
+            "sites": [{
+                "site": _site(difference.traceback),
+                "size_diff": difference.size_diff,
+                "count_diff": difference.count_diff,
+                "size": difference.size,
+            } for difference in differences[:TOP_SITES]],
+        }
+
+    def clear_snapshot(self):
+        """Drops the baseline snapshot and stops tracing, unless a request is being traced or the trace was started elsewhere."""
+        with self._lock:
+            self._baseline = self._baseline_at = None
+            if not self._busy and self._owns_trace:
+                tracemalloc.stop()
+                self._owns_trace = False
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+            self.profiled = self.skipped = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "profiled": self.profiled,
+                "skipped": self.skipped,
+                "baseline_at": self._baseline_at,
+            }
+
+class AllocationProfilerMiddleware:
+    """Traces the requests sampled by the allocation profiler."""
+
+    def __init__(self, app: ASGIApp, profiler: Optional[AllocationProfiler] = None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        profiler = self.profiler or allocation_profiler
+        measurement = profiler.begin() if scope["type"] == "http" else None
+        if measurement is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end(measurement, _route_name(scope))
+
+def _route_name(scope: Scope) -> str:
+    # the router stores the matched route in the scope; unmatched paths are not reported one by one
+    route = scope.get("route")
+    return f"{scope['method']} {getattr(route, 'path', '(unmatched)')}"
+
+allocation_profiler = AllocationProfiler()
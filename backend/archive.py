@@ -0,0 +1,265 @@
+## This class contains the cold-tier message archive for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Messages older than a configurable age are moved out of the 'messages' table into per-chat,
+# append-only segment files. Each segment is a sequence of zlib-compressed blocks of messages,
+# and each chat keeps a small sparse index (one entry per block) in 'index.json', so a read
+# only has to decompress the blocks that overlap the requested id range. Messages are moved in
+# batches of 'ARCHIVE_BATCH_SIZE', each appended as a segment and deleted in one transaction, so
+# the first run over years of history holds neither every old message in memory nor a long write
+# lock. The attachments and moderation flags of archived messages are deleted with them.
+
+import json
+import mmap
+import os
+import shutil
+import threading
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+from sqlmodel import Session, delete, select
+
+from backend import events
+from backend.entities import AttachmentInDB, MentionInDB, MessageFlagInDB, MessageInDB
+from backend.message_cache import message_cache
+
+archive_dir = os.environ.get("ARCHIVE_DIR", default="backend/archive")
+archive_after_days = int(os.environ.get("ARCHIVE_AFTER_DAYS", default="180"))
+# number of messages moved per segment and transaction
+archive_batch_size = int(os.environ.get("ARCHIVE_BATCH_SIZE", default="5000"))
+# number of messages compressed together in one block of a segment file
+BLOCK_SIZE = 256
+
+_index_cache: dict[int, tuple[float, dict]] = {}
+_index_lock = threading.Lock()
+
+# ---------- reading ----------- #
+def get_archived_count(chat_id: int) -> int:
+    """
+    Counts the archived messages of a chat.
+
+    :param chat_id - id of the chat.
+    :return - the number of messages of the chat held in the archive.
+    """
+    return _read_index(chat_id)["count"]
+
+def get_last_archived_id(chat_id: int) -> Optional[int]:
+    """
+    Returns the id of the newest archived message of a chat, or None if nothing is archived.
+
+    :param chat_id - id of the chat.
+    """
+    return _read_index(chat_id)["last_id"]
+
+def get_archived_chat_ids() -> list[int]:
+    """Returns the ids of the chats that have archived messages."""
+    try:
+        names = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit() and os.path.exists(_index_path(int(name))))
+
+def iter_messages(chat_id: int) -> Iterator[tuple[int, int, datetime]]:
+    """
+    Yields the id, author id and creation time of every archived message of a chat, oldest first,
+    decompressing one block at a time.
+
+    :param chat_id - id of the chat.
+    """
+    for segment in _read_index(chat_id)["segments"]:
+        path = os.path.join(_chat_dir(chat_id), segment["file"])
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for block in segment["blocks"]:
+                records = json.loads(zlib.decompress(mapped[block["offset"]:block["offset"] + block["length"]]))
+                for message_id, user_id, created_at, _text in records:
+                    yield message_id, user_id, datetime.fromisoformat(created_at)
+
+def read_messages(chat_id: int, before: Optional[int] = None, limit: Optional[int] = None) -> list[dict]:
+    """
+    Reads the newest archived messages of a chat that are older than 'before'. Only the blocks that
+    overlap the requested range are memory-mapped and decompressed.
+
+    :param chat_id - id of the chat.
+    :param before - only return messages with an id lower than this, or None for no bound.
+    :param limit - the maximum number of messages to return, or None for every matching message.
+    :return - the archived messages in ascending id order, as dicts with id, user_id, text and created_at.
+    """
+    index = _read_index(chat_id)
+    newest_first = []
+    for segment in reversed(index["segments"]):
+        path = os.path.join(_chat_dir(chat_id), segment["file"])
+        blocks = [block for block in reversed(segment["blocks"]) if before is None or block["first_id"] < before]
+        if not blocks:
+            continue
+
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for block in blocks:
+                records = json.loads(zlib.decompress(mapped[block["offset"]:block["offset"] + block["length"]]))
+                for message_id, user_id, created_at, text in reversed(records):
+                    if before is not None and message_id >= before:
+                        continue
+                    newest_first.append({
+                        "id": message_id,
+                        "user_id": user_id,
+                        "chat_id": chat_id,
+                        "text": text,
+                        "created_at": datetime.fromisoformat(created_at),
+                    })
+                    if limit is not None and len(newest_first) >= limit:
+                        return newest_first[::-1]
+
+    return newest_first[::-1]
+
+# ---------- writing ----------- #
+def archive_old_messages(session: Session, older_than: datetime, batch_size: Optional[int] = None) -> int:
+    """
+    Moves every message created before 'older_than' into the archive, one chat at a time and one
+    batch of ids at a time, each batch as its own segment and transaction. Only a prefix of each
+    chat's history (by id) is moved, so archived messages are always older than the messages still
+    in the database. Segments are written and indexed before the rows are deleted, so a crash in
+    between leaves duplicates that the next run removes, and never loses messages.
+
+    :param session - a Session object for database retrieval.
+    :param older_than - messages created before this time are archived.
+    :param batch_size - the number of messages read, archived and deleted per transaction.
+    :return - the number of messages archived.
+    """
+    batch_size = batch_size or archive_batch_size
+    chat_ids = session.exec(
+        select(MessageInDB.chat_id).where(MessageInDB.created_at < older_than).distinct()
+    ).all()
+
+    archived = 0
+    for chat_id in chat_ids:
+        last_archived_id = get_last_archived_id(chat_id)
+        if last_archived_id is not None:
+            # rows archived by a run that stopped before deleting them
+            _delete_archived_rows(session, chat_id, last_archived_id)
+            session.commit()
+
+        first_hot_id = session.exec(
+            select(MessageInDB.id)
+            .where(MessageInDB.chat_id == chat_id, MessageInDB.created_at >= older_than)
+            .order_by(MessageInDB.id)
+            .limit(1)
+        ).first()
+        while True:
+            # only the archived columns, so a batch never loads whole entities
+            statement = (
+                select(MessageInDB.id, MessageInDB.user_id, MessageInDB.created_at, MessageInDB.text)
+                .where(MessageInDB.chat_id == chat_id)
+                .order_by(MessageInDB.id)
+                .limit(batch_size)
+            )
+            if first_hot_id is not None:
+                statement = statement.where(MessageInDB.id < first_hot_id)
+            rows = session.exec(statement).all()
+            if not rows:
+                break
+
+            _append_segment(chat_id, [
+                (message_id, user_id, created_at.isoformat(), text) for message_id, user_id, created_at, text in rows
+            ])
+            _delete_archived_rows(session, chat_id, rows[-1][0])
+            events.publish(session, "chat_messages", chat_id)
+            session.commit()
+            message_cache.invalidate(chat_id)
+            archived += len(rows)
+            if len(rows) < batch_size:
+                break
+
+    return archived
+
+def _delete_archived_rows(session: Session, chat_id: int, last_id: int):
+    # attachments and flags go with their messages, as in 'delete_message', so blob collection can
+    # reclaim the attachments' blobs; the mentions inbox only lists messages still in the database
+    for entity in (AttachmentInDB, MessageFlagInDB, MentionInDB):
+        session.exec(delete(entity).where(entity.chat_id == chat_id, entity.message_id <= last_id))
+    session.exec(delete(MessageInDB).where(MessageInDB.chat_id == chat_id, MessageInDB.id <= last_id))
+
+def remove_chat(chat_id: int):
+    """
+    Removes every archived message of a chat.
+
+    :param chat_id - id of the deleted chat.
+    """
+    with _index_lock:
+        _index_cache.pop(chat_id, None)
+    shutil.rmtree(_chat_dir(chat_id), ignore_errors=True)
+
+def _append_segment(chat_id: int, records: list[tuple]):
+    index = _read_index(chat_id)
+    os.makedirs(_chat_dir(chat_id), exist_ok=True)
+    name = f"segment-{len(index['segments']) + 1:06d}.zz"
+
+    blocks = []
+    offset = 0
+    with open(os.path.join(_chat_dir(chat_id), name), "wb") as file:
+        for start in range(0, len(records), BLOCK_SIZE):
+            chunk = records[start:start + BLOCK_SIZE]
+            data = zlib.compress(json.dumps(chunk, separators=(",", ":")).encode(), level=9)
+            file.write(data)
+            blocks.append({
+                "offset": offset,
+                "length": len(data),
+                "first_id": chunk[0][0],
+                "last_id": chunk[-1][0],
+                "count": len(chunk),
+            })
+            offset += len(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    index = {
+        "count": index["count"] + len(records),
+        "last_id": records[-1][0],
+        "segments": index["segments"] + [{"file": name, "blocks": blocks}],
+    }
+    temporary_path = _index_path(chat_id) + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(index, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, _index_path(chat_id))
+
+# ---------- helpers ----------- #
+def _chat_dir(chat_id: int) -> str:
+    return os.path.join(archive_dir, str(chat_id))
+
+def _index_path(chat_id: int) -> str:
+    return os.path.join(_chat_dir(chat_id), "index.json")
+
+def _read_index(chat_id: int) -> dict:
+    try:
+        modified = os.stat(_index_path(chat_id)).st_mtime_ns
+    except FileNotFoundError:
+        return {"count": 0, "last_id": None, "segments": []}
+
+    with _index_lock:
+        cached = _index_cache.get(chat_id)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+
+    with open(_index_path(chat_id)) as file:
+        index = json.load(file)
+    with _index_lock:
+        _index_cache[chat_id] = (modified, index)
+    return index
+
+def main():
+    # imported here, since only the command line needs it
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Move old messages into the cold-tier archive.")
+    parser.add_argument("--older-than-days", type=int, default=archive_after_days,
+                        help="archive messages older than this many days")
+    args = parser.parse_args()
+
+    from backend.database import engine
+    with Session(engine) as session:
+        count = archive_old_messages(session, datetime.now() - timedelta(days=args.older_than_days))
+    print(f"archived {count} messages into {archive_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 ## This class contains authorization methods and routes for the Spring 2024 CS 4550 Pony Express application.
 # Author: Riley Kraabel
 
+import functools
 import os
 from datetime import datetime, timezone
 from typing import Annotated
@@ -10,8 +11,6 @@ from fastapi.security import (
     OAuth2PasswordBearer,
     OAuth2PasswordRequestForm
 )
-from jose import ExpiredSignatureError, JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel, ValidationError
 from sqlmodel import Session, SQLModel, select
 
@@ -19,13 +18,15 @@ from backend import database as db
 from backend.entities import UserInDB, UserResponse
 from backend.database import DuplicateEntityException
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 access_token_duration = 3600
 jwt_alg = "HS256"
 jwt_key = os.environ.get(
     "JWT_KEY", 
     default="riley",
 )
+admin_usernames = {
+    username.strip() for username in os.environ.get("ADMIN_USERNAMES", default="").split(",") if username.strip()
+}
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 auth_router = APIRouter(prefix="/auth", tags=["Authentication"])
 
@@ -91,7 +92,7 @@ def register_new_user(
                                        entity_field="username" if existing_user.username == registration.username else "email",
                                        entity_value=registration.username if existing_user.username == registration.username else registration.email)
 
-    hashed_password = pwd_context.hash(registration.password)
+    hashed_password = hash_password(registration.password)
     new_user = UserInDB(username=registration.username, email=registration.email, hashed_password=hashed_password)
     user = db.create_user(new_user, session)
     return UserResponse(user=user)
@@ -105,6 +106,31 @@ def get_access_token(
     return _build_access_token(user)
 
 # ----------- helper methods ------------------ #
+# 'jose' (which loads 'cryptography') and 'passlib' are imported on first use rather than with this
+# module, so importing the app stays fast; the startup warmup imports them before the first request.
+@functools.cache
+def password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def hash_password(password: str) -> str:
+    return password_context().hash(password)
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return password_context().verify(password, hashed_password)
+
+def warm_up(session: Session):
+    """
+    Loads the bcrypt backend and the JWT library and runs the login query once, so the first login
+    does not pay for them.
+
+    :param session - a Session object for database retrieval.
+    """
+    hash_password("warmup")
+    claims = Claims(sub="0", exp=int(datetime.now(timezone.utc).timestamp()) + access_token_duration)
+    _decode_claims(_encode_claims(claims))
+    _find_user(session, "")
+
 def get_current_user(
     session: Session = Depends(db.get_session),
     token: str = Depends(oauth2_scheme),
@@ -112,21 +138,39 @@ def get_current_user(
     user = _decode_access_token(session, token)
     return user
 
+def get_current_user_id(token: str = Depends(oauth2_scheme)) -> int:
+    """Returns the id of the user the access token was issued to, without loading the user from the database."""
+    try:
+        return int(_decode_claims(token).sub)
+    except ValueError:
+        raise InvalidToken()
+
+def get_admin_user(user: UserInDB = Depends(get_current_user)) -> UserInDB:
+    if user.username not in admin_usernames:
+        raise HTTPException(status_code=403, detail={
+            "error": "no_permission",
+            "error_description": "requires admin privileges"
+        })
+
+    return user
+
 def _get_authenticated_user(
     session: Session,
     form: OAuth2PasswordRequestForm
 ) -> UserInDB:
-    user = session.exec(select(UserInDB).where(UserInDB.username == form.username)).first()
+    user = _find_user(session, form.username)
 
-    if user is None or not pwd_context.verify(form.password, user.hashed_password):
+    if user is None or not verify_password(form.password, user.hashed_password):
         raise InvalidCredentials
     
     return user
 
+def _find_user(session: Session, username: str) -> UserInDB:
+    return session.exec(select(UserInDB).where(UserInDB.username == username)).first()
+
 def _build_access_token(user: UserInDB) -> AccessToken:
     expiration = int(datetime.now(timezone.utc).timestamp()) + access_token_duration
-    claims = Claims(sub=str(user.id), exp=expiration)
-    access_token = jwt.encode(claims.model_dump(), key=jwt_key, algorithm=jwt_alg)
+    access_token = _encode_claims(Claims(sub=str(user.id), exp=expiration))
 
     return AccessToken(
         access_token=access_token,
@@ -138,17 +182,21 @@ def _decode_access_token(
     session: Session, 
     token: str
 ) -> UserInDB:
+    user = session.get(UserInDB, _decode_claims(token).sub)
+    if user is None:
+        raise InvalidToken()
+
+    return user
+
+def _encode_claims(claims: Claims) -> str:
+    from jose import jwt
+    return jwt.encode(claims.model_dump(), key=jwt_key, algorithm=jwt_alg)
+
+def _decode_claims(token: str) -> Claims:
+    from jose import ExpiredSignatureError, JWTError, jwt
     try:
         claims_dict = jwt.decode(token, key=jwt_key, algorithms=[jwt_alg])
-        claims = Claims(**claims_dict)
-        user_id = claims.sub
-        user = session.get(UserInDB, user_id)
-
-        if user is None:
-            raise InvalidToken()
-        
-        return user
-    
+        return Claims(**claims_dict)
     except ExpiredSignatureError:
         raise ExpiredToken()
     except JWTError:
@@ -0,0 +1,284 @@
+## This class contains online backups and maintenance of the database for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# A backup copies the live database with SQLite's online backup API, a few pages per step with a
+# short sleep between steps. The app's database uses the write-ahead log (migration 13), so every
+# step reads from one read transaction held for the whole copy: the copy is a consistent snapshot,
+# writers keep committing, and their commits do not restart it.
+#
+# A database in rollback-journal mode cannot be read from one snapshot without blocking writers, so
+# its source is only locked while a step copies its pages. SQLite restarts that copy whenever another
+# connection writes, so a backup that restarts too often copies the rest in a single step, holding a
+# read lock for the length of that step; the result reports it as 'single_step'.
+#
+# The copy is checked with 'PRAGMA quick_check', gzip-compressed into the backup directory with a
+# sha256 checksum next to it ('sha256sum -c' format), and only the newest snapshots are kept.
+# Backups and maintenance (ANALYZE, incremental vacuum) run as background jobs, queued by the job
+# scheduler, by an admin or from the command line.
+
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+backup_dir = os.environ.get("BACKUP_DIR", default="backend/backups")
+# number of snapshots kept; older ones are deleted after each backup
+keep = int(os.environ.get("BACKUP_KEEP", default="7"))
+pages_per_step = int(os.environ.get("BACKUP_PAGES_PER_STEP", default="1024"))
+step_sleep_ms = float(os.environ.get("BACKUP_STEP_SLEEP_MS", default="10"))
+# restarts caused by concurrent writes before the rest is copied in one step
+max_restarts = int(os.environ.get("BACKUP_MAX_RESTARTS", default="5"))
+# how often the scheduler queues a backup and a maintenance run; 0 disables them
+backup_interval_hours = float(os.environ.get("BACKUP_INTERVAL_HOURS", default="24"))
+maintenance_interval_hours = float(os.environ.get("MAINTENANCE_INTERVAL_HOURS", default="24"))
+# rows sampled per index by ANALYZE, which keeps it fast on large tables
+ANALYSIS_LIMIT = 1000
+# free pages returned to the file system per incremental vacuum step
+VACUUM_PAGES_PER_STEP = 1000
+# busy timeout of the backup and maintenance connections, in seconds
+BUSY_TIMEOUT = 30
+CHUNK_SIZE = 1024 * 1024
+SNAPSHOT_SUFFIX = ".db.gz"
+
+class _TooManyRestarts(Exception):
+    pass
+
+def backup(database_path: str, directory: Optional[str] = None, pages: Optional[int] = None,
+           sleep_ms: Optional[float] = None, keep_snapshots: Optional[int] = None,
+           on_step: Optional[Callable[[int, int], None]] = None) -> dict:
+    """
+    Takes a compressed, checksummed snapshot of a live database and rotates old snapshots.
+
+    :param database_path - the path of the database file.
+    :param directory - the directory snapshots are written to.
+    :param pages - the number of pages copied per step.
+    :param sleep_ms - the pause between two steps, in milliseconds.
+    :param keep_snapshots - the number of snapshots kept.
+    :param on_step - called with the number of pages copied and the total after each step. It must
+                     not write to the database, which would restart the copy of a database that is not
+                     in WAL mode.
+    :return - the snapshot's path, sizes, checksum, timings, the number of steps and restarts, whether
+              the copy read one snapshot and whether it fell back to a single step.
+    """
+    directory = directory or backup_dir
+    pages = pages or pages_per_step
+    sleep_seconds = (step_sleep_ms if sleep_ms is None else sleep_ms) / 1000
+    os.makedirs(directory, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(database_path))[0]}-{datetime.now():%Y%m%d-%H%M%S-%f}"
+    copy_path = os.path.join(directory, f"{name}.db.part")
+    snapshot_path = os.path.join(directory, name + SNAPSHOT_SUFFIX)
+
+    progress = {"steps": 0, "restarts": 0, "copied": 0, "total": 0}
+
+    def step(_status: int, remaining: int, total: int):
+        copied = total - remaining
+        # a restarted copy starts over, so it ends its step no further than the previous step did
+        if progress["steps"] and copied <= progress["copied"]:
+            progress["restarts"] += 1
+            if progress["restarts"] > max_restarts:
+                raise _TooManyRestarts()
+        progress.update(steps=progress["steps"] + 1, copied=copied, total=total)
+        if on_step is not None:
+            on_step(copied, total)
+        if remaining:
+            time.sleep(sleep_seconds)
+
+    started = time.perf_counter()
+    source = sqlite3.connect(database_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    target = sqlite3.connect(copy_path)
+    single_step = False
+    try:
+        read_snapshot = source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if read_snapshot:
+            # the steps share this read transaction, which in WAL mode does not block writers
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            source.backup(target, pages=pages, progress=step)
+        except _TooManyRestarts:
+            logger.warning("backup of %s restarted %s times, copying the rest in one step",
+                           database_path, progress["restarts"] - 1)
+            single_step = True
+            source.backup(target, pages=-1)
+        if read_snapshot:
+            source.execute("COMMIT")
+        copy_seconds = time.perf_counter() - started
+        if target.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise RuntimeError(f"the backup copy of {database_path} failed its integrity check")
+    finally:
+        target.close()
+        source.close()
+
+    try:
+        with open(copy_path, "rb") as copy, gzip.open(snapshot_path, "wb", compresslevel=6) as snapshot:
+            shutil.copyfileobj(copy, snapshot, CHUNK_SIZE)
+        size = os.path.getsize(copy_path)
+    finally:
+        os.remove(copy_path)
+    checksum = write_checksum(snapshot_path)
+    seconds = time.perf_counter() - started
+    removed = rotate(directory, keep if keep_snapshots is None else keep_snapshots)
+
+    result = {
+        "path": snapshot_path,
+        "bytes": size,
+        "compressed_bytes": os.path.getsize(snapshot_path),
+        "sha256": checksum,
+        "copy_seconds": round(copy_seconds, 3),
+        "seconds": round(seconds, 3),
+        "mb_per_second": round(size / 1e6 / copy_seconds, 1) if copy_seconds else None,
+        "steps": progress["steps"],
+        "restarts": progress["restarts"],
+        "snapshot": read_snapshot,
+        "single_step": single_step,
+        "removed": removed,
+    }
+    logger.info("backed up %s (%.1f MB) in %.2f s at %s MB/s, %s steps, %s restarts%s; %s is %.1f MB",
+                database_path, size / 1e6, seconds, result["mb_per_second"], result["steps"], result["restarts"],
+                ", rest copied in one step" if single_step else "", snapshot_path, result["compressed_bytes"] / 1e6)
+    return result
+
+def write_checksum(path: str) -> str:
+    """Writes the sha256 of a file next to it, in the format of 'sha256sum', and returns it."""
+    checksum = _sha256(path)
+    with open(path + ".sha256", "w") as file:
+        file.write(f"{checksum}  {os.path.basename(path)}\n")
+    return checksum
+
+def verify(path: str) -> bool:
+    """Returns whether a snapshot still matches its recorded checksum."""
+    try:
+        with open(path + ".sha256") as file:
+            expected = file.read().split()[0]
+    except (OSError, IndexError):
+        return False
+    return _sha256(path) == expected
+
+def list_snapshots(directory: Optional[str] = None) -> list[dict]:
+    """
+    :param directory - the backup directory.
+    :return - the snapshots in the directory, newest first.
+    """
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory or backup_dir, "*" + SNAPSHOT_SUFFIX)), reverse=True):
+        try:
+            with open(path + ".sha256") as file:
+                checksum = file.read().split()[0]
+        except (OSError, IndexError):
+            checksum = None
+        stat = os.stat(path)
+        snapshots.append({
+            "name": os.path.basename(path),
+            "bytes": stat.st_size,
+            "created_at": datetime.fromtimestamp(stat.st_mtime),
+            "sha256": checksum,
+        })
+    return snapshots
+
+def rotate(directory: str, keep_snapshots: int) -> int:
+    """
+    Deletes all but the newest snapshots, and copies left behind by interrupted backups.
+
+    :return - the number of snapshots deleted.
+    """
+    snapshots = sorted(glob.glob(os.path.join(directory, "*" + SNAPSHOT_SUFFIX)), reverse=True)
+    for path in snapshots[keep_snapshots:]:
+        os.remove(path)
+        if os.path.exists(path + ".sha256"):
+            os.remove(path + ".sha256")
+    # a copy is in progress for at most a few minutes
+    for path in glob.glob(os.path.join(directory, "*.db.part")):
+        if time.time() - os.path.getmtime(path) > 3600:
+            os.remove(path)
+    return len(snapshots[keep_snapshots:])
+
+def maintain(database_path: str, sleep_ms: Optional[float] = None) -> dict:
+    """
+    Refreshes the query planner's statistics with a sampled ANALYZE, then returns free pages to the
+    file system a few at a time if the database uses incremental auto-vacuum.
+
+    :param database_path - the path of the database file.
+    :param sleep_ms - the pause between two vacuum steps, in milliseconds.
+    :return - the time ANALYZE took, and the free pages before and after vacuuming.
+    """
+    sleep_seconds = (step_sleep_ms if sleep_ms is None else sleep_ms) / 1000
+    # autocommit, so each statement is its own short transaction
+    connection = sqlite3.connect(database_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        started = time.perf_counter()
+        connection.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        connection.execute("ANALYZE")
+        analyze_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        remaining = free_pages
+        if incremental:
+            while remaining:
+                connection.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})").fetchall()
+                remaining = connection.execute("PRAGMA freelist_count").fetchone()[0]
+                time.sleep(sleep_seconds)
+        elif free_pages:
+            logger.info("%s has %s free pages; run 'python -m backend.backups --enable-incremental-vacuum' "
+                        "while the app is stopped to return them to the file system", database_path, free_pages)
+    finally:
+        connection.close()
+
+    result = {"analyze_ms": analyze_ms, "incremental_vacuum": incremental, "free_pages": free_pages,
+              "free_pages_left": remaining}
+    logger.info("maintained %s: ANALYZE in %s ms, %s of %s free pages vacuumed", database_path, analyze_ms,
+                free_pages - remaining, free_pages)
+    return result
+
+def enable_incremental_vacuum(database_path: str):
+    """Switches a database to incremental auto-vacuum. This rewrites the whole file, so the app must be stopped."""
+    connection = sqlite3.connect(database_path, isolation_level=None)
+    try:
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Back up or maintain the database while the app runs.")
+    parser.add_argument("--list", action="store_true", help="list the snapshots and check their checksums")
+    parser.add_argument("--maintenance", action="store_true", help="run ANALYZE and the incremental vacuum")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="switch the database to incremental auto-vacuum (the app must be stopped)")
+    parser.add_argument("--dir", default=backup_dir, help="the backup directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from backend.database import engine
+    database_path = engine.url.database
+    if args.list:
+        for snapshot in list_snapshots(args.dir):
+            valid = verify(os.path.join(args.dir, snapshot["name"]))
+            print(f"{snapshot['name']}  {snapshot['bytes'] / 1e6:8.1f} MB  {'ok' if valid else 'CHECKSUM MISMATCH'}")
+    elif args.maintenance:
+        print(maintain(database_path))
+    elif args.enable_incremental_vacuum:
+        enable_incremental_vacuum(database_path)
+        print(f"{database_path} now uses incremental auto-vacuum")
+    else:
+        print(backup(database_path, args.dir))
+
+if __name__ == "__main__":
+    main()
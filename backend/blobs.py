@@ -0,0 +1,178 @@
+## This class contains the content-addressed attachment blob store for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Attachment bytes never go into the database. An upload is appended chunk by chunk to a part file,
+# whose size is the offset a client resumes from. Once complete, the part file is hashed and moved
+# to 'objects/<first two hex digits>/<sha256>', so identical files are stored once no matter how
+# many attachments refer to them. Requests appending to the same upload take turns through an
+# exclusive lock on its part file. Uploads left unfinished for 'UPLOAD_EXPIRY_HOURS' are deleted
+# with their part files by the scheduled "expire_uploads" job. Unreferenced objects are deleted by the "collect_blobs" job after
+# a grace period, which keeps a concurrent upload of the same content from losing its file. An upload
+# of content that is already stored refreshes the object's age under an exclusive lock on the object,
+# and the collection re-checks the age under the same lock before deleting it.
+
+import fcntl
+import hashlib
+import os
+import time
+from typing import BinaryIO, Iterator, Optional
+
+blob_dir = os.environ.get("BLOB_DIR", default="backend/blobs")
+max_attachment_size = int(os.environ.get("MAX_ATTACHMENT_SIZE", default=str(100 * 1024 * 1024)))
+# unfinished uploads that received no bytes for this long are deleted; 0 keeps them forever
+upload_expiry_hours = float(os.environ.get("UPLOAD_EXPIRY_HOURS", default="24"))
+# objects younger than this are never collected, even if no attachment refers to them yet
+COLLECT_GRACE_SECONDS = 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def part_path(upload_id: str) -> str:
+    return os.path.join(blob_dir, "uploads", f"{upload_id}.part")
+
+def object_path(sha256: str) -> str:
+    return os.path.join(blob_dir, "objects", sha256[:2], sha256)
+
+def create_part(upload_id: str):
+    """
+    Creates the empty part file of a new upload.
+
+    :param upload_id - id of the upload.
+    """
+    os.makedirs(os.path.dirname(part_path(upload_id)), exist_ok=True)
+    open(part_path(upload_id), "xb").close()
+
+def open_part(upload_id: str) -> Optional[BinaryIO]:
+    """
+    Opens the part file of an upload for appending, and waits for an exclusive lock on it, which
+    is released when the file is closed.
+
+    :param upload_id - id of the upload.
+    :return - the locked part file, or None if the upload was completed or removed meanwhile.
+    """
+    # never O_CREAT, so a completed upload's part is not created again; the lock holder before us
+    # may have moved the part into the object store
+    return _open_locked(part_path(upload_id), os.O_WRONLY | os.O_APPEND, "ab")
+
+def remove_idle_part(upload_id: str, idle_seconds: float) -> bool:
+    """
+    Deletes the part file of an upload that received no bytes for 'idle_seconds', unless a request
+    is appending to it right now.
+
+    :param upload_id - id of the upload.
+    :param idle_seconds - the time since the last append after which a part is removed.
+    :return - whether the part is gone.
+    """
+    try:
+        file = os.fdopen(os.open(part_path(upload_id), os.O_WRONLY | os.O_APPEND), "ab")
+    except FileNotFoundError:
+        return True
+    with file:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if os.fstat(file.fileno()).st_mtime > time.time() - idle_seconds:
+            return False
+        try:
+            os.remove(part_path(upload_id))
+        except FileNotFoundError:
+            pass
+        return True
+
+def get_offset(upload_id: str) -> int:
+    """
+    Returns the number of bytes received so far for an upload.
+
+    :param upload_id - id of the upload.
+    """
+    try:
+        return os.path.getsize(part_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+def commit_part(upload_id: str) -> str:
+    """
+    Hashes a complete upload and moves it into the object store, or drops it if an identical
+    object already exists.
+
+    :param upload_id - id of the completed upload.
+    :return - the sha256 hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(part_path(upload_id), "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+
+    path = object_path(sha256)
+    existing = _open_locked(path, os.O_RDONLY, "rb")
+    if existing is not None:
+        with existing:
+            # refresh the object's age under its lock, so a collection that found it unreferenced keeps it
+            os.utime(path)
+        os.remove(part_path(upload_id))
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(part_path(upload_id), "rb+") as file:
+            os.fsync(file.fileno())
+        # the part keeps the time of its last append, which may be older than the grace period
+        os.utime(part_path(upload_id))
+        os.replace(part_path(upload_id), path)
+    return sha256
+
+def remove_part(upload_id: str):
+    try:
+        os.remove(part_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+def iter_objects(older_than_seconds: float = COLLECT_GRACE_SECONDS) -> Iterator[str]:
+    """
+    Yields the sha256 of every stored object last modified more than 'older_than_seconds' ago.
+
+    :param older_than_seconds - the grace period of new objects.
+    """
+    cutoff = time.time() - older_than_seconds
+    root = os.path.join(blob_dir, "objects")
+    if not os.path.isdir(root):
+        return
+    for prefix in sorted(os.listdir(root)):
+        with os.scandir(os.path.join(root, prefix)) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime < cutoff:
+                    yield entry.name
+
+def remove_object(sha256: str, older_than_seconds: float = COLLECT_GRACE_SECONDS) -> bool:
+    """
+    Deletes a stored object unless it was modified within the grace period. The age is checked under
+    the object's lock, so an upload of the same content that 'commit_part' refreshed since the object
+    was listed keeps it.
+
+    :param sha256 - the sha256 of the object.
+    :param older_than_seconds - the grace period of new objects.
+    :return - whether the object is gone.
+    """
+    file = _open_locked(object_path(sha256), os.O_RDONLY, "rb")
+    if file is None:
+        return True
+    with file:
+        if os.fstat(file.fileno()).st_mtime >= time.time() - older_than_seconds:
+            return False
+        os.remove(object_path(sha256))
+        return True
+
+def _open_locked(path: str, flags: int, mode: str) -> Optional[BinaryIO]:
+    # opens an existing file and waits for an exclusive lock on it, released when the file is closed;
+    # None if the file is missing, or was replaced or removed by the lock holder before us
+    try:
+        file = os.fdopen(os.open(path, flags), mode)
+    except FileNotFoundError:
+        return None
+    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    try:
+        current = os.stat(path).st_ino
+    except FileNotFoundError:
+        current = None
+    if current != os.fstat(file.fileno()).st_ino:
+        file.close()
+        return None
+    return file
@@ -0,0 +1,231 @@
+## This class contains production traffic capture for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# In capture mode every request is appended to a trace file as one compact JSON array:
+#
+#   [offset_ms, "GET /chats/{chat_id}/messages", {"chat_id": 3}, [["limit", "50"]], user, request_bytes,
+#    status, response_bytes, duration_ms]
+#
+# Traces are sanitized as they are written. Routes are recorded by their template; ids of users,
+# chats, messages, uploads and attachments are replaced by small numbers assigned in order of first
+# appearance, so the trace keeps which requests touched the same chat without naming it. Request
+# bodies, message texts, search queries, cursors and tokens are never written: only the size of a
+# body is kept, and query values that are not known to be harmless are replaced by null.
+#
+# Each capture session starts with a header line, and offsets and ids are relative to their session.
+# 'backend/replay.py' rebuilds a matching dataset from a session and replays it.
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from fastapi import HTTPException
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from backend import auth
+
+logger = logging.getLogger(__name__)
+
+enabled = os.environ.get("TRAFFIC_CAPTURE", default="0") == "1"
+capture_path = os.environ.get("TRAFFIC_CAPTURE_PATH", default="backend/traffic/capture.ndjson")
+# the file stops growing at this size; capture has to be restarted with a new file
+max_bytes = int(os.environ.get("TRAFFIC_CAPTURE_MAX_BYTES", default=str(100 * 1024 * 1024)))
+FORMAT_VERSION = 1
+# buffered records are written to disk at least this often
+FLUSH_SECONDS = 1.0
+# path prefixes of requests that are not user traffic
+EXCLUDED_PREFIXES = ("/admin", "/health", "/docs", "/redoc", "/openapi.json")
+
+# the id namespace of each path parameter; values of other path parameters are dropped
+ID_PARAMETERS = {
+    "user_id": "user",
+    "chat_id": "chat",
+    "message_id": "message",
+    "upload_id": "upload",
+    "attachment_id": "attachment",
+}
+# query parameters whose values are kept as they are
+KEPT_QUERY_PARAMETERS = {"limit", "sort", "include", "email"}
+# query parameters holding ids, which are remapped like path parameters
+ID_QUERY_PARAMETERS = {"before": "message", "ids": "user"}
+# names an admin may give a new trace file, which is always created in the capture directory
+TRACE_FILE_NAME = re.compile(r"\w[\w.-]*\.ndjson")
+
+def trace_file(name: str) -> str:
+    """
+    Resolves the name of a trace file in the directory of 'TRAFFIC_CAPTURE_PATH'.
+
+    :param name - a file name ending in '.ndjson', without any directory.
+    :raises HTTPException (422) if the name is not a plain file name, or resolves outside the directory.
+    :return - the path of the trace file.
+    """
+    directory = os.path.realpath(os.path.dirname(capture_path) or ".")
+    path = os.path.realpath(os.path.join(directory, name))
+    if not TRACE_FILE_NAME.fullmatch(name) or os.path.dirname(path) != directory:
+        raise HTTPException(status_code=422, detail={
+            "error": "invalid_file",
+            "error_description": "the trace file must be a name ending in '.ndjson', without a directory"
+        })
+    return path
+
+class TrafficRecorder:
+    """Appends sanitized request records to a trace file."""
+
+    def __init__(self, path: str = capture_path, enabled: bool = enabled, max_bytes: int = max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._file = None
+        self._ids: dict[str, dict] = {}
+        self._started = 0.0
+        self._last_flush = 0.0
+        self.records = 0
+        self.dropped = 0
+        if enabled:
+            self.start()
+
+    def start(self, path: Optional[str] = None):
+        """
+        Starts a new capture session, appended to the trace file.
+
+        :param path - the trace file, or None to keep the current one.
+        """
+        with self._lock:
+            self._close()
+            self.path = path or self.path
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._ids = {namespace: {} for namespace in set(ID_PARAMETERS.values())}
+            self._started = time.perf_counter()
+            self.records = self.dropped = 0
+            self._write({"version": FORMAT_VERSION, "started_at": datetime.now().isoformat()})
+            self.enabled = True
+        logger.info("capturing traffic to %s", self.path)
+
+    def stop(self):
+        with self._lock:
+            self.enabled = False
+            self._close()
+
+    def record(self, scope: Scope, arrived: float, user_id: Optional[int], request_bytes: int, status: int,
+               response_bytes: int):
+        """
+        Appends the record of a completed request.
+
+        :param scope - the ASGI scope of the request, after routing.
+        :param arrived - the 'time.perf_counter()' at which the request arrived.
+        :param user_id - the id of the authenticated user, if any.
+        """
+        route = scope.get("route")
+        if route is None:
+            return
+        with self._lock:
+            if self._file is None:
+                return
+            if self._file.tell() >= self.max_bytes:
+                self.dropped += 1
+                return
+            path_ids = {name: self._remap(ID_PARAMETERS[name], value)
+                        for name, value in scope.get("path_params", {}).items() if name in ID_PARAMETERS}
+            self._write([
+                round((arrived - self._started) * 1000, 1),
+                f"{scope['method']} {route.path}",
+                path_ids,
+                self._sanitize_query(scope.get("query_string", b"").decode("latin-1")),
+                self._remap("user", user_id) if user_id is not None else None,
+                request_bytes,
+                status,
+                response_bytes,
+                round((time.perf_counter() - arrived) * 1000, 1),
+            ])
+            self.records += 1
+            if time.perf_counter() - self._last_flush >= FLUSH_SECONDS:
+                self._file.flush()
+                self._last_flush = time.perf_counter()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "path": self.path,
+                "records": self.records,
+                "dropped": self.dropped,
+                "bytes": self._file.tell() if self._file is not None else None,
+            }
+
+    def _sanitize_query(self, query_string: str) -> list:
+        query = []
+        for name, value in parse_qsl(query_string, keep_blank_values=True):
+            if name in KEPT_QUERY_PARAMETERS:
+                query.append([name, value])
+            elif name in ID_QUERY_PARAMETERS:
+                namespace = ID_QUERY_PARAMETERS[name]
+                query.append([name, ",".join(str(self._remap(namespace, part)) for part in value.split(",") if part)])
+            else:
+                query.append([name, None])
+        return query
+
+    def _remap(self, namespace: str, value) -> int:
+        ids = self._ids[namespace]
+        key = str(value)
+        if key not in ids:
+            ids[key] = len(ids) + 1
+        return ids[key]
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class TrafficCaptureMiddleware:
+    """Records every user request while the traffic recorder is enabled."""
+
+    def __init__(self, app: ASGIApp, recorder: Optional[TrafficRecorder] = None):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        recorder = self.recorder or traffic_recorder
+        if scope["type"] != "http" or not recorder.enabled or scope["path"].startswith(EXCLUDED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.perf_counter()
+        headers = Headers(scope=scope)
+        response = {"status": 0, "bytes": 0}
+
+        async def send_counted(message: Message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            length = headers.get("content-length", "")
+            recorder.record(scope, arrived, _user_id(headers), int(length) if length.isdigit() else 0,
+                            response["status"] or 500, response["bytes"])
+
+def _user_id(headers: Headers) -> Optional[int]:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return auth.get_current_user_id(token)
+    except HTTPException:
+        return None
+
+traffic_recorder = TrafficRecorder()
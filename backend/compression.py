@@ -0,0 +1,221 @@
+## This class contains response compression for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Compresses JSON responses above a size threshold with the best encoding the client accepts:
+# zstd and brotli when their optional packages are installed, gzip otherwise. Routes opt into a
+# compression level and into caching of compressed bodies with the 'compressible' decorator.
+# Cached bodies are keyed by a hash of the uncompressed body, so polling an unchanged collection
+# only hashes the payload instead of compressing it again.
+
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+minimum_size = int(os.environ.get("COMPRESSION_MIN_SIZE", default="1024"))
+default_level = int(os.environ.get("COMPRESSION_LEVEL", default="6"))
+cache_max_bytes = int(os.environ.get("COMPRESSION_CACHE_BYTES", default=str(16 * 1024 * 1024)))
+# bodies at least this large are compressed on a worker thread rather than on the event loop
+OFFLOAD_SIZE = 64 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+def _gzip(body: bytes, level: int) -> bytes:
+    return gzip.compress(body, compresslevel=max(1, min(level, 9)), mtime=0)
+
+def _brotli(body: bytes, level: int) -> bytes:
+    # brotli levels run 0-11; map the gzip-style 1-9 scale onto them
+    return brotli.compress(body, quality=max(0, min(round(level * 11 / 9), 11)))
+
+def _zstd(body: bytes, level: int) -> bytes:
+    return zstandard.ZstdCompressor(level=max(1, min(level, 19))).compress(body)
+
+# encodings in order of server preference, limited to the ones available in this environment
+ENCODERS: dict[str, Callable[[bytes, int], bytes]] = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = _zstd
+if brotli is not None:
+    ENCODERS["br"] = _brotli
+ENCODERS["gzip"] = _gzip
+
+def compressible(level: Optional[int] = None, cache: bool = False):
+    """
+    Marks a route's responses for compression settings other than the defaults. Must be applied
+    below the router decorator, so the router registers the marked function.
+
+    :param level - the compression level (1-9, gzip scale) for this route.
+    :param cache - whether compressed bodies of this route are cached for identical payloads.
+    """
+    def decorator(endpoint):
+        endpoint.compression_level = level
+        endpoint.compression_cache = cache
+        return endpoint
+    return decorator
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the preferred available encoding that the client accepts with a non-zero quality.
+
+    :param accept_encoding - the value of the request's Accept-Encoding header.
+    :return - the encoding name, or None if the response should not be compressed.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = 1.0
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ENCODERS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+class CompressedBodyCache:
+    """LRU cache of compressed bodies keyed by (body hash, encoding, level), bounded in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: tuple, body: bytes):
+        with self._lock:
+            if key in self._entries or len(body) > self.max_bytes:
+                return
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": self._size,
+                "max_memory_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+compressed_cache = CompressedBodyCache(cache_max_bytes)
+compression_stats = {"responses": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0}
+
+class CompressionMiddleware:
+    """Compresses complete, single-chunk JSON or text responses above the size threshold."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = minimum_size):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        passthrough = False
+
+        async def send_compressed(message: Message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            if start is not None and not message.get("more_body", False) and self._should_compress(start, body):
+                compressed = await self._compress(scope, body, encoding)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["content-encoding"] = encoding
+                headers["content-length"] = str(len(compressed))
+                headers.add_vary_header("Accept-Encoding")
+                compression_stats["compressed"] += 1
+                compression_stats["bytes_in"] += len(body)
+                compression_stats["bytes_out"] += len(compressed)
+                body = compressed
+                message = {**message, "body": body}
+
+            # anything streamed in several chunks (e.g. file downloads) is passed through untouched
+            passthrough = True
+            compression_stats["responses"] += 1
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    def _should_compress(self, start: Message, body: bytes) -> bool:
+        headers = Headers(raw=start["headers"])
+        return (
+            start["status"] not in (204, 206, 304)
+            and len(body) >= self.minimum_size
+            and "content-encoding" not in headers
+            and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+        )
+
+    async def _compress(self, scope: Scope, body: bytes, encoding: str) -> bytes:
+        route = scope.get("route")
+        endpoint = getattr(route, "endpoint", None)
+        level = getattr(endpoint, "compression_level", None) or default_level
+        encoder = ENCODERS[encoding]
+
+        if not getattr(endpoint, "compression_cache", False):
+            return await self._encode(encoder, body, level)
+
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding, level)
+        compressed = compressed_cache.get(key)
+        if compressed is None:
+            compressed = await self._encode(encoder, body, level)
+            compressed_cache.put(key, compressed)
+        return compressed
+
+    async def _encode(self, encoder: Callable[[bytes, int], bytes], body: bytes, level: int) -> bytes:
+        if len(body) >= OFFLOAD_SIZE:
+            return await run_in_threadpool(encoder, body, level)
+        return encoder(body, level)
@@ -0,0 +1,78 @@
+## This class contains request admission control for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Every request holds one pooled database connection from its first query until its response has
+# been serialized, and both the endpoint and the serialization need a thread from the 40-thread
+# anyio pool. If more requests are in flight than there are connections, requests holding a
+# connection wait for a thread while every thread waits for a connection, and the worker deadlocks.
+# Bounding the requests in flight to the pool size keeps the excess queued in the event loop, where
+# it holds neither.
+#
+# FastAPI closes a request's session before the response starts, so a request gives up its slot as
+# soon as it starts responding; streaming a large download does not keep other requests waiting.
+# Routes that stream a large request body after closing their session (attachment uploads) give
+# the slot up early with 'release_slot'.
+
+import asyncio
+import os
+
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from backend.database import POOL_SIZE
+
+max_in_flight = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", default=str(POOL_SIZE)))
+
+class ConcurrencyLimitMiddleware:
+    """Queues HTTP requests beyond 'limit' until an in-flight request completes."""
+
+    def __init__(self, app: ASGIApp, limit: int = max_in_flight):
+        self.app = app
+        self.limit = limit
+        self._semaphore = None
+        self._loop = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        semaphore = self._get_semaphore()
+        await semaphore.acquire()
+        held = True
+
+        def release():
+            nonlocal held
+            if held:
+                held = False
+                semaphore.release()
+
+        async def send_releasing(message: Message):
+            if message["type"] == "http.response.start":
+                release()
+            await send(message)
+
+        scope["concurrency_slot"] = release
+        try:
+            await self.app(scope, receive, send_releasing)
+        finally:
+            release()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # a semaphore is bound to the event loop it first waits in, and test clients start new loops
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+def release_slot(request: Request):
+    """
+    Gives up the request's in-flight slot before its response starts. Only call this once the
+    request holds no pooled connection and needs no pool thread for the rest of its work.
+
+    :param request - the current request.
+    """
+    release = request.scope.get("concurrency_slot")
+    if release is not None:
+        release()
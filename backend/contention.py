@@ -0,0 +1,117 @@
+## This class contains write-contention handling for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# SQLite allows one writer at a time. A write that cannot get the lock within the driver's busy
+# timeout fails with "database is locked", which used to surface as a 500. The mutators in
+# 'database.py' are wrapped in 'retry_on_busy', which rolls the session back and runs the whole
+# mutation again after a jittered exponential backoff, and only answers 503 once every attempt failed.
+#
+# Edits are guarded by optimistic concurrency instead of locks: chats, messages and users carry a
+# version that every update compares and increments in a single UPDATE. The version is sent as the
+# ETag of a resource and may be echoed in 'If-Match' to make sure an edit applies to what the
+# client last saw. Retries and conflicts are counted per mutator and per table, so contention shows
+# up at 'GET /admin/contention'.
+
+import functools
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from fastapi import Header, HTTPException, Response
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session
+
+write_retries = int(os.environ.get("DB_WRITE_RETRIES", default="5"))
+retry_base_seconds = float(os.environ.get("DB_WRITE_RETRY_BASE_SECONDS", default="0.05"))
+retry_max_seconds = float(os.environ.get("DB_WRITE_RETRY_MAX_SECONDS", default="1.0"))
+
+_lock = threading.Lock()
+_retries = Counter()
+_exhausted = Counter()
+_conflicts = Counter()
+
+def is_busy(error: OperationalError) -> bool:
+    message = str(error.orig).lower()
+    return isinstance(error.orig, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+def backoff(attempt: int) -> float:
+    """
+    :param attempt - the number of failed attempts so far, starting at 1.
+    :return - a random delay up to the capped exponential backoff of the attempt ("full jitter").
+    """
+    return random.uniform(0, min(retry_max_seconds, retry_base_seconds * 2 ** (attempt - 1)))
+
+def retry_on_busy(function):
+    """
+    Runs a mutator again when SQLite reports the database as locked or busy. The mutator must take
+    its Session as the 'session' argument and must not have side effects before its commit.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except OperationalError as error:
+                if not is_busy(error):
+                    raise
+                _session_of(args, kwargs).rollback()
+                attempt += 1
+                if attempt > write_retries:
+                    with _lock:
+                        _exhausted[function.__name__] += 1
+                    raise HTTPException(status_code=503, headers={"Retry-After": "1"}, detail={
+                        "error": "database_busy",
+                        "error_description": "the database is busy, try again"
+                    })
+                with _lock:
+                    _retries[function.__name__] += 1
+                time.sleep(backoff(attempt))
+
+    return wrapper
+
+def record_conflict(table: str):
+    with _lock:
+        _conflicts[table] += 1
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "retries": dict(_retries),
+            "exhausted": dict(_exhausted),
+            "conflicts": dict(_conflicts),
+            "max_retries": write_retries,
+        }
+
+def reset_stats():
+    with _lock:
+        _retries.clear()
+        _exhausted.clear()
+        _conflicts.clear()
+
+def if_match_version(if_match: Optional[str] = Header(None, description="The ETag of the version the edit applies to.")) -> Optional[int]:
+    """
+    Reads the expected version from an 'If-Match' header. A header naming no version ('*') or no
+    header at all returns None; a header that cannot match any version fails with 412.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=412, detail={
+            "error": "precondition_failed",
+            "error_description": "If-Match does not name a version of this resource"
+        })
+
+def set_etag(response: Response, version: int):
+    response.headers["ETag"] = f'"{version}"'
+
+def _session_of(args: tuple, kwargs: dict) -> Session:
+    if "session" in kwargs:
+        return kwargs["session"]
+    return next(arg for arg in args if isinstance(arg, Session))
@@ -0,0 +1,204 @@
+## This class contains the sampling CPU profiler for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# An admin starts a profile on a live worker for a few seconds. A background thread then takes the
+# Python stack of every other thread at a fixed rate with 'sys._current_frames()', which costs a few
+# microseconds per thread and needs no tracing hooks, so requests run at full speed meanwhile.
+# Threads that are waiting (idle pool threads, the event loop in 'select', background loops
+# sleeping on an event) are left out unless asked for, so the samples show where CPU time goes.
+#
+# A profile can be restricted to one route: only stacks that pass through the route's endpoint
+# function count, including the database and serialization work it calls. Results are kept as
+# counts per distinct stack and rendered on request as collapsed stacks ("frame;frame;frame count"
+# per line, as read by flamegraph.pl, speedscope or inferno) and as a summary of the functions with
+# the most samples. Only one profile runs at a time, and its length and rate are capped.
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import CodeType, FrameType
+from typing import Optional
+
+from backend.allocations import short_path
+
+default_rate = float(os.environ.get("CPU_PROFILE_HZ", default="100"))
+MAX_SECONDS = 60
+MAX_RATE = 1000
+TRAILING_NUMBER = re.compile(r"[-_\d]+$")
+# number of functions listed in a profile's summary
+TOP_FUNCTIONS = 20
+# the innermost Python functions of a thread that is blocked waiting rather than running
+IDLE_FUNCTIONS = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("concurrent/futures/thread.py", "_worker"),
+}
+
+class CpuProfile:
+    """The samples of one profiling run, counted per distinct stack."""
+
+    def __init__(self, seconds: float, rate: float, route: Optional[str], include_idle: bool):
+        self.seconds = seconds
+        self.rate = rate
+        self.route = route
+        self.include_idle = include_idle
+        self.started_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+        self.sweeps = 0
+        self.idle = 0
+        self.filtered = 0
+        # (thread name, code objects from the outermost frame inwards) -> samples
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+
+    def collapsed(self) -> str:
+        """Renders the samples as collapsed stacks, one "thread;outer;...;inner count" line per stack."""
+        with self.lock:
+            stacks = self.stacks.copy()
+        lines = []
+        for (thread, codes), count in stacks.most_common():
+            frames = ";".join([thread] + [_label(code) for code in codes])
+            lines.append(f"{frames} {count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def summary(self, limit: int = TOP_FUNCTIONS) -> dict:
+        """
+        :param limit - the maximum number of functions listed.
+        :return - the state of the profile, and the functions with the most samples where they were
+        running themselves ("self") and anywhere on the stack ("total"), by descending self samples.
+        """
+        with self.lock:
+            stacks = self.stacks.copy()
+        own, total = Counter(), Counter()
+        for (_thread, codes), count in stacks.items():
+            own[codes[-1]] += count
+            for code in set(codes):
+                total[code] += count
+        samples = sum(stacks.values())
+        ranked = sorted(total, key=lambda code: (own[code], total[code]), reverse=True)[:limit]
+        return {
+            "status": "running" if self.finished_at is None else "finished",
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": self.seconds,
+            "rate": self.rate,
+            "route": self.route,
+            "sweeps": self.sweeps,
+            "samples": samples,
+            "idle_samples": self.idle,
+            "filtered_samples": self.filtered,
+            "top_functions": [{
+                "function": _label(code),
+                "self_samples": own[code],
+                "total_samples": total[code],
+                "self_share": round(own[code] / samples, 4) if samples else 0.0,
+                "total_share": round(total[code] / samples, 4) if samples else 0.0,
+            } for code in ranked],
+        }
+
+class SamplingProfiler:
+    """Runs at most one stack-sampling profile at a time on a background thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profile: Optional[CpuProfile] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._idle_codes: dict[CodeType, bool] = {}
+
+    def start(self, seconds: float, rate: float = default_rate, route: Optional[str] = None,
+              route_codes: frozenset = frozenset(), include_idle: bool = False) -> Optional[CpuProfile]:
+        """
+        Starts sampling every other thread's stack.
+
+        :param seconds - how long to sample, capped at MAX_SECONDS.
+        :param rate - the number of samples per second, capped at MAX_RATE.
+        :param route - the name of the route the profile is restricted to, if any.
+        :param route_codes - the code objects of the route's endpoint; only stacks containing one are kept.
+        :param include_idle - whether stacks of waiting threads are kept.
+        :return - the new profile, or None if a profile is already running.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return None
+            profile = self._profile = CpuProfile(min(seconds, MAX_SECONDS), min(rate, MAX_RATE), route, include_idle)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, args=(profile, route_codes),
+                                            name="cpu-profiler", daemon=True)
+            self._thread.start()
+            return profile
+
+    def stop(self, timeout: float = 5):
+        """Ends the running profile early; its samples so far are kept."""
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the running profile to finish, and returns whether it did."""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    @property
+    def profile(self) -> Optional[CpuProfile]:
+        """The running or most recent profile."""
+        with self._lock:
+            return self._profile
+
+    def _sample(self, profile: CpuProfile, route_codes: frozenset):
+        own = threading.get_ident()
+        interval = 1 / profile.rate
+        deadline = time.monotonic() + profile.seconds
+        next_sweep = time.monotonic()
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: _thread_group(thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._record(profile, names.get(ident, "thread"), frame, route_codes)
+            profile.sweeps += 1
+            next_sweep += interval
+            self._stop.wait(max(0.0, next_sweep - time.monotonic()))
+        profile.finished_at = datetime.now()
+
+    def _record(self, profile: CpuProfile, thread: str, frame: FrameType, route_codes: frozenset):
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        if not profile.include_idle and self._is_idle(codes[0]):
+            profile.idle += 1
+            return
+        if route_codes and route_codes.isdisjoint(codes):
+            profile.filtered += 1
+            return
+        codes.reverse()
+        with profile.lock:
+            profile.stacks[(thread, tuple(codes))] += 1
+
+    def _is_idle(self, code: CodeType) -> bool:
+        idle = self._idle_codes.get(code)
+        if idle is None:
+            filename = short_path(code.co_filename).replace(os.sep, "/")
+            idle = self._idle_codes[code] = (filename, code.co_name) in IDLE_FUNCTIONS
+        return idle
+
+def _thread_group(name: str) -> str:
+    # pool threads differ only by a trailing number, e.g. "ThreadPoolExecutor-0_3"
+    return TRAILING_NUMBER.sub("", name) or name
+
+def _label(code: CodeType) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+cpu_profiler = SamplingProfiler()
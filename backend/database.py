@@ -1,26 +1,68 @@
 ## This class contains backend database methods for the Spring 2024 CS 4550 Pony Express application.
 # Author: Riley Kraabel
 
-from sqlmodel import Session, SQLModel, create_engine, select
+import base64
+import os
+import uuid
+from typing import Callable, Iterator, Optional
+from sqlmodel import Session, SQLModel, create_engine, select, func, and_, or_, delete, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
 from fastapi import HTTPException
-from datetime import datetime
+from datetime import datetime, timedelta
 from backend.entities import (
+    AttachmentInDB,
+    MentionInDB,
+    MessageFlagInDB,
     MessageInDB,
+    MessageRollupInDB,
     UserInDB,
     ChatInDB,
+    ChatSummaryInDB,
+    ChatDeletionInDB,
+    JobInDB,
+    ModerationTermInDB,
+    UploadCreate,
+    UploadInDB,
     Message,
     UserUpdate,
     UserChatLinkInDB
 )
+from backend.mentions import extract_usernames, username_directory
+from backend.message_cache import message_cache
+from backend.moderation import moderation_filter
+from backend.presence import presence
+from backend.query_analyzer import query_analyzer
+from backend.single_flight import chat_reads
+from backend.rows import ChatPreviewRow, InboxChatRow, UserRow, UserRows, user_columns
+from backend import archive, backups, blobs, contention, events, jobs, migrations
+from backend.contention import retry_on_busy
+
+# Sync routes run on the 40-thread anyio pool and each one holds a pooled connection while it runs,
+# so the pool is sized to the thread pool rather than SQLAlchemy's default of 5 (plus 10 overflow).
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", default="40"))
+# number of messages removed per transaction when purging a deleted chat, so no single
+# transaction holds SQLite's write lock for long
+DELETE_CHUNK_SIZE = int(os.environ.get("DELETE_CHUNK_SIZE", default="1000"))
 
 engine = create_engine(
     "sqlite:///backend/pony_express.db",
     echo=True,
     connect_args={"check_same_thread": False},
+    pool_size=POOL_SIZE,
 )
+query_analyzer.install(engine)
+
+# number of characters of the last message kept in a chat's inbox summary
+PREVIEW_LENGTH = 100
+# the sizes of the time buckets that messages are counted in for analytics
+ROLLUP_GRANULARITIES = ("hour", "day")
+# number of banned terms inserted per statement, below SQLite's limit on bound parameters
+MODERATION_TERMS_BATCH_SIZE = 500
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
 
 def get_session():
     with Session(engine) as session:
@@ -63,27 +105,110 @@ def get_user_by_id(user_id: int, session: Session) -> UserInDB:
 
     raise EntityNotFoundException(entity_name="User", entity_id=user_id)        
 
-def get_all_users(session: Session) -> list[UserInDB]:
+def get_all_users(session: Session, limit: Optional[int] = None,
+                  cursor: Optional[str] = None) -> tuple[list[UserRow], Optional[str]]:
     """
-    Retrieve all users from the database. 
+    Retrieve a page of users from the database, ordered by id, as read-only rows.
 
     :param session - a Session object for database retrieval. 
-    :return - ordered list of users.
+    :param limit - the maximum number of users to return, or None for every user.
+    :param cursor - the 'next_cursor' of the previous page, or None for the first page.
+    :return - the users of the page, and the cursor of the next page (None on the last page).
+    """
+    statement = select(*user_columns()).order_by(UserInDB.id)
+    if cursor:
+        statement = statement.where(UserInDB.id > _decode_id_cursor(cursor))
+
+    users = [UserRow(*values) for values in session.exec(statement.limit(limit + 1 if limit else None))]
+    if limit and len(users) > limit:
+        users = users[:limit]
+        return users, str(users[-1].id)
+    return users, None
+
+def count_users(session: Session) -> int:
     """
-    return session.exec(select(UserInDB)).all()
+    Counts every user in the database.
 
-def get_all_users_from_chat(chat_id: int, session: Session) -> list[UserInDB]:
+    :param session - a Session object for database retrieval.
+    :return - the number of users.
+    """
+    return session.exec(select(func.count()).select_from(UserInDB)).one()
+
+def get_users_by_ids(user_ids: list[int], session: Session) -> list[UserRow]:
+    """
+    Retrieve the users with the given ids in a single query, as read-only rows. Ids that do not exist are skipped.
+
+    :param user_ids - ids of the users to be retrieved.
+    :param session - a Session object for database retrieval.
+    :return - the found users, ordered by id.
+    """
+    statement = select(*user_columns()).where(UserInDB.id.in_(user_ids)).order_by(UserInDB.id)
+    return [UserRow(*values) for values in session.exec(statement)]
+
+def search_users(query: str, session: Session, limit: int, include_email: bool = False) -> list[UserRow]:
+    """
+    Retrieve the users whose username (or, optionally, email) starts with the query, ignoring case.
+    The prefix is matched as a range on the lower-cased column, so it is answered from the
+    'ix_users_username_lower' and 'ix_users_email_lower' indexes instead of scanning every user.
+
+    :param query - the prefix to search for.
+    :param session - a Session object for database retrieval.
+    :param limit - the maximum number of users to return.
+    :param include_email - whether users whose email starts with the query also match.
+    :return - the matching users as read-only rows, ordered by username.
     """
-    Retrieve all of the users involved in the 'chat_id' provided.
+    prefix = query.lower()
+    # U+10FFFF sorts after every character under SQLite's binary collation, closing the prefix range
+    upper_bound = prefix + "\U0010ffff"
+
+    def prefix_of(column):
+        return and_(func.lower(column) >= prefix, func.lower(column) < upper_bound)
+
+    condition = prefix_of(UserInDB.username)
+    if include_email:
+        condition = or_(condition, prefix_of(UserInDB.email))
+    statement = select(*user_columns()).where(condition).order_by(func.lower(UserInDB.username)).limit(limit)
+    return [UserRow(*values) for values in session.exec(statement)]
+
+def get_member_ids(chat_id: int, session: Session) -> list[int]:
+    """
+    Retrieve the ids of the members of a chat, without loading the users.
+
+    :param chat_id - id of the chat.
+    :param session - a Session object for database retrieval.
+    :return - the member ids; empty if the chat does not exist.
+    """
+    return session.exec(select(UserChatLinkInDB.user_id).where(UserChatLinkInDB.chat_id == chat_id)).all()
+
+def get_all_users_from_chat(chat_id: int, session: Session) -> list[UserRow]:
+    """
+    Retrieve all of the users involved in the 'chat_id' provided, as read-only rows.
 
     :param chat_id - the id of the chat to be retrieved.
     :param session - a Session object for database retrieval. 
-    :return - list of the users involved in the specified 'chat_id'. 
+    :return - list of the users involved in the specified 'chat_id', ordered by id.
     :raises EntityNotFoundException if the chat_id does not map to anything in the database. 
     """
-    chat = get_chat_by_id(chat_id, session)
-    return chat.users
+    get_chat_by_id(chat_id, session)
+    return _read_chat_users(chat_id, session)
+
+def _read_chat_users(chat_id: int, session: Session) -> list[UserRow]:
+    statement = (
+        select(*user_columns())
+        .join(UserChatLinkInDB, UserChatLinkInDB.user_id == UserInDB.id)
+        .where(UserChatLinkInDB.chat_id == chat_id)
+        .order_by(UserInDB.id)
+    )
+    return [UserRow(*values) for values in session.exec(statement)]
 
+def _get_user_rows(user_ids: set[int], session: Session) -> UserRows:
+    users = UserRows()
+    if user_ids:
+        for values in session.exec(select(*user_columns()).where(UserInDB.id.in_(user_ids))):
+            users.row(values)
+    return users
+
+@retry_on_busy
 def create_user(user_create: UserInDB, session: Session) -> UserInDB:
     """
     Creates a new user in the database. 
@@ -94,26 +219,36 @@ def create_user(user_create: UserInDB, session: Session) -> UserInDB:
     """
     user = UserInDB(**user_create.model_dump())
     session.add(user)
+    session.flush()
+    events.publish(session, "username", user.id)
     session.commit()
     session.refresh(user)
+    username_directory.add(user.id, user.username)
     return user
 
-def update_user(user: UserInDB, user_update: UserUpdate, session: Session) -> UserInDB:
+@retry_on_busy
+def update_user(user: UserInDB, user_update: UserUpdate, session: Session,
+                expected_version: Optional[int] = None) -> UserInDB:
     """
-    Updates an existing user in the database.
+    Updates an existing user in the database, unless it changed since it was read.
 
     :param user - the User object to update.
     :param user_update - the attributes of the user to update.
     :param session - a Session object for database retrieval. 
+    :param expected_version - the version the update applies to (from 'If-Match'), or None for the version read.
+    :raises HTTPException (409/412) if the user changed concurrently or is not at the expected version.
     :return - the updated version of the user. 
     """
     current_user = get_user_by_id(user.id, session)
-    for attr, value in user_update.model_dump(exclude_none=True).items():
-        setattr(current_user, attr, value)
-
-    session.add(current_user)
+    _compare_and_set(current_user, expected_version, session, **user_update.model_dump(exclude_none=True))
+    events.publish(session, "user", current_user.id)
     session.commit()
     session.refresh(current_user)
+    username_directory.add(current_user.id, current_user.username)
+
+    # messages embed their author, so cached messages may now carry a stale username/email
+    message_cache.clear()
+    chat_reads.clear()
     return current_user
 
 def get_existing_user(session: Session, username: str, email: str) -> UserInDB:
@@ -127,6 +262,45 @@ def get_existing_user(session: Session, username: str, email: str) -> UserInDB:
     """
     return session.exec(select(UserInDB).filter((UserInDB.username == username) | (UserInDB.email == email))).first()
 
+def get_taken_usernames_and_emails(usernames: list[str], emails: list[str],
+                                   session: Session) -> tuple[set[str], set[str]]:
+    """
+    Finds which of many usernames and emails already belong to users, with one batched query for each.
+
+    :param usernames - the usernames to check, at most a few hundred.
+    :param emails - the emails to check, at most a few hundred.
+    :param session - a Session object for database retrieval.
+    :return - the usernames and the emails that are taken.
+    """
+    taken_usernames = set(session.exec(select(UserInDB.username).where(UserInDB.username.in_(usernames))).all()
+                          if usernames else ())
+    taken_emails = set(session.exec(select(UserInDB.email).where(UserInDB.email.in_(emails))).all() if emails else ())
+    return taken_usernames, taken_emails
+
+@retry_on_busy
+def create_users(users: list[dict], session: Session) -> list[tuple[int, str]]:
+    """
+    Creates many users with a single insert, in one transaction. Users whose username or email was
+    taken after it was checked are skipped rather than failing the others.
+
+    :param users - the 'username', 'email' and 'hashed_password' of each user.
+    :param session - a Session object for database retrieval.
+    :return - the id and username of every user created.
+    """
+    now = datetime.now()
+    created = session.exec(
+        sqlite_insert(UserInDB)
+        .values([{**user, "created_at": now} for user in users])
+        .on_conflict_do_nothing()
+        .returning(UserInDB.id, UserInDB.username)
+    ).all()
+    for user_id, _username in created:
+        events.publish(session, "username", user_id)
+    session.commit()
+    for user_id, username in created:
+        username_directory.add(user_id, username)
+    return created
+
 # ---------- methods for the 'chats' routes  ----------- #
 def get_chat_by_id(chat_id: int, session: Session) -> ChatInDB:
     """
@@ -138,28 +312,112 @@ def get_chat_by_id(chat_id: int, session: Session) -> ChatInDB:
     :return - the retrieved chat.
     """
     chat = session.get(ChatInDB, chat_id)
-    if chat:
+    # a chat whose messages are still being purged is already deleted for every caller
+    if chat and session.get(ChatDeletionInDB, chat_id) is None:
         return chat
     
     raise EntityNotFoundException(entity_name="Chat", entity_id=chat_id)
 
-def get_all_chats(current_user: UserInDB, session: Session) -> list[ChatInDB]:
+def get_all_chats(current_user: UserInDB, session: Session, sort: str = "id", limit: Optional[int] = None,
+                  cursor: Optional[str] = None) -> tuple[list[InboxChatRow], Optional[str]]:
     """
-    Retrieve all chats from the database that the given user is a part of.
+    Retrieve a page of the chats that the given user is a part of, along with each chat's last activity.
+    Chats are found through the user's rows in user_chat_links and joined to their inbox summaries,
+    owners and last message authors in a single query, which selects only the columns of the response.
+    Each link row holds its chat's last activity, so the "recent" order is read from the
+    (user_id, last_activity_at, chat_id) index rather than sorting every chat of the user.
 
     :param current_user - the currently logged in user.
     :param session - a Session object for database retrieval. 
-    :return - ordered list of chats.
-    """
-    valid_chats = []
-    all_chats = session.exec(select(ChatInDB)).all()
-    for chat in all_chats:
-        chat_link = session.get(UserChatLinkInDB, (current_user.id, chat.id))
-        if chat_link is not None:
-            valid_chats.append(chat)
-    
-    return valid_chats
+    :param sort - "id" to order chats by id, or "recent" to order them by last activity, most recent first.
+    :param limit - the maximum number of chats to return, or None for every chat.
+    :param cursor - the 'next_cursor' returned with the previous page, if any.
+    :return - a tuple of the ordered chats and the cursor of the next page (None on the last page).
+    """
+    owner = aliased(UserInDB)
+    author = aliased(UserInDB)
+    statement = (
+        select(ChatInDB.id, ChatInDB.name, ChatInDB.created_at, ChatSummaryInDB.last_message_id,
+               ChatSummaryInDB.preview, UserChatLinkInDB.last_activity_at, *user_columns(owner), *user_columns(author))
+        .join(UserChatLinkInDB, UserChatLinkInDB.chat_id == ChatInDB.id)
+        .join(owner, owner.id == ChatInDB.owner_id)
+        .outerjoin(ChatSummaryInDB, ChatSummaryInDB.chat_id == ChatInDB.id)
+        .outerjoin(author, author.id == ChatSummaryInDB.last_user_id)
+        .where(UserChatLinkInDB.user_id == current_user.id)
+    )
+
+    if sort == "recent":
+        if cursor:
+            last_activity_at, chat_id = _decode_inbox_cursor(cursor)
+            statement = statement.where(or_(
+                UserChatLinkInDB.last_activity_at < last_activity_at,
+                and_(UserChatLinkInDB.last_activity_at == last_activity_at, UserChatLinkInDB.chat_id < chat_id),
+            ))
+        statement = statement.order_by(UserChatLinkInDB.last_activity_at.desc(), UserChatLinkInDB.chat_id.desc())
+    else:
+        if cursor:
+            statement = statement.where(ChatInDB.id > _decode_id_cursor(cursor))
+        statement = statement.order_by(ChatInDB.id)
+
+    rows = session.exec(statement.limit(limit + 1 if limit else None)).all()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        chat_id, last_activity_at = rows[-1][0], rows[-1][5]
+        next_cursor = _encode_inbox_cursor(chat_id, last_activity_at) if sort == "recent" else str(chat_id)
+
+    users = UserRows()
+    return [_build_inbox_chat(row, users) for row in rows], next_cursor
+
+def count_chats_of_user(current_user: UserInDB, session: Session) -> int:
+    """
+    Counts the chats that the given user is a part of.
+
+    :param current_user - the currently logged in user.
+    :param session - a Session object for database retrieval.
+    :return - the number of chats the user is a member of.
+    """
+    return session.exec(
+        select(func.count()).select_from(UserChatLinkInDB).where(UserChatLinkInDB.user_id == current_user.id)
+    ).one()
+
+def _build_inbox_chat(row, users: UserRows) -> InboxChatRow:
+    chat_id, name, created_at, last_message_id, preview, last_activity_at = row[:6]
+    author = users.row(row[10:14])
+    last_message = None
+    if last_message_id is not None and author is not None:
+        last_message = ChatPreviewRow(last_message_id, author, preview)
+
+    return InboxChatRow(chat_id, name, users.row(row[6:10]), created_at,
+                        last_activity_at if last_activity_at is not None else created_at, last_message)
+
+def _encode_inbox_cursor(chat_id: int, last_activity_at: Optional[datetime]) -> str:
+    # chats without a summary sort last, so their cursor can only point past the end of the listing
+    if last_activity_at is None:
+        last_activity_at = datetime.min
+    raw = f"{last_activity_at.isoformat()}|{chat_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_id_cursor(cursor: str) -> int:
+    try:
+        return int(cursor)
+    except ValueError:
+        raise HTTPException(status_code=422, detail={
+            "error": "invalid_cursor",
+            "error_description": "the cursor is not valid for this listing"
+        })
+
+def _decode_inbox_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        last_activity_at, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(last_activity_at), int(chat_id)
+    except ValueError:
+        raise HTTPException(status_code=422, detail={
+            "error": "invalid_cursor",
+            "error_description": "the cursor is not valid for this listing"
+        })
 
+@retry_on_busy
 def add_chat(chat_name: str, current_user: UserInDB, session: Session) -> ChatInDB:
     """
     Adds a chat to the database. The current user is set to be the chat's owner, and they are added
@@ -176,6 +434,9 @@ def add_chat(chat_name: str, current_user: UserInDB, session: Session) -> ChatIn
     )
     new_chat.users.append(current_user)
     session.add(new_chat)
+    session.flush()
+    session.add(ChatSummaryInDB(chat_id=new_chat.id, last_activity_at=new_chat.created_at))
+    _set_member_activity(new_chat.id, new_chat.created_at, session)
     session.commit()
     session.refresh(new_chat)
 
@@ -186,23 +447,27 @@ def add_chat(chat_name: str, current_user: UserInDB, session: Session) -> ChatIn
 
     return new_chat
 
-def update_chat(chat_id: int, new_name: str, session: Session) -> ChatInDB:
+@retry_on_busy
+def update_chat(chat_id: int, new_name: str, session: Session, expected_version: Optional[int] = None) -> ChatInDB:
     """
-    Update a chat in the database.
+    Update a chat in the database, unless it changed since it was read.
 
     :param chat_id: id of the chat to be updated
     :param chat_update: attributes to be updated on the chat
     :param session - a Session object for database retrieval. 
+    :param expected_version - the version the update applies to (from 'If-Match'), or None for the version read.
+    :raises HTTPException (409/412) if the chat changed concurrently or is not at the expected version.
     :return: the updated chat
     """
     chat = get_chat_by_id(chat_id, session)
-    chat.name = new_name
-
-    session.add(chat)
+    _compare_and_set(chat, expected_version, session, name=new_name)
+    events.publish(session, "chat", chat.id)
     session.commit()
+    chat_reads.invalidate(chat.id)
     session.refresh(chat)
     return chat
 
+@retry_on_busy
 def add_new_chat_user(chat_id: int, user_id: int, session: Session) -> ChatInDB:
     """
     Add a new user to the specified chat.
@@ -215,23 +480,21 @@ def add_new_chat_user(chat_id: int, user_id: int, session: Session) -> ChatInDB:
     """
     chat = get_chat_by_id(chat_id, session)
     user = get_user_by_id(user_id, session)
-    chat.users.append(user)
 
-    statement = select(UserChatLinkInDB).where(
-        UserChatLinkInDB.user_id == user.id, 
-        UserChatLinkInDB.chat_id == chat.id
-    )
-    existing_link = session.exec(statement).all()
-    if not existing_link:
-        session.add(existing_link)
-        session.commit()
-
-    session.add(chat)
+    # insert-or-ignore, so concurrent requests adding the same member cannot collide on the primary key
+    last_activity_at = select(ChatSummaryInDB.last_activity_at).where(ChatSummaryInDB.chat_id == chat.id).scalar_subquery()
+    session.exec(sqlite_insert(UserChatLinkInDB).values(
+        user_id=user.id, chat_id=chat.id, last_activity_at=last_activity_at
+    ).on_conflict_do_nothing())
+    events.publish(session, "membership", chat.id)
     session.commit()
+    presence.invalidate_members(chat.id)
+    chat_reads.invalidate(chat.id)
     session.refresh(chat)
 
     return chat
 
+@retry_on_busy
 def remove_chat_user(chat_id: int, user_id: int, session: Session) -> ChatInDB:
     """
     Removes a user from the specified chat.
@@ -244,34 +507,114 @@ def remove_chat_user(chat_id: int, user_id: int, session: Session) -> ChatInDB:
     """
     chat = get_chat_by_id(chat_id, session)
     user = get_user_by_id(user_id, session)
-    chat.users.remove(user)
-
-    statement = select(UserChatLinkInDB).where(
-        UserChatLinkInDB.user_id == user.id, 
-        UserChatLinkInDB.chat_id == chat.id
-    )
-    existing_link = session.exec(statement).all()
 
-    if existing_link is not None:
-        session.delete(existing_link)
-        session.commit()
-    
-    session.add(chat)
+    # a set-based delete, so removing a user who was already removed concurrently is a no-op
+    session.exec(delete(UserChatLinkInDB).where(UserChatLinkInDB.user_id == user.id,
+                                                UserChatLinkInDB.chat_id == chat.id))
+    # a former member no longer sees the chat's messages, including those mentioning them
+    session.exec(delete(MentionInDB).where(MentionInDB.user_id == user.id, MentionInDB.chat_id == chat.id))
+    events.publish(session, "membership", chat.id)
     session.commit()
+    presence.invalidate_members(chat.id)
+    chat_reads.invalidate(chat.id)
     session.refresh(chat)
 
     return chat
     
-def delete_chat(chat_id: int, session: Session):
+@retry_on_busy
+def delete_chat(chat_id: int, current_user: UserInDB, session: Session) -> JobInDB:
     """
-    Delete a chat from the database.
+    Delete a chat from the database. The memberships and the inbox summary are removed, and the chat
+    is marked as pending deletion, in one short transaction, so the chat disappears for every user
+    at once. The same transaction queues a "purge_chat" job, which removes the messages in chunks
+    with 'purge_deleted_chat' and then removes the chat row itself; keeping the row until then stops
+    SQLite from reusing its id while messages still refer to it.
 
     :param chat_id: the id of the chat to be deleted
+    :param current_user - the user deleting the chat.
     :param session - a Session object for database retrieval. 
+    :raises EntityNotFoundException if the chat_id does not map to anything in the database.
+    :return - the queued purge job.
     """
     chat = get_chat_by_id(chat_id, session)
-    session.delete(chat)
+    session.exec(delete(UserChatLinkInDB).where(UserChatLinkInDB.chat_id == chat.id))
+    session.exec(delete(ChatSummaryInDB).where(ChatSummaryInDB.chat_id == chat.id))
+    session.add(ChatDeletionInDB(chat_id=chat.id))
+    job = jobs.enqueue(session, "purge_chat", {"chat_id": chat.id}, current_user.id)
+    events.publish(session, "chat", chat.id)
     session.commit()
+    session.refresh(job)
+    message_cache.invalidate(chat_id)
+    presence.invalidate_members(chat_id)
+    chat_reads.invalidate(chat_id)
+    archive.remove_chat(chat_id)
+    jobs.notify()
+    return job
+
+def purge_deleted_chat(chat_id: int, session: Session, chunk_size: int = DELETE_CHUNK_SIZE,
+                       on_chunk: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Removes the messages of a chat marked by 'delete_chat', at most 'chunk_size' per transaction,
+    then removes the chat row and its pending-deletion mark. Safe to re-run after an interruption.
+
+    :param chat_id - the id of the deleted chat.
+    :param session - a Session object for database retrieval.
+    :param chunk_size - the maximum number of messages deleted per transaction.
+    :param on_chunk - called with the number of messages removed so far after each committed chunk.
+    :return - the number of messages removed.
+    """
+    removed = 0
+    while True:
+        chunk = select(MessageInDB.id).where(MessageInDB.chat_id == chat_id).limit(chunk_size)
+        count = session.exec(delete(MessageInDB).where(MessageInDB.id.in_(chunk))).rowcount
+        session.commit()
+        removed += count
+        if on_chunk is not None:
+            on_chunk(removed)
+        if count < chunk_size:
+            break
+
+    upload_ids = session.exec(select(UploadInDB.id).where(UploadInDB.chat_id == chat_id)).all()
+    for upload_id in upload_ids:
+        blobs.remove_part(upload_id)
+    session.exec(delete(UploadInDB).where(UploadInDB.chat_id == chat_id))
+    session.exec(delete(AttachmentInDB).where(AttachmentInDB.chat_id == chat_id))
+    session.exec(delete(MessageFlagInDB).where(MessageFlagInDB.chat_id == chat_id))
+    session.exec(delete(MentionInDB).where(MentionInDB.chat_id == chat_id))
+    # naming every granularity lets the delete use the rollups' chat index
+    session.exec(delete(MessageRollupInDB).where(MessageRollupInDB.granularity.in_(ROLLUP_GRANULARITIES),
+                                                 MessageRollupInDB.chat_id == chat_id))
+    session.exec(delete(ChatDeletionInDB).where(ChatDeletionInDB.chat_id == chat_id))
+    session.exec(delete(ChatInDB).where(ChatInDB.id == chat_id))
+    session.commit()
+    return removed
+
+def rebuild_chat_summaries(session: Session, after_chat_id: int = 0,
+                           batch_size: int = 200) -> Iterator[tuple[int, int]]:
+    """
+    Recomputes the inbox summary of every chat from its messages, one committed batch of chats at a time.
+
+    :param session - a Session object for database retrieval.
+    :param after_chat_id - only chats with a higher id are rebuilt, to resume an interrupted rebuild.
+    :param batch_size - the number of chats rebuilt per transaction.
+    :return - yields the id of the last chat and the number of chats of each committed batch.
+    """
+    while True:
+        chat_ids = session.exec(
+            _live_chat_ids().where(ChatInDB.id > after_chat_id).order_by(ChatInDB.id).limit(batch_size)
+        ).all()
+        if not chat_ids:
+            return
+
+        for chat_id in chat_ids:
+            _set_chat_summary(chat_id, _get_last_message(chat_id, session), session)
+        session.commit()
+        after_chat_id = chat_ids[-1]
+        yield after_chat_id, len(chat_ids)
+
+def _live_chat_ids():
+    # chats pending deletion are skipped; their purge job removes them
+    return select(ChatInDB.id).where(ChatInDB.id.not_in(select(ChatDeletionInDB.chat_id)))
 
 # ------------------ methods for routes handling 'messages' ------------------- #
 def get_message_by_id(message_id: int, session: Session) -> MessageInDB:
@@ -289,20 +632,103 @@ def get_message_by_id(message_id: int, session: Session) -> MessageInDB:
     
     raise EntityNotFoundException(entity_name="Message", entity_id=message_id)
 
-def get_all_messages_from_chat(chat_id: int, session: Session) -> list[Message]:
+def get_all_messages_from_chat(chat_id: int, session: Session) -> list[dict]:
     """
-    Retrieve all messages for a given chat's 'chat_id'. 
+    Retrieve all messages for a given chat's 'chat_id' still in the database, oldest first.
 
     :param chat_id - the id of the chat to be retrieved.
     :param session - a Session object for database retrieval. 
-    :return - list of all messages from the specified 'chat_id'. 
+    :return - list of all messages from the specified 'chat_id', as dicts matching the Message model. 
     :raises EntityNotFoundException if the chat_id does not map to anything in the database. 
     """
-    chat = get_chat_by_id(chat_id, session)
-    return [Message(id=message_in_db.id, text=message_in_db.text, chat_id=chat_id, user=message_in_db.user, 
-                   created_at=message_in_db.created_at) for message_in_db in chat.messages]
+    get_chat_by_id(chat_id, session)
+    return _read_hot_messages(chat_id, session, None, None)
+
+def get_recent_messages(chat_id: int, session: Session, limit: Optional[int] = None,
+                        before: Optional[int] = None) -> tuple[list[dict], int]:
+    """
+    Retrieve the newest messages of a chat, served from the recent-message cache when possible.
+    On a miss, the newest messages are read from the database and installed in the cache. Reads that
+    page past the messages still in the database continue into the cold-tier archive.
+
+    :param chat_id - the id of the chat to be retrieved.
+    :param session - a Session object for database retrieval.
+    :param limit - the maximum number of newest messages to return, or None for every message.
+    :param before - only return messages with an id lower than this, or None for the newest messages.
+    :return - a tuple of the serialized messages in ascending order and the total number of messages in the chat.
+    :raises EntityNotFoundException if the chat_id does not map to anything in the database.
+    """
+    if before is None:
+        cached = message_cache.get(chat_id, limit)
+        if cached is not None:
+            return cached
+
+    generation = message_cache.generation(chat_id)
+    get_chat_by_id(chat_id, session)
+    total = get_message_count(chat_id, session)
+    if before is not None:
+        return _read_messages(chat_id, session, limit, before), total
 
-def send_message(new_message: str, user: UserInDB, chat_id: int, session: Session) -> MessageInDB:
+    newest = _read_hot_messages(chat_id, session, message_cache.per_chat, None)
+    message_cache.load(chat_id, newest, total, generation)
+
+    if limit is not None and limit <= len(newest):
+        return newest[-limit:], total
+    if total <= len(newest):
+        return newest, total
+
+    return _read_messages(chat_id, session, limit, None), total
+
+def get_message_count(chat_id: int, session: Session) -> int:
+    """
+    Counts the messages of a chat, including its archived messages, using the recent-message cache
+    when the chat is cached.
+
+    :param chat_id - the id of the chat.
+    :param session - a Session object for database retrieval.
+    :return - the number of messages in the chat.
+    """
+    total = message_cache.get_total(chat_id)
+    if total is not None:
+        return total
+
+    hot = session.exec(select(func.count(MessageInDB.id)).where(MessageInDB.chat_id == chat_id)).one()
+    return hot + archive.get_archived_count(chat_id)
+
+def _read_messages(chat_id: int, session: Session, limit: Optional[int], before: Optional[int]) -> list[dict]:
+    messages = _read_hot_messages(chat_id, session, limit, before)
+    if limit is None or len(messages) < limit:
+        oldest = messages[0]["id"] if messages else before
+        remaining = None if limit is None else limit - len(messages)
+        messages = _serialize_archived_messages(archive.read_messages(chat_id, oldest, remaining), session) + messages
+
+    return messages
+
+def _read_hot_messages(chat_id: int, session: Session, limit: Optional[int], before: Optional[int]) -> list[dict]:
+    statement = (
+        select(MessageInDB.id, MessageInDB.text, MessageInDB.chat_id, MessageInDB.user_id, MessageInDB.created_at)
+        .where(MessageInDB.chat_id == chat_id)
+        .order_by(MessageInDB.id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        statement = statement.where(MessageInDB.id < before)
+
+    return _message_dicts(list(reversed(session.exec(statement).all())), session)
+
+def _serialize_archived_messages(records: list[dict], session: Session) -> list[dict]:
+    return _message_dicts([(record["id"], record["text"], record["chat_id"], record["user_id"], record["created_at"])
+                           for record in records], session)
+
+def _message_dicts(rows: list[tuple], session: Session) -> list[dict]:
+    # every message of an author shares one user dict, also while the messages sit in the cache
+    users = _get_user_rows({row[3] for row in rows}, session)
+    return [{"id": message_id, "text": text, "chat_id": chat_id, "user": users.dict(user_id), "created_at": created_at}
+            for message_id, text, chat_id, user_id, created_at in rows]
+
+@retry_on_busy
+def send_message(new_message: str, user: UserInDB, chat_id: int, session: Session,
+                 attachment_ids: list[int] = ()) -> MessageInDB:
     """
     Sends a new message within the specified chat_id. 
 
@@ -310,39 +736,85 @@ def send_message(new_message: str, user: UserInDB, chat_id: int, session: Sessio
     :param message - the new message to send within the chat.
     :param user - the currently logged in user who is sending the new message.
     :param session - a Session object for database retrieval. 
+    :param attachment_ids - ids of completed uploads of the user in this chat to attach to the message.
+    :raises HTTPException (422) if an attachment is not an unattached upload of the user in this chat, or
+            if the message contains a banned term and the chat rejects such messages.
     :return - a Message object containing the description of the newly sent message.
     """
     chat = get_chat_by_id(chat_id, session)
+    verdict = _moderate(new_message, session, policy=chat.moderation_policy)
     new_message = MessageInDB(
-        text=new_message,
+        text=verdict.text,
         user=user,
         chat_id=chat.id,
         created_at=datetime.now()
     )
 
     session.add(new_message)
+    session.flush()
+    if attachment_ids:
+        attached = session.exec(
+            update(AttachmentInDB)
+            .where(AttachmentInDB.id.in_(set(attachment_ids)), AttachmentInDB.chat_id == chat.id,
+                   AttachmentInDB.user_id == user.id, AttachmentInDB.message_id.is_(None))
+            .values(message_id=new_message.id)
+        ).rowcount
+        if attached != len(set(attachment_ids)):
+            session.rollback()
+            raise HTTPException(status_code=422, detail={
+                "error": "invalid_attachment",
+                "error_description": "attachments must be your own unattached uploads to this chat"
+            })
+    if verdict.action == "flag":
+        _flag_message(new_message, verdict.terms, session)
+    _index_mentions(new_message.id, chat.id, user.id, new_message.text, session)
+    _set_chat_summary(chat.id, new_message, session)
+    _add_to_rollups(chat.id, user.id, new_message.created_at, 1, session)
+    events.publish(session, "chat_messages", chat.id)
     session.commit()
     session.refresh(new_message)
+    message_cache.append(chat.id, _serialize_message(new_message))
+    chat_reads.invalidate(chat.id)
     return new_message
 
-def update_message(message_id: int, new_message: str, session: Session) -> MessageInDB:
+@retry_on_busy
+def update_message(message_id: int, new_message: str, session: Session,
+                   expected_version: Optional[int] = None) -> MessageInDB:
     """
-    Updates an existing message in the database.
+    Updates an existing message in the database, unless it changed since it was read.
 
     :param message_id - id of the message to update.
     :param message_update - the attributes of the message to update.
     :param session - a Session object for database retrieval.
+    :param expected_version - the version the update applies to (from 'If-Match'), or None for the version read.
+    :raises HTTPException (409/412) if the message changed concurrently or is not at the expected version, or
+            (422) if the new text contains a banned term and the chat rejects such messages.
     :return - the update version of the message.
     """
     current_message = get_message_by_id(message_id, session)
-    current_message.text = new_message
-
-    session.add(current_message)
+    # the chat is only read when the text has a match
+    verdict = _moderate(new_message, session,
+                        resolve_policy=lambda: get_chat_by_id(current_message.chat_id, session).moderation_policy)
+    new_message = verdict.text
+    _compare_and_set(current_message, expected_version, session, text=new_message)
+    if verdict.action == "flag":
+        _flag_message(current_message, verdict.terms, session)
+    session.exec(delete(MentionInDB).where(MentionInDB.chat_id == current_message.chat_id,
+                                           MentionInDB.message_id == current_message.id))
+    _index_mentions(current_message.id, current_message.chat_id, current_message.user_id, new_message, session)
+    summary = session.get(ChatSummaryInDB, current_message.chat_id)
+    if summary is not None and summary.last_message_id == current_message.id:
+        summary.preview = new_message[:PREVIEW_LENGTH]
+        session.add(summary)
+    events.publish(session, "chat_messages", current_message.chat_id)
     session.commit()
     session.refresh(current_message)
+    message_cache.replace(current_message.chat_id, _serialize_message(current_message))
+    chat_reads.invalidate(current_message.chat_id)
 
     return current_message
 
+@retry_on_busy
 def delete_message(message_id: int, session: Session):
     """
     Deletes the specified message from the database if it exists and other criteria is met.
@@ -351,8 +823,495 @@ def delete_message(message_id: int, session: Session):
     :param session - a Session object for database retrieval.
     """
     current_message = get_message_by_id(message_id, session)
+    chat_id = current_message.chat_id
+    _add_to_rollups(chat_id, current_message.user_id, current_message.created_at, -1, session)
+    # the blobs themselves are left to the "collect_blobs" job
+    session.exec(delete(AttachmentInDB).where(AttachmentInDB.message_id == message_id))
+    session.exec(delete(MessageFlagInDB).where(MessageFlagInDB.message_id == message_id))
+    session.exec(delete(MentionInDB).where(MentionInDB.chat_id == chat_id, MentionInDB.message_id == message_id))
     session.delete(current_message)
+    session.flush()
+
+    summary = session.get(ChatSummaryInDB, chat_id)
+    if summary is not None and summary.last_message_id == message_id:
+        _set_chat_summary(chat_id, _get_last_message(chat_id, session), session)
+    events.publish(session, "chat_messages", chat_id)
+    session.commit()
+    message_cache.remove(chat_id, message_id)
+    chat_reads.invalidate(chat_id)
+
+def get_mentions(user_id: int, session: Session, limit: int,
+                 cursor: Optional[str] = None) -> tuple[list[dict], Optional[str]]:
+    """
+    Retrieve a page of the messages mentioning a user, newest first, from the mentions index.
+    Messages moved to the archive are no longer listed.
+
+    :param user_id - id of the mentioned user.
+    :param session - a Session object for database retrieval.
+    :param limit - the maximum number of messages to return.
+    :param cursor - the 'next_cursor' of the previous page, or None for the first page.
+    :return - the messages of the page, and the cursor of the next page (None on the last page).
+    """
+    statement = (
+        select(MessageInDB.id, MessageInDB.text, MessageInDB.chat_id, MessageInDB.user_id, MessageInDB.created_at)
+        .select_from(MentionInDB)
+        .join(MessageInDB, MessageInDB.id == MentionInDB.message_id)
+        .outerjoin(ChatDeletionInDB, ChatDeletionInDB.chat_id == MentionInDB.chat_id)
+        .where(MentionInDB.user_id == user_id, ChatDeletionInDB.chat_id.is_(None))
+        .order_by(MentionInDB.message_id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        statement = statement.where(MentionInDB.message_id < _decode_id_cursor(cursor))
+
+    messages = _message_dicts(session.exec(statement).all(), session)
+    if len(messages) > limit:
+        messages = messages[:limit]
+        return messages, str(messages[-1]["id"])
+    return messages, None
+
+def _index_mentions(message_id: int, chat_id: int, author_id: int, text: str, session: Session):
+    """
+    Adds the members of a chat mentioned in a message to the mentions index. The caller commits.
+
+    :param message_id - id of the message, already flushed.
+    :param chat_id - id of the message's chat.
+    :param author_id - id of the message's author, who is never notified of their own mentions.
+    :param text - the text of the message.
+    :param session - a Session object for database retrieval.
+    """
+    usernames = extract_usernames(text) if "@" in text else []
+    if not usernames:
+        return
+    mentioned = set(username_directory.resolve(usernames, session).values()) - {author_id}
+    if not mentioned:
+        return
+    # only members can read the message
+    members = session.exec(select(UserChatLinkInDB.user_id).where(UserChatLinkInDB.chat_id == chat_id,
+                                                                  UserChatLinkInDB.user_id.in_(mentioned))).all()
+    if members:
+        session.exec(sqlite_insert(MentionInDB).values(
+            [{"user_id": user_id, "message_id": message_id, "chat_id": chat_id} for user_id in members]
+        ).on_conflict_do_nothing())
+
+def _get_last_message(chat_id: int, session: Session) -> Optional[MessageInDB]:
+    statement = select(MessageInDB).where(MessageInDB.chat_id == chat_id).order_by(MessageInDB.id.desc()).limit(1)
+    return session.exec(statement).first()
+
+def _set_chat_summary(chat_id: int, message: Optional[MessageInDB], session: Session):
+    """
+    Points a chat's inbox summary at the given message, or back at the chat's creation when the
+    chat has no messages left. The caller is responsible for committing.
+
+    :param chat_id - id of the chat whose summary is updated.
+    :param message - the chat's last message, or None.
+    :param session - a Session object for database retrieval.
+    """
+    summary = session.get(ChatSummaryInDB, chat_id)
+    if summary is None:
+        summary = ChatSummaryInDB(chat_id=chat_id, last_activity_at=datetime.now())
+
+    if message is None:
+        summary.last_message_id = None
+        summary.last_user_id = None
+        summary.preview = None
+        summary.last_activity_at = get_chat_by_id(chat_id, session).created_at
+    else:
+        summary.last_message_id = message.id
+        summary.last_user_id = message.user_id
+        summary.preview = message.text[:PREVIEW_LENGTH]
+        summary.last_activity_at = message.created_at
+    session.add(summary)
+    _set_member_activity(chat_id, summary.last_activity_at, session)
+
+def _set_member_activity(chat_id: int, last_activity_at: datetime, session: Session):
+    """Copies a chat's last activity onto its members' links, which order their inboxes. The caller commits."""
+    session.exec(
+        update(UserChatLinkInDB).where(UserChatLinkInDB.chat_id == chat_id).values(last_activity_at=last_activity_at)
+    )
+
+def _serialize_message(message: MessageInDB) -> dict:
+    """
+    Converts a message into the plain representation held by the recent-message cache.
+
+    :param message - the message to serialize, with its author loaded.
+    :return - the message as a dict matching the Message model.
+    """
+    return Message(id=message.id, text=message.text, chat_id=message.chat_id, user=message.user,
+                   created_at=message.created_at).model_dump()
+
+def _compare_and_set(entity, expected_version: Optional[int], session: Session, **values):
+    """
+    Updates a versioned entity in a single statement that only matches the row if its version is
+    still the expected one, and increments the version. The caller commits.
+
+    :param entity - the chat, message or user to update, as read in this transaction.
+    :param expected_version - the version the client sent in 'If-Match', or None for the version read.
+    :param session - a Session object for database retrieval.
+    :param values - the new values of the updated columns.
+    :raises HTTPException (412) if the entity is not at the version from 'If-Match', or (409) if it
+            changed since it was read.
+    """
+    model = type(entity)
+    version = entity.version if expected_version is None else expected_version
+    updated = session.exec(
+        update(model)
+        .where(model.id == entity.id, model.version == version)
+        .values(**values, version=model.version + 1)
+    ).rowcount
+    if updated:
+        return
+
+    session.rollback()
+    contention.record_conflict(model.__tablename__)
+    current = session.get(model, entity.id)
+    if expected_version is not None:
+        raise HTTPException(status_code=412, detail={
+            "error": "precondition_failed",
+            "error_description": f"the {model.__tablename__[:-1]} is no longer at version {expected_version}",
+            "version": current.version if current else None,
+        })
+    raise HTTPException(status_code=409, detail={
+        "error": "version_conflict",
+        "error_description": f"the {model.__tablename__[:-1]} was changed by another request",
+        "version": current.version if current else None,
+    })
+
+# ------------------ methods for routes handling 'attachments' ------------------- #
+def create_upload(chat_id: int, upload_create: UploadCreate, user: UserInDB, session: Session) -> UploadInDB:
+    """
+    Starts a resumable attachment upload in a chat.
+
+    :param chat_id - id of the chat the attachment belongs to.
+    :param upload_create - the name, content type and size of the file.
+    :param user - the currently logged in user who uploads the file.
+    :param session - a Session object for database retrieval.
+    :raises HTTPException (413) if the file is larger than the configured maximum.
+    :return - the new upload.
+    """
+    if upload_create.size > blobs.max_attachment_size:
+        raise HTTPException(status_code=413, detail={
+            "error": "attachment_too_large",
+            "error_description": f"attachments are limited to {blobs.max_attachment_size} bytes"
+        })
+
+    upload = _insert_upload(chat_id, upload_create, user, session)
+    # created once the upload is committed, so a retried insert leaves no part file behind
+    blobs.create_part(upload.id)
+    return upload
+
+@retry_on_busy
+def _insert_upload(chat_id: int, upload_create: UploadCreate, user: UserInDB, session: Session) -> UploadInDB:
+    chat = get_chat_by_id(chat_id, session)
+    upload = UploadInDB(id=uuid.uuid4().hex, chat_id=chat.id, user_id=user.id, filename=upload_create.filename,
+                        content_type=upload_create.content_type, size=upload_create.size)
+    session.add(upload)
     session.commit()
+    session.refresh(upload)
+    return upload
+
+def get_upload(chat_id: int, upload_id: str, user: UserInDB, session: Session) -> UploadInDB:
+    """
+    Retrieve an upload of the current user in a chat.
+
+    :param chat_id - id of the chat of the upload.
+    :param upload_id - id of the upload.
+    :param user - the currently logged in user.
+    :param session - a Session object for database retrieval.
+    :raises EntityNotFoundException if the upload does not exist, or belongs to another chat or user.
+    :return - the upload.
+    """
+    upload = session.get(UploadInDB, upload_id)
+    if upload and upload.chat_id == chat_id and upload.user_id == user.id:
+        return upload
+
+    raise EntityNotFoundException(entity_name="Upload", entity_id=upload_id)
+
+def complete_upload(upload: UploadInDB, session: Session) -> AttachmentInDB:
+    """
+    Moves a fully received upload into the blob store and records it as an attachment that is not
+    linked to a message yet.
+
+    :param upload - the upload whose every byte was received.
+    :param session - a Session object for database retrieval.
+    :return - the new attachment.
+    """
+    sha256 = blobs.commit_part(upload.id)
+    attachment = AttachmentInDB(chat_id=upload.chat_id, user_id=upload.user_id, upload_id=upload.id, sha256=sha256,
+                                filename=upload.filename, content_type=upload.content_type, size=upload.size)
+    session.add(attachment)
+    session.exec(delete(UploadInDB).where(UploadInDB.id == upload.id))
+    session.commit()
+    session.refresh(attachment)
+    return attachment
+
+def get_upload_attachment(upload_id: str, session: Session) -> Optional[AttachmentInDB]:
+    """
+    Retrieve the attachment a completed upload became.
+
+    :param upload_id - id of the upload.
+    :param session - a Session object for database retrieval.
+    :return - the attachment, or None if the upload was never completed.
+    """
+    return session.exec(select(AttachmentInDB).where(AttachmentInDB.upload_id == upload_id)).first()
+
+def get_attachment(chat_id: int, attachment_id: int, session: Session) -> AttachmentInDB:
+    """
+    Retrieve an attachment of a chat.
+
+    :param chat_id - id of the chat of the attachment.
+    :param attachment_id - id of the attachment.
+    :param session - a Session object for database retrieval.
+    :raises EntityNotFoundException if the attachment does not exist in the chat.
+    :return - the attachment.
+    """
+    attachment = session.get(AttachmentInDB, attachment_id)
+    if attachment and attachment.chat_id == chat_id:
+        return attachment
+
+    raise EntityNotFoundException(entity_name="Attachment", entity_id=attachment_id)
+
+def get_message_attachments(message_id: int, session: Session) -> list[AttachmentInDB]:
+    """
+    Retrieve the attachments of a message.
+
+    :param message_id - id of the message.
+    :param session - a Session object for database retrieval.
+    :return - the attachments, ordered by id.
+    """
+    return session.exec(
+        select(AttachmentInDB).where(AttachmentInDB.message_id == message_id).order_by(AttachmentInDB.id)
+    ).all()
+
+def collect_blobs(session: Session) -> Iterator[int]:
+    """
+    Deletes stored blobs that no attachment refers to and that are older than the grace period.
+
+    :param session - a Session object for database retrieval.
+    :return - yields the running count of blobs examined, every 500 blobs.
+    """
+    examined = 0
+    batch = []
+    for sha256 in blobs.iter_objects():
+        batch.append(sha256)
+        if len(batch) == 500:
+            examined += _collect_batch(batch, session)
+            batch = []
+            yield examined
+    if batch:
+        examined += _collect_batch(batch, session)
+        yield examined
+
+def expire_uploads(session: Session) -> Iterator[int]:
+    """
+    Deletes uploads that were started more than 'UPLOAD_EXPIRY_HOURS' ago, never finished and
+    received no bytes for as long, together with their part files.
+
+    :param session - a Session object for database retrieval.
+    :return - yields the running count of uploads deleted, after every batch of 500 uploads.
+    """
+    idle_seconds = blobs.upload_expiry_hours * 3600
+    cutoff = datetime.now() - timedelta(seconds=idle_seconds)
+    deleted, after_id = 0, ""
+    while upload_ids := session.exec(
+        select(UploadInDB.id).where(UploadInDB.created_at < cutoff, UploadInDB.id > after_id)
+        .order_by(UploadInDB.id).limit(500)
+    ).all():
+        after_id = upload_ids[-1]
+        # parts still being appended to are kept until a later run
+        expired = [upload_id for upload_id in upload_ids if blobs.remove_idle_part(upload_id, idle_seconds)]
+        if expired:
+            session.exec(delete(UploadInDB).where(UploadInDB.id.in_(expired)))
+            session.commit()
+            deleted += len(expired)
+        yield deleted
+
+def _collect_batch(hashes: list[str], session: Session) -> int:
+    referenced = set(session.exec(
+        select(AttachmentInDB.sha256).where(AttachmentInDB.sha256.in_(hashes)).distinct()
+    ).all())
+    for sha256 in hashes:
+        if sha256 not in referenced:
+            blobs.remove_object(sha256)
+    return len(hashes)
+
+# ------------------ methods for routes handling 'analytics' ------------------- #
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    """
+    :param moment - a point in time.
+    :param granularity - "hour" or "day".
+    :return - the start of the hour or day containing the moment.
+    """
+    if granularity == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def _add_to_rollups(chat_id: int, user_id: int, created_at: datetime, delta: int, session: Session):
+    # one upsert per granularity, in the transaction of the message it counts
+    for granularity in ROLLUP_GRANULARITIES:
+        statement = sqlite_insert(MessageRollupInDB).values(
+            granularity=granularity, bucket_start=bucket_start(created_at, granularity),
+            chat_id=chat_id, user_id=user_id, count=delta,
+        )
+        session.exec(statement.on_conflict_do_update(
+            index_elements=["granularity", "bucket_start", "chat_id", "user_id"],
+            set_={"count": MessageRollupInDB.count + delta},
+        ))
+
+def get_message_volume(session: Session, granularity: str, start: datetime, end: datetime,
+                       chat_id: Optional[int] = None, user_id: Optional[int] = None) -> list[tuple[datetime, int]]:
+    """
+    Counts messages per hour or day from the rollups, without reading the messages table.
+
+    :param session - a Session object for database retrieval.
+    :param granularity - "hour" or "day".
+    :param start - the start of the range; the bucket containing it is included.
+    :param end - the end of the range, exclusive.
+    :param chat_id - only count messages of this chat, if given.
+    :param user_id - only count messages of this user, if given.
+    :return - the start and message count of every bucket with messages, in order.
+    """
+    statement = (
+        select(MessageRollupInDB.bucket_start, func.sum(MessageRollupInDB.count))
+        .where(*_rollup_range(granularity, start, end))
+        .group_by(MessageRollupInDB.bucket_start)
+        .having(func.sum(MessageRollupInDB.count) > 0)
+        .order_by(MessageRollupInDB.bucket_start)
+    )
+    if chat_id is not None:
+        statement = statement.where(MessageRollupInDB.chat_id == chat_id)
+    if user_id is not None:
+        statement = statement.where(MessageRollupInDB.user_id == user_id)
+    return session.exec(statement).all()
+
+def get_active_users(session: Session, granularity: str, start: datetime, end: datetime) -> list[tuple[datetime, int]]:
+    """
+    Counts the users who sent at least one message, per hour or day, from the rollups.
+
+    :param session - a Session object for database retrieval.
+    :param granularity - "hour" or "day".
+    :param start - the start of the range; the bucket containing it is included.
+    :param end - the end of the range, exclusive.
+    :return - the start and number of active users of every bucket with any, in order.
+    """
+    return session.exec(
+        select(MessageRollupInDB.bucket_start, func.count(MessageRollupInDB.user_id.distinct()))
+        .where(*_rollup_range(granularity, start, end), MessageRollupInDB.count > 0)
+        .group_by(MessageRollupInDB.bucket_start)
+        .order_by(MessageRollupInDB.bucket_start)
+    ).all()
+
+def count_active_users(session: Session, granularity: str, start: datetime, end: datetime) -> int:
+    """
+    Counts the distinct users who sent at least one message within a range, from the rollups.
+
+    :param session - a Session object for database retrieval.
+    :param granularity - "hour" or "day", the rollups to count from.
+    :param start - the start of the range; the bucket containing it is included.
+    :param end - the end of the range, exclusive.
+    :return - the number of active users.
+    """
+    return session.exec(
+        select(func.count(MessageRollupInDB.user_id.distinct()))
+        .where(*_rollup_range(granularity, start, end), MessageRollupInDB.count > 0)
+    ).one()
+
+def get_message_ranking(session: Session, by: str, start: datetime, end: datetime, limit: int) -> list[tuple[int, int]]:
+    """
+    Ranks chats or users by the number of messages sent within a range, from the rollups. Daily
+    rollups are used when the range covers whole days, and hourly rollups otherwise.
+
+    :param session - a Session object for database retrieval.
+    :param by - "chat" or "user".
+    :param start - the start of the range; the hour containing it is included.
+    :param end - the end of the range, exclusive.
+    :param limit - the maximum number of chats or users returned.
+    :return - the id and message count of the top chats or users, most messages first.
+    """
+    granularity = "day" if bucket_start(start, "day") == start and bucket_start(end, "day") == end else "hour"
+    column = MessageRollupInDB.chat_id if by == "chat" else MessageRollupInDB.user_id
+    total = func.sum(MessageRollupInDB.count)
+    return session.exec(
+        select(column, total)
+        .where(*_rollup_range(granularity, start, end))
+        .group_by(column)
+        .having(total > 0)
+        .order_by(total.desc(), column)
+        .limit(limit)
+    ).all()
+
+def _rollup_range(granularity: str, start: datetime, end: datetime) -> tuple:
+    return (
+        MessageRollupInDB.granularity == granularity,
+        MessageRollupInDB.bucket_start >= bucket_start(start, granularity),
+        MessageRollupInDB.bucket_start < end,
+    )
+
+# ------------------ methods for routes handling 'moderation' ------------------- #
+@retry_on_busy
+def update_moderation_policy(chat_id: int, policy: str, session: Session) -> ChatInDB:
+    """
+    Changes what happens to new and edited messages of a chat that contain a banned term.
+
+    :param chat_id - id of the chat.
+    :param policy - "reject", "mask" or "flag".
+    :param session - a Session object for database retrieval.
+    :return - the updated chat.
+    """
+    chat = get_chat_by_id(chat_id, session)
+    chat.moderation_policy = policy
+    session.add(chat)
+    session.commit()
+    session.refresh(chat)
+    return chat
+
+@retry_on_busy
+def replace_moderation_terms(terms: list[str], session: Session) -> int:
+    """
+    Replaces the banned terms of the moderation filter, and has every worker reload them.
+
+    :param terms - the new terms; blank lines and duplicates are dropped.
+    :param session - a Session object for database retrieval.
+    :return - the number of terms stored.
+    """
+    kept = sorted({term.strip().lower() for term in terms if term.strip()})
+    session.exec(delete(ModerationTermInDB))
+    for start in range(0, len(kept), MODERATION_TERMS_BATCH_SIZE):
+        session.exec(sqlite_insert(ModerationTermInDB).values(
+            [{"term": term} for term in kept[start:start + MODERATION_TERMS_BATCH_SIZE]]
+        ))
+    events.publish(session, "moderation_terms", 0)
+    session.commit()
+    # this worker skips its own event, so it reloads here
+    moderation_filter.replace(kept)
+    return len(kept)
+
+def get_message_flags(session: Session, chat_id: Optional[int] = None, limit: int = 100) -> list[MessageFlagInDB]:
+    """
+    :param session - a Session object for database retrieval.
+    :param chat_id - only return flags of this chat, if given.
+    :param limit - the maximum number of flags returned.
+    :return - the most recent flagged messages, newest first.
+    """
+    statement = select(MessageFlagInDB).order_by(MessageFlagInDB.id.desc()).limit(limit)
+    if chat_id is not None:
+        statement = statement.where(MessageFlagInDB.chat_id == chat_id)
+    return session.exec(statement).all()
+
+def _moderate(text: str, session: Session, policy: Optional[str] = None, resolve_policy=None):
+    verdict = moderation_filter.moderate(text, policy, resolve_policy)
+    if verdict.action == "reject":
+        session.rollback()
+        raise HTTPException(status_code=422, detail={
+            "error": "message_rejected",
+            "error_description": "the message contains banned terms"
+        })
+    return verdict
+
+def _flag_message(message: MessageInDB, terms: list[str], session: Session):
+    session.flush()
+    session.add(MessageFlagInDB(message_id=message.id, chat_id=message.chat_id, user_id=message.user_id,
+                                terms=",".join(terms)))
 
 # --------------- methods for routes handling 'members' / access rights ------------------- #
 def is_member_of_chat(chat_id: int, current_user: UserInDB, session: Session) -> bool:
@@ -454,4 +1413,102 @@ def check_remove_owner(chat_id: int, user_id: int, session: Session) -> bool:
     raise HTTPException(status_code=422, detail={
             "error": "invalid_state",
             "error_description": "owner of a chat cannot be removed"
-        })
\ No newline at end of file
+        })
+
+# ---------- startup warmup ----------- #
+def warm_statements(session: Session) -> int:
+    """
+    Runs the statements of the hot read paths once, for ids that no row has, so SQLAlchemy compiles
+    and caches them at startup instead of during the first requests. Statements are cached by their
+    shape, so a read runs once for every shape its route produces (e.g. with and without a limit).
+    Nothing is written, and the recent-message cache is bypassed.
+
+    :param session - a Session object for database retrieval.
+    :return - the number of reads run.
+    """
+    missing = 0
+    nobody = UserInDB(id=missing, username="", email="", hashed_password="")
+    reads = [
+        lambda: session.get(UserInDB, missing),
+        lambda: session.get(ChatInDB, missing),
+        lambda: session.get(ChatDeletionInDB, missing),
+        lambda: session.get(UserChatLinkInDB, (missing, missing)),
+        lambda: session.get(MessageInDB, missing),
+        lambda: get_all_users(session),
+        lambda: get_all_users(session, limit=1, cursor=str(missing)),
+        lambda: count_users(session),
+        lambda: get_users_by_ids([missing], session),
+        lambda: search_users("warmup", session, 1),
+        lambda: get_existing_user(session, "", ""),
+        lambda: get_member_ids(missing, session),
+        lambda: _read_chat_users(missing, session),
+        lambda: _get_user_rows({missing}, session),
+        lambda: get_all_chats(nobody, session),
+        lambda: get_all_chats(nobody, session, "recent", limit=1),
+        lambda: count_chats_of_user(nobody, session),
+        lambda: get_message_count(missing, session),
+        lambda: _read_hot_messages(missing, session, message_cache.per_chat, None),
+        lambda: _read_hot_messages(missing, session, None, None),
+        lambda: _read_hot_messages(missing, session, 1, missing),
+        lambda: get_message_attachments(missing, session),
+        lambda: get_mentions(missing, session, 1),
+        lambda: get_mentions(missing, session, 1, str(missing)),
+    ]
+    for read in reads:
+        read()
+    session.rollback()
+    return len(reads)
+
+# ---------- background jobs ----------- #
+def _run_purge_chat_job(context: jobs.JobContext):
+    chat_id = context.params["chat_id"]
+    total = context.session.exec(
+        select(func.count()).select_from(MessageInDB).where(MessageInDB.chat_id == chat_id)
+    ).one()
+    context.progress(0, total)
+    purge_deleted_chat(chat_id, context.session, on_chunk=context.progress)
+
+def _run_rebuild_chat_summaries_job(context: jobs.JobContext):
+    session = context.session
+    after_chat_id = context.checkpoint["after_chat_id"] if context.checkpoint else 0
+    total = session.exec(select(func.count()).select_from(_live_chat_ids().subquery())).one()
+    done = context.completed if context.checkpoint else 0
+    context.progress(done, total)
+    for last_chat_id, count in rebuild_chat_summaries(session, after_chat_id):
+        done += count
+        context.progress(done, checkpoint={"after_chat_id": last_chat_id})
+
+def _run_collect_blobs_job(context: jobs.JobContext):
+    for examined in collect_blobs(context.session):
+        context.progress(examined)
+
+def _run_expire_uploads_job(context: jobs.JobContext):
+    for deleted in expire_uploads(context.session):
+        context.progress(deleted)
+
+def _run_backup_job(context: jobs.JobContext):
+    # progress is only reported once the copy is done, since writing it would restart the copy of a
+    # database that is not in WAL mode yet
+    result = backups.backup(_database_path(context.session))
+    context.progress(result["bytes"], result["bytes"])
+
+def _run_maintenance_job(context: jobs.JobContext):
+    backups.maintain(_database_path(context.session))
+
+def _database_path(session: Session) -> str:
+    path = session.get_bind().url.database
+    if not path or path == ":memory:":
+        raise ValueError("only a database file can be backed up or maintained")
+    return path
+
+# purging a deleted chat cannot be cancelled halfway, as its messages would be left behind
+jobs.register("purge_chat", _run_purge_chat_job, cancellable=False)
+jobs.register("rebuild_chat_summaries", _run_rebuild_chat_summaries_job)
+jobs.register("collect_blobs", _run_collect_blobs_job)
+jobs.register("expire_uploads", _run_expire_uploads_job)
+jobs.register("backup_database", _run_backup_job, cancellable=False)
+jobs.register("database_maintenance", _run_maintenance_job, cancellable=False)
+jobs.schedule("backup_database", backups.backup_interval_hours * 3600)
+jobs.schedule("database_maintenance", backups.maintenance_interval_hours * 3600)
+# an upload expires at most an hour after its expiry time
+jobs.schedule("expire_uploads", 3600 if blobs.upload_expiry_hours > 0 else 0)
@@ -2,8 +2,9 @@
 # Author: Riley Kraabel
 
 from datetime import date, datetime
-from typing import Optional
-from pydantic import BaseModel, Field
+from typing import Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from sqlalchemy import Index, text
 from sqlmodel import Field, Relationship, SQLModel
 
 # Represents Metadata for any collection other than Chats. 
@@ -20,21 +21,34 @@ class UserChatLinkInDB(SQLModel, table=True):
     """Database model for many-to-many relation of users to chats."""
 
     __tablename__ = "user_chat_links"
+    __table_args__ = (
+        Index("ix_user_chat_links_chat_id", "chat_id"),
+        # each member's inbox, most recently active chats first
+        Index("ix_user_chat_links_user_id_last_activity_at_chat_id", "user_id", "last_activity_at", "chat_id"),
+    )
 
     user_id: int = Field(foreign_key="users.id", primary_key=True)
     chat_id: int = Field(foreign_key="chats.id", primary_key=True)
+    # a copy of the chat summary's last_activity_at, kept in step by '_set_chat_summary'
+    last_activity_at: Optional[datetime] = Field(default=None)
 
 # Represents the Database model for a User item. 
 class UserInDB(SQLModel, table=True):
     """Database model for user."""
 
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_username_lower", text("lower(username)")),
+        Index("ix_users_email_lower", text("lower(email)")),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(unique=True, index=True)
     email: str = Field(unique=True)
     hashed_password: str
     created_at: Optional[datetime] = Field(default_factory=datetime.now)
+    # incremented by every update, which compares it to detect concurrent edits
+    version: int = Field(default=1, sa_column_kwargs={"server_default": text("1")})
 
     chats: list["ChatInDB"] = Relationship(
         back_populates="users",
@@ -46,11 +60,18 @@ class ChatInDB(SQLModel, table=True):
     """Database model for chat."""
 
     __tablename__ = "chats"
+    __table_args__ = (
+        Index("ix_chats_owner_id", "owner_id"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     owner_id: int = Field(foreign_key="users.id")
     created_at: Optional[datetime] = Field(default_factory=datetime.now)
+    # incremented by every update, which compares it to detect concurrent edits
+    version: int = Field(default=1, sa_column_kwargs={"server_default": text("1")})
+    # what happens to messages containing a banned term: "reject", "mask" or "flag"
+    moderation_policy: str = Field(default="reject", sa_column_kwargs={"server_default": text("'reject'")})
 
     owner: UserInDB = Relationship()
     users: list[UserInDB] = Relationship(
@@ -64,16 +85,167 @@ class MessageInDB(SQLModel, table=True):
     """Database model for message."""
 
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     text: str
     user_id: int = Field(foreign_key="users.id")
     chat_id: int = Field(foreign_key="chats.id")
     created_at: Optional[datetime] = Field(default_factory=datetime.now)
+    # incremented by every update, which compares it to detect concurrent edits
+    version: int = Field(default=1, sa_column_kwargs={"server_default": text("1")})
 
     user: UserInDB = Relationship()
     chat: ChatInDB = Relationship(back_populates="messages")
 
+# Represents the Database model for the denormalized inbox summary of a Chat item.
+class ChatSummaryInDB(SQLModel, table=True):
+    """Database model for the last activity of a chat, maintained by the message mutators."""
+
+    __tablename__ = "chat_summaries"
+    __table_args__ = (
+        Index("ix_chat_summaries_last_activity_at_chat_id", "last_activity_at", "chat_id"),
+    )
+
+    chat_id: int = Field(foreign_key="chats.id", primary_key=True)
+    last_message_id: Optional[int] = Field(default=None)
+    last_user_id: Optional[int] = Field(default=None, foreign_key="users.id")
+    preview: Optional[str] = Field(default=None)
+    last_activity_at: datetime
+
+# Represents the Database model for a deleted Chat whose messages are still being purged.
+class ChatDeletionInDB(SQLModel, table=True):
+    """Database model for a pending chat deletion. The chat row is removed once its messages are gone."""
+
+    __tablename__ = "chat_deletions"
+
+    chat_id: int = Field(foreign_key="chats.id", primary_key=True)
+    requested_at: datetime = Field(default_factory=datetime.now)
+
+# Represents the Database model for the number of messages a user sent to a chat within an hour or a day.
+class MessageRollupInDB(SQLModel, table=True):
+    """Database model for a time-bucketed message count, maintained by the message mutators."""
+
+    __tablename__ = "message_rollups"
+    __table_args__ = (
+        Index("ix_message_rollups_chat", "granularity", "chat_id", "bucket_start"),
+        Index("ix_message_rollups_user", "granularity", "user_id", "bucket_start"),
+    )
+
+    granularity: str = Field(primary_key=True)
+    bucket_start: datetime = Field(primary_key=True)
+    chat_id: int = Field(primary_key=True)
+    user_id: int = Field(primary_key=True)
+    count: int = Field(default=0)
+
+# Represents the Database model for an entity-change event on the cross-worker invalidation bus.
+class CacheEventInDB(SQLModel, table=True):
+    """Database model for a cache invalidation event. The autoincrement id is the bus generation."""
+
+    __tablename__ = "cache_events"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    entity: str
+    entity_id: int
+    origin: str
+    created_at: datetime = Field(default_factory=datetime.now, index=True)
+
+# Represents the Database model for a user mentioned in a message.
+class MentionInDB(SQLModel, table=True):
+    """Database model for an '@username' mention; the primary key serves each user's mentions inbox, newest first."""
+
+    __tablename__ = "mentions"
+    __table_args__ = (
+        Index("ix_mentions_chat_id_message_id", "chat_id", "message_id"),
+    )
+
+    user_id: int = Field(foreign_key="users.id", primary_key=True)
+    message_id: int = Field(primary_key=True)
+    chat_id: int
+
+# Represents the Database model for a banned term of the moderation filter.
+class ModerationTermInDB(SQLModel, table=True):
+    """Database model for a banned term, optionally with a leading or trailing '*' wildcard."""
+
+    __tablename__ = "moderation_terms"
+
+    term: str = Field(primary_key=True)
+
+# Represents the Database model for a message flagged by the moderation filter.
+class MessageFlagInDB(SQLModel, table=True):
+    """Database model for a message of a chat with the "flag" policy that contained banned terms."""
+
+    __tablename__ = "message_flags"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    message_id: int = Field(index=True)
+    chat_id: int = Field(index=True)
+    user_id: int
+    # the matched terms, comma-separated
+    terms: str
+    created_at: datetime = Field(default_factory=datetime.now)
+
+# Represents the Database model for an attachment upload in progress.
+class UploadInDB(SQLModel, table=True):
+    """Database model for a resumable upload. The bytes received so far live in the blob store's part file."""
+
+    __tablename__ = "uploads"
+
+    id: str = Field(primary_key=True)
+    chat_id: int = Field(foreign_key="chats.id", index=True)
+    user_id: int = Field(foreign_key="users.id")
+    filename: str
+    content_type: str
+    size: int
+    created_at: datetime = Field(default_factory=datetime.now)
+
+# Represents the Database model for a file attached to a message.
+class AttachmentInDB(SQLModel, table=True):
+    """Database model for attachment metadata. The content is the blob store object named by sha256."""
+
+    __tablename__ = "attachments"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    chat_id: int = Field(foreign_key="chats.id", index=True)
+    message_id: Optional[int] = Field(default=None, foreign_key="messages.id", index=True)
+    user_id: int = Field(foreign_key="users.id")
+    # the upload the attachment was completed from
+    upload_id: Optional[str] = Field(default=None, index=True)
+    sha256: str = Field(index=True)
+    filename: str
+    content_type: str
+    size: int
+    created_at: datetime = Field(default_factory=datetime.now)
+
+# Represents the Database model for a background job.
+class JobInDB(SQLModel, table=True):
+    """Database model for a background job, its progress and its resume checkpoint."""
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_id", "status", "id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str
+    status: str = Field(default="queued")
+    params: str = Field(default="{}")
+    checkpoint: Optional[str] = Field(default=None)
+    completed: int = Field(default=0)
+    total: Optional[int] = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    cancel_requested: bool = Field(default=False)
+    created_by: Optional[int] = Field(default=None, foreign_key="users.id")
+    worker_id: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: Optional[datetime] = Field(default=None)
+    heartbeat_at: Optional[datetime] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
+
 # Represents a data model object for a user. 
 class User(SQLModel):
     id: int
@@ -96,6 +268,19 @@ class Message(SQLModel):
     user: User
     created_at: datetime
 
+# Represents a preview of the last message of a chat, as shown in the inbox.
+class ChatPreview(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    message_id: int
+    user: User
+    text: str
+
+# Represents a chat along with its last activity, as shown in the inbox.
+class InboxChat(Chat):
+    last_activity_at: Optional[datetime] = Field(default=None)
+    last_message: Optional[ChatPreview] = Field(default=None)
+
 # Represents an API response for a user. 
 class UserResponse(BaseModel):
     user: User
@@ -103,6 +288,7 @@ class UserResponse(BaseModel):
 # Represents the API response for creating a new message. 
 class CreateMessage(BaseModel):
     text: str
+    attachment_ids: list[int] = []
     
 # Represents an API response for a chat.
 class ChatResponse(BaseModel):
@@ -118,6 +304,7 @@ class GetChatResponse(BaseModel):
 # Represents an API response for a message. 
 class MessageResponse(BaseModel):
     message: Message
+    attachments: Optional[list["Attachment"]] = None
 
 # Represents an API response for a collection of users, but structured for when removing a user. 
 class RemovedUserCollection(BaseModel):
@@ -128,16 +315,115 @@ class UserCollection(BaseModel):
     meta: Metadata
     users: list[User]
 
+# Represents the presence of a chat's members: who is online and who is typing.
+class ChatPresence(BaseModel):
+    chat_id: int
+    online: list[int]
+    typing: list[int]
+
+# Represents parameters for reporting that the current user started or stopped typing.
+class TypingUpdate(BaseModel):
+    typing: bool = True
+
+# Represents a data model object for an attachment.
+class Attachment(BaseModel):
+    id: int
+    chat_id: int
+    message_id: Optional[int] = None
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    created_at: datetime
+
+# Represents an API response for a collection of attachments.
+class AttachmentCollection(BaseModel):
+    meta: Metadata
+    attachments: list[Attachment]
+
+# Represents parameters for starting an attachment upload.
+class UploadCreate(BaseModel):
+    filename: str = Field(min_length=1, max_length=255)
+    content_type: str = "application/octet-stream"
+    size: int = Field(ge=0)
+
+# Represents a data model object for an upload; 'attachment' is set once every byte was received.
+class Upload(BaseModel):
+    id: str
+    filename: str
+    size: int
+    offset: int
+    attachment: Optional[Attachment] = None
+
+# Represents an API response for an upload.
+class UploadResponse(BaseModel):
+    upload: Upload
+
+# Represents a data model object for a background job.
+class Job(BaseModel):
+    id: int
+    kind: str
+    status: str
+    completed: int
+    total: Optional[int] = None
+    percent: Optional[float] = None
+    throughput: Optional[float] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+# Represents an API response for a background job.
+class JobResponse(BaseModel):
+    job: Job
+
+# Represents a row of a bulk user import that did not create an account.
+class UserImportError(BaseModel):
+    row: int
+    username: Optional[str] = None
+    error: str
+
+# Represents the outcome so far of a bulk user import.
+class UserImportReport(BaseModel):
+    rows: int
+    created: int
+    failed: int
+    seconds: float
+    accounts_per_second: Optional[float] = None
+    errors: list[UserImportError]
+
+# Represents an API response for a bulk user import job.
+class UserImportResponse(BaseModel):
+    job: Job
+    report: Optional[UserImportReport] = None
+
+# Represents an API response for a page of users.
+class UserPage(BaseModel):
+    meta: Metadata
+    users: list[User]
+    next_cursor: Optional[str] = None
+
 # Represents an API response for a collection of chats.
 class ChatCollection(BaseModel):
     meta: Metadata
     chats: list[Chat]
 
+# Represents an API response for a page of the current user's chats.
+class InboxCollection(BaseModel):
+    meta: Metadata
+    chats: list[InboxChat]
+    next_cursor: Optional[str] = Field(default=None)
+
 # Represents a collection of messages.
 class MessageCollection(BaseModel):
     meta: Metadata
     messages: list[Message]
 
+# Represents an API response for a page of the messages mentioning the current user, newest first.
+class MentionPage(BaseModel):
+    mentions: list[Message]
+    next_cursor: Optional[str] = None
+
 # Represents parameters for updating a user in the system.
 class UserUpdate(BaseModel):
     username: Optional[str] = Field(default=None)
@@ -150,4 +436,56 @@ class ChatCreate(BaseModel):
     name: str
 
 class MessageCreate(BaseModel):
-    text: str
\ No newline at end of file
+    text: str
+
+# Represents the number of messages (or of active users) within one hour or day.
+class RollupBucket(BaseModel):
+    bucket_start: datetime
+    count: int
+
+# Represents an API response for message volume or active users over a time range.
+class RollupSeries(BaseModel):
+    granularity: str
+    start: datetime
+    end: datetime
+    total: int
+    buckets: list[RollupBucket]
+
+# Represents the number of messages of one chat or user over a time range.
+class RollupTotal(BaseModel):
+    id: int
+    count: int
+
+# Represents an API response for the chats or users with the most messages over a time range.
+class RollupRanking(BaseModel):
+    by: str
+    start: datetime
+    end: datetime
+    ranking: list[RollupTotal]
+
+# Represents parameters for changing the moderation policy of a chat.
+class ModerationPolicyUpdate(BaseModel):
+    policy: Literal["reject", "mask", "flag"]
+
+# Represents an API response for the moderation policy of a chat.
+class ModerationPolicyResponse(BaseModel):
+    chat_id: int
+    policy: str
+
+# Represents parameters for replacing the banned terms of the moderation filter.
+class ModerationTerms(BaseModel):
+    terms: list[str]
+
+# Represents a data model object for a message flagged by the moderation filter.
+class MessageFlag(BaseModel):
+    id: int
+    message_id: int
+    chat_id: int
+    user_id: int
+    terms: list[str]
+    created_at: datetime
+
+# Represents an API response for a collection of flagged messages.
+class MessageFlagCollection(BaseModel):
+    meta: Metadata
+    flags: list[MessageFlag]
@@ -0,0 +1,189 @@
+## This class contains the cross-worker cache invalidation bus for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Every uvicorn worker keeps its own in-process caches. The database mutators publish an
+# entity-change event into the 'cache_events' table in the same transaction as the change, and
+# every worker runs a subscriber thread that polls the table and invalidates its caches. Events
+# published by a worker are skipped by that worker's own subscriber, since it already updated its
+# caches directly.
+#
+# The autoincrement id of an event is the bus generation. SQLite has a single writer and never
+# reuses autoincrement ids, so generations are dense. A subscriber only advances its generation
+# after the handlers ran, so delivery is at-least-once; if events it has not seen yet were pruned,
+# it notices the gap in generations and resets every cache instead.
+
+import logging
+import os
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, delete, select, text
+
+from backend.entities import CacheEventInDB
+
+logger = logging.getLogger(__name__)
+
+def _new_worker_id() -> str:
+    return f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+worker_id = _new_worker_id()
+
+def _reset_worker_id():
+    # a worker forked after the app was imported (e.g. gunicorn --preload) would otherwise share its
+    # parent's id, and skip the other workers' events as its own
+    global worker_id
+    worker_id = _new_worker_id()
+
+os.register_at_fork(after_in_child=_reset_worker_id)
+poll_interval = float(os.environ.get("EVENT_POLL_INTERVAL", default="0.2"))
+retention_seconds = int(os.environ.get("EVENT_RETENTION_SECONDS", default="3600"))
+# maximum number of events applied per poll
+POLL_BATCH_SIZE = 500
+# the subscriber prunes expired events every this many polls
+PRUNE_EVERY_POLLS = 300
+
+_handlers: dict[str, list[Callable[[int], None]]] = defaultdict(list)
+_reset_handlers: list[Callable[[], None]] = []
+
+def subscribe(entity: str, handler: Callable[[int], None]):
+    """
+    Registers a handler called with the entity id of every event about the given entity type.
+
+    :param entity - the entity type, e.g. "user", "chat", "membership" or "chat_messages".
+    :param handler - a function taking the id of the changed entity.
+    """
+    _handlers[entity].append(handler)
+
+def subscribe_reset(handler: Callable[[], None]):
+    """
+    Registers a handler called when a subscriber may have missed events and every cache must be dropped.
+
+    :param handler - a function taking no arguments.
+    """
+    _reset_handlers.append(handler)
+
+def publish(session: Session, entity: str, entity_id: int):
+    """
+    Publishes an entity-change event. The event is added to the session, so it is committed
+    atomically with the change itself; the caller is responsible for committing.
+
+    :param session - the Session object holding the change.
+    :param entity - the entity type that changed.
+    :param entity_id - the id of the changed entity.
+    """
+    session.add(CacheEventInDB(entity=entity, entity_id=entity_id, origin=worker_id))
+
+class EventSubscriber:
+    """Polls the 'cache_events' table from a background thread and applies events to this worker's caches."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.generation: Optional[int] = None
+        self.received = 0
+        self.resets = 0
+        self._polls = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with Session(self.engine) as session:
+            self.generation = _current_generation(session)
+        self._thread = threading.Thread(target=self._run, name="cache-event-subscriber", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll_once(self, session: Session) -> int:
+        """
+        Applies every event published since the last poll.
+
+        :param session - a Session object for database retrieval.
+        :return - the number of events read.
+        """
+        events = session.exec(
+            select(CacheEventInDB)
+            .where(CacheEventInDB.id > self.generation)
+            .order_by(CacheEventInDB.id)
+            .limit(POLL_BATCH_SIZE)
+        ).all()
+        if not events:
+            return 0
+
+        if events[0].id != self.generation + 1:
+            logger.warning("missed cache events after generation %s, resetting caches", self.generation)
+            self._reset()
+        else:
+            for event in events:
+                if event.origin != worker_id and not self._apply(event):
+                    self._reset()
+                    break
+
+        self.generation = events[-1].id
+        self.received += len(events)
+        return len(events)
+
+    def prune(self, session: Session):
+        """
+        Deletes events older than the retention period.
+
+        :param session - a Session object for database retrieval.
+        """
+        cutoff = datetime.now() - timedelta(seconds=retention_seconds)
+        session.exec(delete(CacheEventInDB).where(CacheEventInDB.created_at < cutoff))
+        session.commit()
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": worker_id,
+            "generation": self.generation,
+            "received": self.received,
+            "resets": self.resets,
+        }
+
+    def _run(self):
+        while not self._stop.wait(poll_interval):
+            try:
+                with Session(self.engine) as session:
+                    self.poll_once(session)
+                    self._polls += 1
+                    if self._polls % PRUNE_EVERY_POLLS == 0:
+                        self.prune(session)
+            except Exception:
+                logger.exception("cache event poll failed")
+
+    def _apply(self, event: CacheEventInDB) -> bool:
+        try:
+            for handler in _handlers.get(event.entity, []):
+                handler(event.entity_id)
+            return True
+        except Exception:
+            logger.exception("cache event handler failed for %s %s", event.entity, event.entity_id)
+            return False
+
+    def _reset(self):
+        self.resets += 1
+        for handler in _reset_handlers:
+            handler()
+
+def _current_generation(session: Session) -> int:
+    # the table may have been pruned empty, so the generation comes from the autoincrement sequence
+    sequence = session.exec(text("SELECT seq FROM sqlite_sequence WHERE name = 'cache_events'")).first()
+    return sequence[0] if sequence else 0
+
+subscriber: Optional[EventSubscriber] = None
+
+def start_subscriber(engine: Engine):
+    global subscriber
+    subscriber = EventSubscriber(engine)
+    subscriber.start()
+
+def stop_subscriber():
+    if subscriber is not None:
+        subscriber.stop()
@@ -0,0 +1,375 @@
+## This class contains the background job runner for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Work that is too slow for a request (purging a large deleted chat, rebuilding inbox summaries,
+# provisioning users in bulk) is queued as a row of the 'jobs' table and run by a bounded pool of
+# worker threads in every uvicorn worker. Workers claim a queued job with a conditional UPDATE, so
+# each job runs on exactly one worker at a time. A running job reports progress and a checkpoint
+# through its JobContext; if its worker dies, the job's heartbeat goes stale, another worker puts
+# it back in the queue, and the handler resumes from the last checkpoint.
+#
+# Kinds can also be scheduled to run periodically (backups, database maintenance). Every worker's
+# dispatcher checks the schedules, and queues a job only if no job of the kind was created within
+# the interval, in a single conditional INSERT, so workers never queue the same run twice.
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import DateTime, exists, insert, literal
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, func, select, update
+
+from backend.entities import Job, JobInDB
+from backend import events
+
+logger = logging.getLogger(__name__)
+
+job_workers = int(os.environ.get("JOB_WORKERS", default="2"))
+poll_interval = float(os.environ.get("JOB_POLL_INTERVAL", default="1.0"))
+# a running job whose worker has not refreshed its heartbeat for this long is queued again
+stale_seconds = int(os.environ.get("JOB_STALE_SECONDS", default="30"))
+HEARTBEAT_INTERVAL = 5.0
+# how often each worker checks whether a scheduled job is due, in seconds
+SCHEDULE_INTERVAL = 60.0
+
+class JobCancelled(Exception):
+    """Raised from JobContext.progress when cancellation of the job was requested."""
+
+class JobInterrupted(Exception):
+    """Raised from JobContext.progress when the runner is stopping; the job is queued again."""
+
+@dataclass(frozen=True)
+class JobKind:
+    name: str
+    handler: Callable[["JobContext"], None]
+    cancellable: bool
+
+@dataclass(frozen=True)
+class Schedule:
+    kind: str
+    interval: timedelta
+    params: str
+
+_kinds: dict[str, JobKind] = {}
+_schedules: list[Schedule] = []
+
+def register(kind: str, handler: Callable[["JobContext"], None], cancellable: bool = True):
+    """
+    Registers the handler that runs jobs of a kind.
+
+    :param kind - the name of the job kind, stored in the 'kind' column.
+    :param handler - a function taking the JobContext of the job. It must be safe to re-run from the
+                     last checkpoint it reported.
+    :param cancellable - whether clients may cancel jobs of this kind while they run.
+    """
+    _kinds[kind] = JobKind(kind, handler, cancellable)
+
+def schedule(kind: str, interval_seconds: float, params: Optional[dict] = None):
+    """
+    Runs jobs of a registered kind periodically.
+
+    :param kind - the name of the job kind.
+    :param interval_seconds - the time between two runs; 0 or less disables the schedule.
+    :param params - the parameters of the scheduled jobs.
+    """
+    if interval_seconds > 0:
+        _schedules.append(Schedule(kind, timedelta(seconds=interval_seconds), json.dumps(params or {})))
+
+def enqueue_due(session: Session) -> list[str]:
+    """
+    Queues a job of every scheduled kind that has no job created within its interval.
+
+    :param session - a Session object for database retrieval.
+    :return - the kinds queued.
+    """
+    queued = []
+    for due in _schedules:
+        now = datetime.now()
+        recent = exists().where(JobInDB.kind == due.kind, JobInDB.created_at > now - due.interval)
+        candidate = select(literal(due.kind), literal("queued"), literal(due.params), literal(0), literal(False),
+                           literal(now, DateTime)).where(~recent)
+        inserted = session.exec(insert(JobInDB).from_select(
+            ["kind", "status", "params", "completed", "cancel_requested", "created_at"], candidate
+        )).rowcount
+        session.commit()
+        if inserted:
+            logger.info("queued scheduled %s job", due.kind)
+            queued.append(due.kind)
+    return queued
+
+def enqueue(session: Session, kind: str, params: dict, user_id: Optional[int] = None) -> JobInDB:
+    """
+    Queues a job. The job is added to the session and flushed, so it is committed atomically with
+    the work that created it; the caller is responsible for committing, then calling 'notify'.
+
+    :param session - the Session object holding the change.
+    :param kind - a registered job kind.
+    :param params - the JSON-serializable parameters of the job.
+    :param user_id - id of the user who requested the job, or None for system jobs.
+    :return - the queued job.
+    """
+    if kind not in _kinds:
+        raise ValueError(f"unknown job kind {kind!r}")
+    job = JobInDB(kind=kind, params=json.dumps(params), created_by=user_id)
+    session.add(job)
+    session.flush()
+    return job
+
+def notify():
+    """Wakes this worker's runner so a job committed by the caller starts without waiting for a poll."""
+    if runner is not None:
+        runner.wake()
+
+def request_cancel(job: JobInDB, session: Session) -> JobInDB:
+    """
+    Cancels a queued job immediately, or asks a running job to stop at its next progress report.
+    Finished jobs and jobs of kinds that cannot be cancelled are returned unchanged.
+
+    :param job - the job to cancel.
+    :param session - a Session object for database retrieval.
+    :return - the updated job.
+    """
+    if job.status == "queued" and _kinds[job.kind].cancellable:
+        session.exec(
+            update(JobInDB)
+            .where(JobInDB.id == job.id, JobInDB.status == "queued")
+            .values(status="cancelled", finished_at=datetime.now())
+        )
+    elif job.status == "running" and _kinds[job.kind].cancellable:
+        job.cancel_requested = True
+        session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+def to_job(job: JobInDB) -> Job:
+    """
+    Converts a job row into its API model, deriving percent complete and throughput (items/s).
+
+    :param job - the job row.
+    """
+    percent = None
+    if job.total:
+        percent = round(min(job.completed / job.total, 1.0) * 100, 1)
+    elif job.status == "succeeded":
+        percent = 100.0
+
+    throughput = None
+    if job.started_at is not None:
+        elapsed = ((job.finished_at or datetime.now()) - job.started_at).total_seconds()
+        if elapsed > 0:
+            throughput = round(job.completed / elapsed, 1)
+
+    return Job(id=job.id, kind=job.kind, status=job.status, completed=job.completed, total=job.total,
+               percent=percent, throughput=throughput, error=job.error, created_at=job.created_at,
+               started_at=job.started_at, finished_at=job.finished_at)
+
+class JobContext:
+    """The view of a running job given to its handler."""
+
+    def __init__(self, job: JobInDB, session: Session, kind: JobKind, stopping: threading.Event):
+        self.job_id = job.id
+        self.session = session
+        self.params: dict = json.loads(job.params)
+        self.checkpoint: Optional[dict] = json.loads(job.checkpoint) if job.checkpoint else None
+        self.completed = job.completed
+        self._kind = kind
+        self._stopping = stopping
+
+    def progress(self, completed: int, total: Optional[int] = None, checkpoint: Optional[dict] = None):
+        """
+        Records progress and commits it. Call this after committing a unit of work, so a resumed job
+        never skips work; the work between two checkpoints may run twice.
+
+        :param completed - the number of items processed so far.
+        :param total - the total number of items, if known.
+        :param checkpoint - JSON-serializable state the handler resumes from after a restart.
+        :raises JobCancelled if the job was cancelled, or JobInterrupted if the runner is stopping.
+        """
+        self.completed = completed
+        values = {"completed": completed, "heartbeat_at": datetime.now()}
+        if total is not None:
+            values["total"] = total
+        if checkpoint is not None:
+            values["checkpoint"] = json.dumps(checkpoint)
+        self.session.exec(update(JobInDB).where(JobInDB.id == self.job_id).values(**values))
+        self.session.commit()
+
+        if self._kind.cancellable and self.session.exec(
+            select(JobInDB.cancel_requested).where(JobInDB.id == self.job_id)
+        ).one():
+            raise JobCancelled()
+        if self._stopping.is_set():
+            raise JobInterrupted()
+
+class JobRunner:
+    """Claims queued jobs and runs them on a bounded pool of worker threads."""
+
+    def __init__(self, engine: Engine, workers: int = job_workers):
+        self.engine = engine
+        self.workers = workers
+        self.finished = 0
+        self.failed = 0
+        self._slots = threading.Semaphore(workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job-worker")
+        self._thread = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops claiming jobs and waits for running jobs to reach their next progress report."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def wake(self):
+        self._wake.set()
+
+    def run_until_idle(self) -> int:
+        """
+        Runs queued jobs one after another in the calling thread until none is left.
+
+        :return - the number of jobs run.
+        """
+        count = 0
+        while (job_id := self._claim()) is not None:
+            self._run(job_id)
+            count += 1
+        return count
+
+    def requeue_stale(self, session: Session) -> int:
+        """
+        Queues again every running job whose worker stopped refreshing its heartbeat.
+
+        :param session - a Session object for database retrieval.
+        :return - the number of jobs queued again.
+        """
+        cutoff = datetime.now() - timedelta(seconds=stale_seconds)
+        count = session.exec(
+            update(JobInDB)
+            .where(JobInDB.status == "running", JobInDB.heartbeat_at < cutoff)
+            .values(status="queued", worker_id=None)
+        ).rowcount
+        session.commit()
+        if count:
+            logger.warning("queued %s stale jobs again", count)
+        return count
+
+    def stats(self) -> dict:
+        return {"worker_id": events.worker_id, "workers": self.workers, "finished": self.finished, "failed": self.failed}
+
+    def _dispatch(self):
+        last_heartbeat = last_schedule = datetime.min
+        while not self._stop.is_set():
+            try:
+                if (datetime.now() - last_heartbeat).total_seconds() >= HEARTBEAT_INTERVAL:
+                    self._heartbeat()
+                    last_heartbeat = datetime.now()
+                if _schedules and (datetime.now() - last_schedule).total_seconds() >= SCHEDULE_INTERVAL:
+                    with Session(self.engine) as session:
+                        enqueue_due(session)
+                    last_schedule = datetime.now()
+
+                if not self._slots.acquire(timeout=poll_interval):
+                    continue
+                job_id = self._claim()
+                if job_id is None:
+                    self._slots.release()
+                    self._wake.wait(poll_interval)
+                    self._wake.clear()
+                    continue
+                self._executor.submit(self._run_in_slot, job_id)
+            except Exception:
+                logger.exception("job dispatch failed")
+                self._stop.wait(poll_interval)
+
+    def _heartbeat(self):
+        with Session(self.engine) as session:
+            session.exec(
+                update(JobInDB)
+                .where(JobInDB.worker_id == events.worker_id, JobInDB.status == "running")
+                .values(heartbeat_at=datetime.now())
+            )
+            session.commit()
+            self.requeue_stale(session)
+
+    def _claim(self) -> Optional[int]:
+        with Session(self.engine) as session:
+            while True:
+                job_id = session.exec(
+                    select(JobInDB.id).where(JobInDB.status == "queued").order_by(JobInDB.id).limit(1)
+                ).first()
+                if job_id is None:
+                    return None
+
+                now = datetime.now()
+                claimed = session.exec(
+                    update(JobInDB)
+                    .where(JobInDB.id == job_id, JobInDB.status == "queued")
+                    .values(status="running", worker_id=events.worker_id, heartbeat_at=now,
+                            started_at=func.coalesce(JobInDB.started_at, now))
+                ).rowcount
+                session.commit()
+                if claimed:
+                    return job_id
+
+    def _run_in_slot(self, job_id: int):
+        try:
+            self._run(job_id)
+        finally:
+            self._slots.release()
+
+    def _run(self, job_id: int):
+        with Session(self.engine) as session:
+            job = session.get(JobInDB, job_id)
+            kind = _kinds.get(job.kind)
+            status, error = "succeeded", None
+            try:
+                if kind is None:
+                    raise ValueError(f"unknown job kind {job.kind!r}")
+                kind.handler(JobContext(job, session, kind, self._stop))
+            except JobCancelled:
+                status = "cancelled"
+            except JobInterrupted:
+                session.rollback()
+                session.exec(update(JobInDB).where(JobInDB.id == job_id).values(status="queued", worker_id=None))
+                session.commit()
+                return
+            except Exception as exception:
+                logger.exception("job %s (%s) failed", job_id, job.kind)
+                session.rollback()
+                status, error = "failed", str(exception) or type(exception).__name__
+                self.failed += 1
+
+            session.exec(
+                update(JobInDB)
+                .where(JobInDB.id == job_id)
+                .values(status=status, error=error, worker_id=None, finished_at=datetime.now())
+            )
+            session.commit()
+            self.finished += 1
+
+runner: Optional[JobRunner] = None
+
+def start_runner(engine: Engine):
+    global runner
+    runner = JobRunner(engine)
+    runner.start()
+
+def stop_runner():
+    if runner is not None:
+        runner.stop()
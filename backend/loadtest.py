@@ -0,0 +1,313 @@
+## This class contains the concurrent load generator for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Registers and logs in virtual users, gives each of them a chat with a few members, then fires a
+# weighted mix of chat requests at a target rate. Arrivals are open-loop: request start times follow
+# a Poisson process fixed in advance, and every latency is measured from the request's scheduled
+# start, so a slow server cannot hold back the next arrivals and hide its tail latency
+# (coordinated omission).
+#
+#   python -m backend.loadtest --users 2000 --rate 500 --duration 60
+#   python -m backend.loadtest --target http://127.0.0.1:8000 --mix get_messages=60,send_message=40
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import httpx
+
+DEFAULT_MIX = {
+    "get_chats": 25,
+    "get_chat": 15,
+    "get_messages": 40,
+    "send_message": 15,
+    "membership": 5,
+}
+
+@dataclass
+class VirtualUser:
+    id: int
+    username: str
+    headers: dict
+    chat_id: Optional[int] = None
+    chat_ids: list[int] = field(default_factory=list)
+
+class RouteStats:
+    """Latencies (in milliseconds) and outcomes of the requests sent to one route."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.statuses: dict[int, int] = defaultdict(int)
+
+    def record(self, latency: float, status: Optional[int]):
+        self.latencies.append(latency)
+        if status is None or status >= 400:
+            self.errors += 1
+        self.statuses[status or 0] += 1
+
+    def summary(self, duration: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "throughput": len(latencies) / duration if duration else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": latencies[-1] if latencies else 0.0,
+            "error_rate": self.errors / len(latencies) if latencies else 0.0,
+            "statuses": dict(self.statuses),
+        }
+
+def percentile(sorted_values: list[float], rank: float) -> float:
+    """
+    Returns the nearest-rank percentile of already sorted values.
+
+    :param sorted_values - the values in ascending order.
+    :param rank - the percentile, between 0 and 100.
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(rank / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise ValueError(f"unknown operation '{name.strip()}', expected one of {', '.join(DEFAULT_MIX)}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+def arrival_times(rate: float, duration: float, rng: random.Random) -> list[float]:
+    """
+    Schedules Poisson arrivals ahead of time, independent of how fast the server responds.
+
+    :param rate - the mean number of requests per second.
+    :param duration - the length of the run in seconds.
+    :param rng - the random number generator to draw inter-arrival gaps from.
+    :return - the request start offsets in seconds.
+    """
+    times = []
+    offset = rng.expovariate(rate)
+    while offset < duration:
+        times.append(offset)
+        offset += rng.expovariate(rate)
+    return times
+
+# ---------- setup ----------- #
+async def register_user(client: httpx.AsyncClient, username: str) -> tuple[int, dict]:
+    """
+    Registers a user whose password is its username, and logs it in.
+
+    :return - the id of the user and the headers authenticating its requests.
+    """
+    response = await client.post("/auth/registration", json={
+        "username": username, "email": f"{username}@loadtest.invalid", "password": username,
+    })
+    response.raise_for_status()
+    user_id = response.json()["user"]["id"]
+    response = await client.post("/auth/token", data={"username": username, "password": username})
+    response.raise_for_status()
+    return user_id, {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def create_users(client: httpx.AsyncClient, count: int, concurrency: int, prefix: str) -> list[VirtualUser]:
+    """
+    Registers and logs in 'count' virtual users, and gives each one a chat that they own.
+
+    :param client - the HTTP client pointed at the backend.
+    :param count - the number of virtual users.
+    :param concurrency - the maximum number of concurrent setup requests.
+    :param prefix - a prefix making the usernames unique to this run.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(index: int) -> VirtualUser:
+        username = f"{prefix}-{index}"
+        async with semaphore:
+            user_id, headers = await register_user(client, username)
+            response = await client.post("/chats", json={"name": f"{username}'s chat"}, headers=headers)
+            response.raise_for_status()
+            chat_id = response.json()["chat"]["id"]
+        return VirtualUser(id=user_id, username=username, headers=headers, chat_id=chat_id, chat_ids=[chat_id])
+
+    return list(await asyncio.gather(*(create(index) for index in range(count))))
+
+async def add_members(client: httpx.AsyncClient, users: list[VirtualUser], members_per_chat: int,
+                      concurrency: int, rng: random.Random):
+    """Adds random other users to every virtual user's chat."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def add(owner: VirtualUser, member: VirtualUser):
+        async with semaphore:
+            response = await client.put(f"/chats/{owner.chat_id}/users/{member.id}", headers=owner.headers)
+            if response.status_code < 400:
+                member.chat_ids.append(owner.chat_id)
+
+    tasks = []
+    for owner in users:
+        others = [user for user in users if user is not owner]
+        for member in rng.sample(others, min(members_per_chat, len(others))):
+            tasks.append(add(owner, member))
+    await asyncio.gather(*tasks)
+
+# ---------- traffic ----------- #
+async def run_operation(client: httpx.AsyncClient, operation: str, user: VirtualUser,
+                        users: list[VirtualUser], rng: random.Random) -> tuple[str, int]:
+    chat_id = rng.choice(user.chat_ids)
+    if operation == "get_chats":
+        response = await client.get("/chats", params={"sort": "recent", "limit": 50}, headers=user.headers)
+        return "GET /chats", response.status_code
+    if operation == "get_chat":
+        response = await client.get(f"/chats/{chat_id}", headers=user.headers)
+        return "GET /chats/{chat_id}", response.status_code
+    if operation == "get_messages":
+        response = await client.get(f"/chats/{chat_id}/messages", params={"limit": 50}, headers=user.headers)
+        return "GET /chats/{chat_id}/messages", response.status_code
+    if operation == "send_message":
+        response = await client.post(f"/chats/{chat_id}/messages", json={"text": f"load test {time.time()}"},
+                                     headers=user.headers)
+        return "POST /chats/{chat_id}/messages", response.status_code
+
+    # membership: the user toggles a random other user in the chat they own
+    member = rng.choice([other for other in users if other is not user] or [user])
+    if user.chat_id in member.chat_ids:
+        response = await client.delete(f"/chats/{user.chat_id}/users/{member.id}", headers=user.headers)
+        if response.status_code < 400 and user.chat_id in member.chat_ids:
+            member.chat_ids.remove(user.chat_id)
+        return "DELETE /chats/{chat_id}/users/{user_id}", response.status_code
+    response = await client.put(f"/chats/{user.chat_id}/users/{member.id}", headers=user.headers)
+    if response.status_code < 400 and user.chat_id not in member.chat_ids:
+        member.chat_ids.append(user.chat_id)
+    return "PUT /chats/{chat_id}/users/{user_id}", response.status_code
+
+async def run_traffic(client: httpx.AsyncClient, users: list[VirtualUser], mix: dict[str, float], rate: float,
+                      duration: float, rng: random.Random) -> tuple[dict[str, RouteStats], float]:
+    """
+    Fires the weighted request mix at the target rate with open-loop arrivals.
+
+    :return - the per-route statistics and the measured wall-clock duration of the run.
+    """
+    stats: dict[str, RouteStats] = defaultdict(RouteStats)
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    schedule = arrival_times(rate, duration, rng)
+
+    async def fire(scheduled: float, operation: str, user: VirtualUser):
+        try:
+            route, status = await run_operation(client, operation, user, users, rng)
+        except httpx.HTTPError:
+            route, status = operation, None
+        # measured from the scheduled start, including any time spent waiting for a connection
+        stats[route].record((time.perf_counter() - scheduled) * 1000, status)
+
+    started = time.perf_counter()
+    tasks = []
+    for offset in schedule:
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        operation = rng.choices(operations, weights)[0]
+        tasks.append(asyncio.create_task(fire(started + offset, operation, rng.choice(users))))
+    await asyncio.gather(*tasks)
+    return stats, time.perf_counter() - started
+
+def format_report(stats: dict[str, RouteStats], duration: float) -> str:
+    lines = [f"{'route':<42}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"]
+    total = RouteStats()
+    for route in sorted(stats):
+        summary = stats[route].summary(duration)
+        total.latencies += stats[route].latencies
+        total.errors += stats[route].errors
+        lines.append(f"{route:<42}{summary['requests']:>9}{summary['throughput']:>9.1f}{summary['p50_ms']:>9.1f}"
+                     f"{summary['p95_ms']:>9.1f}{summary['p99_ms']:>9.1f}{summary['error_rate']:>8.1%}")
+    summary = total.summary(duration)
+    lines.append(f"{'total':<42}{summary['requests']:>9}{summary['throughput']:>9.1f}{summary['p50_ms']:>9.1f}"
+                 f"{summary['p95_ms']:>9.1f}{summary['p99_ms']:>9.1f}{summary['error_rate']:>8.1%}")
+    return "\n".join(lines)
+
+# ---------- entry points ----------- #
+@contextlib.asynccontextmanager
+async def in_process_client(connections: int) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Yields a client that calls the ASGI app directly, backed by a throwaway database file so a
+    load test never writes to 'backend/pony_express.db'. The file is deleted on exit.
+    """
+    from sqlmodel import Session, SQLModel, create_engine
+
+    from backend import database as db
+    from backend import migrations
+    from backend.main import app
+
+    path = tempfile.NamedTemporaryFile(prefix="pony-express-load-", suffix=".db", delete=False).name
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False},
+                           pool_size=db.POOL_SIZE)
+    SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
+
+    def _get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[db.get_session] = _get_session_override
+    # unhandled server errors are reported as 500s and counted, as they would be over the network
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest",
+                                     limits=httpx.Limits(max_connections=connections), timeout=None) as client:
+            yield client
+    finally:
+        app.dependency_overrides.pop(db.get_session, None)
+        engine.dispose()
+        os.remove(path)
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    if args.target:
+        connect = httpx.AsyncClient(base_url=args.target, limits=httpx.Limits(max_connections=args.connections),
+                                    timeout=args.timeout)
+    else:
+        connect = in_process_client(args.connections)
+
+    async with connect as client:
+        prefix = f"load-{int(time.time())}-{rng.randrange(10 ** 6)}"
+        users = await create_users(client, args.users, args.setup_concurrency, prefix)
+        await add_members(client, users, args.members_per_chat, args.setup_concurrency, rng)
+        stats, duration = await run_traffic(client, users, parse_mix(args.mix), args.rate, args.duration, rng)
+
+    return {"duration": duration, "routes": {route: stats[route].summary(duration) for route in sorted(stats)},
+            "report": format_report(stats, duration)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the Pony Express backend.")
+    parser.add_argument("--target", help="base URL of a running server; defaults to an in-process app")
+    parser.add_argument("--users", type=int, default=200, help="number of virtual users")
+    parser.add_argument("--members-per-chat", type=int, default=5, help="extra members added to each user's chat")
+    parser.add_argument("--rate", type=float, default=100.0, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="length of the traffic phase in seconds")
+    parser.add_argument("--mix", default=",".join(f"{name}={weight}" for name, weight in DEFAULT_MIX.items()),
+                        help="weighted operation mix, e.g. get_messages=60,send_message=40")
+    parser.add_argument("--connections", type=int, default=1000, help="maximum concurrent connections")
+    parser.add_argument("--setup-concurrency", type=int, default=50, help="concurrent requests during setup")
+    parser.add_argument("--timeout", type=float, default=30.0, help="request timeout in seconds (remote targets)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a reproducible run")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps({"duration": result["duration"], "routes": result["routes"]}, indent=2))
+    else:
+        print(result["report"])
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,30 @@
-from fastapi import FastAPI, Request
+# imported first, so the startup timings include importing everything below
+from backend import warmup
+
+import time
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from backend.routers.chats import chats_router
 from backend.routers.users import users_router
+from backend.routers.admin import admin_router
+from backend.routers.jobs import jobs_router
+from backend.routers.attachments import attachments_router
+from backend.routers.presence import presence_router
 from backend.auth import auth_router
 from backend.database import EntityNotFoundException, DuplicateEntityException
+from backend.concurrency import ConcurrencyLimitMiddleware
+from backend.compression import CompressionMiddleware
+from backend.allocations import AllocationProfilerMiddleware
+from backend.capture import TrafficCaptureMiddleware, traffic_recorder
 
 from contextlib import asynccontextmanager
-from backend.database import create_db_and_tables
+from backend import events, jobs
+from backend.database import create_db_and_tables, engine
+from backend.moderation import moderation_filter
+from backend.query_analyzer import query_analyzer
 
 tags_metadata = [
     {
@@ -19,12 +35,48 @@ tags_metadata = [
         "name": "Users",
         "description": "Routes related to Users",
     },
+    {
+        "name": "Attachments",
+        "description": "Routes related to message attachments",
+    },
+    {
+        "name": "Presence",
+        "description": "Routes related to online and typing indicators",
+    },
+    {
+        "name": "Jobs",
+        "description": "Routes related to background jobs",
+    },
+    {
+        "name": "Admin",
+        "description": "Admin-only diagnostic routes",
+    },
+    {
+        "name": "Health",
+        "description": "Liveness and readiness probes",
+    },
 ]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    warmup.record_phase("import", warmup.started_at)
+    phase_started_at = time.perf_counter()
     create_db_and_tables()
+    warmup.record_phase("database", phase_started_at)
+    phase_started_at = time.perf_counter()
+    moderation_filter.start(engine)
+    warmup.record_phase("moderation", phase_started_at)
+    events.start_subscriber(engine)
+    jobs.start_runner(engine)
+    query_analyzer.start_reporter()
+    # in the background, so the server accepts requests and answers 503 at '/health/ready' meanwhile
+    warmup.start(engine)
     yield
+    warmup.reset()
+    traffic_recorder.stop()
+    query_analyzer.stop_reporter()
+    jobs.stop_runner()
+    events.stop_subscriber()
 
 app = FastAPI(
     title="Pony Express", 
@@ -36,7 +88,12 @@ app = FastAPI(
 app.include_router(auth_router)
 app.include_router(chats_router)
 app.include_router(users_router)
+app.include_router(attachments_router)
+app.include_router(presence_router)
+app.include_router(jobs_router)
+app.include_router(admin_router)
 
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"], # change this as appropriate for your setup
@@ -44,6 +101,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# inside the concurrency limit, so requests are not traced while they wait for a slot
+app.add_middleware(AllocationProfilerMiddleware)
+app.add_middleware(ConcurrencyLimitMiddleware)
+# outermost, so captured arrival times and durations include waiting for a slot
+app.add_middleware(TrafficCaptureMiddleware)
 
 @app.exception_handler(EntityNotFoundException)
 def handle_entity_not_found(
@@ -79,6 +141,23 @@ def handle_duplicate_entity(
     )
 
 
+# Answers as long as the worker serves requests, e.g. for a process supervisor.
+@app.get("/health/live", tags=["Health"], description="Returns 200 while the worker is serving requests.")
+def get_liveness():
+    return {"status": "live"}
+
+# Answers 503 until the startup warmup has finished, so a load balancer only routes requests to warm
+# workers, and with how long each phase of the startup took afterwards.
+@app.get("/health/ready", tags=["Health"], description="Returns 200 with startup timings once the worker finished warming up, and 503 before.")
+def get_readiness():
+    if not warmup.is_ready():
+        raise HTTPException(status_code=503, headers={"Retry-After": "1"}, detail={
+            "error": "not_ready",
+            "error_description": "the worker is still starting up"
+        })
+
+    return warmup.stats()
+
 @app.get("/", include_in_schema=False)
 def default() -> str:
     return HTMLResponse(
@@ -0,0 +1,137 @@
+## This class contains @mention extraction and the username directory for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# When a message is sent or edited, the '@username' mentions in its text are resolved to users
+# and indexed in the 'mentions' table, so each user's mentions inbox is read from that index
+# rather than by scanning chats. Mentions are resolved through an in-memory directory of every
+# username rather than with a query per message. A mention matches a username exactly, or
+# ignoring case when only one user has that name in any case.
+#
+# The directory is loaded on first use. Registrations and renames on this worker update it
+# directly; those on other workers publish a "username" or "user" event, after which the changed
+# users are re-read on the next lookup. Registrations made while the first load is reading users
+# are kept and applied once it finishes, since the load may have read the table before them.
+
+import re
+import threading
+from typing import Iterable, Optional
+
+from sqlmodel import Session, select
+
+from backend import events
+from backend.entities import UserInDB
+
+# an '@' that does not follow a letter or digit, so e-mail addresses are not mentions
+MENTION = re.compile(r"(?<![\w@])@(\w[\w.-]*)")
+# mentions beyond this many per message are ignored
+MAX_MENTIONS = 50
+# a username that is ambiguous when case is ignored
+AMBIGUOUS = 0
+
+def extract_usernames(text: str) -> list[str]:
+    """
+    :param text - the text of a message.
+    :return - the distinct usernames mentioned in the text, in order of first mention.
+    """
+    names = {}
+    for match in MENTION.finditer(text):
+        # punctuation ending a sentence is not part of the name
+        names.setdefault(match.group(1).rstrip(".-"), None)
+        if len(names) == MAX_MENTIONS:
+            break
+    return list(names)
+
+class UsernameDirectory:
+    """Maps usernames to user ids for resolving mentions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Optional[dict[str, int]] = None
+        # username in lower case -> user id, or AMBIGUOUS
+        self._folded: dict[str, int] = {}
+        self._names: dict[int, str] = {}
+        self._stale: set[int] = set()
+        # (user id, username) added while a load is reading users, or None when no load is running
+        self._pending: Optional[list[tuple[int, str]]] = None
+
+    def load(self, rows: Iterable[tuple[int, str]]):
+        """Replaces the directory with the given (user id, username) rows."""
+        ids, folded = {}, {}
+        for user_id, username in rows:
+            ids[username] = user_id
+            key = username.lower()
+            folded[key] = user_id if key not in folded else AMBIGUOUS
+        with self._lock:
+            self._ids, self._folded = ids, folded
+            self._names = {user_id: username for username, user_id in ids.items()}
+            pending, self._pending = self._pending or [], None
+            for user_id, username in pending:
+                self._add(user_id, username)
+
+    def add(self, user_id: int, username: str):
+        """Records a new user, or a user's new username."""
+        with self._lock:
+            if self._ids is not None:
+                self._add(user_id, username)
+            elif self._pending is not None:
+                self._pending.append((user_id, username))
+
+    def _add(self, user_id: int, username: str):
+        previous = self._names.get(user_id)
+        if previous == username:
+            return
+        if previous is not None:
+            del self._ids[previous]
+            # a name that was ambiguous stays so until the next full load, which only costs the case-insensitive match
+            if self._folded.get(previous.lower()) == user_id:
+                del self._folded[previous.lower()]
+        self._ids[username] = user_id
+        self._names[user_id] = username
+        key = username.lower()
+        self._folded[key] = user_id if self._folded.get(key, user_id) == user_id else AMBIGUOUS
+
+    def lookup(self, usernames: Iterable[str]) -> dict[str, int]:
+        """
+        :param usernames - mentioned usernames.
+        :return - the id of each username that names a user.
+        """
+        with self._lock:
+            ids, folded = self._ids or {}, self._folded
+            resolved = {}
+            for username in usernames:
+                user_id = ids.get(username) or folded.get(username.lower())
+                if user_id:
+                    resolved[username] = user_id
+            return resolved
+
+    def resolve(self, usernames: list[str], session: Session) -> dict[str, int]:
+        """Like 'lookup', after loading the directory or re-reading users changed on other workers."""
+        with self._lock:
+            loaded = self._ids is not None
+            stale, self._stale = self._stale, set()
+            if not loaded and self._pending is None:
+                self._pending = []
+        if not loaded:
+            self.load(session.exec(select(UserInDB.id, UserInDB.username)).all())
+        elif stale:
+            for user_id, username in session.exec(select(UserInDB.id, UserInDB.username).where(UserInDB.id.in_(stale))):
+                self.add(user_id, username)
+        return self.lookup(usernames)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._stale.add(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._ids = None
+            self._folded, self._names, self._stale, self._pending = {}, {}, set(), None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"loaded": self._ids is not None, "usernames": len(self._names), "stale": len(self._stale)}
+
+username_directory = UsernameDirectory()
+events.subscribe("username", username_directory.invalidate)
+events.subscribe("user", username_directory.invalidate)
+events.subscribe_reset(username_directory.clear)
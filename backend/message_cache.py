@@ -0,0 +1,252 @@
+## This class contains the in-memory recent-message cache for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+
+import os
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+from backend import events
+
+# rough per-message overhead of the cached dict, its keys and the embedded user (in bytes)
+MESSAGE_OVERHEAD_BYTES = 640
+# number of striped generation counters used to detect writes that race with a lazy load
+GENERATION_STRIPES = 256
+
+class _ChatEntry:
+    """Ring buffer of the most recent serialized messages of a single chat."""
+
+    __slots__ = ("messages", "total", "complete", "size")
+
+    def __init__(self, capacity: int):
+        self.messages = deque(maxlen=capacity)
+        self.total = 0
+        self.complete = False
+        self.size = 0
+
+class RecentMessageCache:
+    """
+    Process-wide cache of the most recent serialized messages per chat.
+
+    Each chat keeps a bounded ring buffer of its newest messages. Chats are evicted in
+    least-recently-used order whenever the estimated memory usage exceeds the global budget.
+    Entries are populated lazily by readers and updated in place by the message mutators.
+    """
+
+    def __init__(self, per_chat: int, max_bytes: int):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[int, _ChatEntry] = OrderedDict()
+        self._generations = [0] * GENERATION_STRIPES
+        self._lock = threading.Lock()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, chat_id: int, limit: Optional[int] = None) -> Optional[tuple[list[dict], int]]:
+        """
+        Retrieve the newest messages of a chat from the cache.
+
+        :param chat_id - id of the chat to read.
+        :param limit - the maximum number of newest messages wanted, or None for the full history.
+        :return - a (messages, total message count) tuple, or None if the cache cannot answer the read.
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or not (entry.complete or (limit is not None and limit <= len(entry.messages))):
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(chat_id)
+            self._hits += 1
+            messages = list(entry.messages)
+            if limit is not None:
+                messages = messages[-limit:]
+            return messages, entry.total
+
+    def get_total(self, chat_id: int) -> Optional[int]:
+        """
+        Retrieve the cached message count of a chat without counting it as a hit or miss.
+
+        :param chat_id - id of the chat.
+        :return - the number of messages in the chat, or None if the chat is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            return entry.total if entry is not None else None
+
+    def generation(self, chat_id: int) -> int:
+        """
+        Returns the write generation of a chat. Readers take it before querying the database
+        and pass it to 'load' so a load that raced with a write is discarded.
+
+        :param chat_id - id of the chat.
+        """
+        return self._generations[chat_id % GENERATION_STRIPES]
+
+    def load(self, chat_id: int, messages: list[dict], total: int, generation: int):
+        """
+        Installs the newest messages of a chat after a cache miss.
+
+        :param chat_id - id of the chat.
+        :param messages - the newest messages of the chat in ascending order.
+        :param total - the number of messages in the chat.
+        :param generation - the chat generation observed before the messages were read.
+        """
+        with self._lock:
+            if self._generations[chat_id % GENERATION_STRIPES] != generation:
+                return
+
+            self._drop(chat_id)
+            entry = _ChatEntry(self.per_chat)
+            for message in messages[-self.per_chat:]:
+                entry.messages.append(message)
+                entry.size += _estimate_size(message)
+            entry.total = total
+            entry.complete = total <= len(entry.messages)
+            self._entries[chat_id] = entry
+            self._size += entry.size
+            self._evict()
+
+    def append(self, chat_id: int, message: dict):
+        """
+        Adds a newly sent message to the chat's ring buffer if the chat is cached. A load that read
+        the chat after the message was committed, but before this call, already holds it.
+
+        :param chat_id - id of the chat.
+        :param message - the serialized message.
+        """
+        with self._lock:
+            self._bump(chat_id)
+            entry = self._entries.get(chat_id)
+            if entry is None or any(cached["id"] == message["id"] for cached in reversed(entry.messages)):
+                return
+
+            if len(entry.messages) == entry.messages.maxlen:
+                evicted = entry.messages[0]
+                entry.size -= _estimate_size(evicted)
+                self._size -= _estimate_size(evicted)
+                entry.complete = False
+            entry.messages.append(message)
+            entry.size += _estimate_size(message)
+            entry.total += 1
+            self._size += _estimate_size(message)
+            self._entries.move_to_end(chat_id)
+            self._evict()
+
+    def replace(self, chat_id: int, message: dict):
+        """
+        Replaces an updated message in the chat's ring buffer if it is cached.
+
+        :param chat_id - id of the chat.
+        :param message - the serialized message, matched by id.
+        """
+        with self._lock:
+            self._bump(chat_id)
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return
+
+            for index, cached in enumerate(entry.messages):
+                if cached["id"] == message["id"]:
+                    delta = _estimate_size(message) - _estimate_size(cached)
+                    entry.messages[index] = message
+                    entry.size += delta
+                    self._size += delta
+                    break
+            self._evict()
+
+    def remove(self, chat_id: int, message_id: int):
+        """
+        Removes a deleted message from the chat's ring buffer. A ring that holds only part of the
+        history is dropped instead, since it could no longer answer reads of its full length.
+
+        :param chat_id - id of the chat.
+        :param message_id - id of the deleted message.
+        """
+        with self._lock:
+            self._bump(chat_id)
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return
+
+            if not entry.complete:
+                self._drop(chat_id)
+                return
+
+            for cached in entry.messages:
+                if cached["id"] == message_id:
+                    entry.messages.remove(cached)
+                    entry.size -= _estimate_size(cached)
+                    self._size -= _estimate_size(cached)
+                    entry.total -= 1
+                    break
+
+    def invalidate(self, chat_id: int):
+        """
+        Drops a chat from the cache.
+
+        :param chat_id - id of the chat.
+        """
+        with self._lock:
+            self._bump(chat_id)
+            self._drop(chat_id)
+
+    def clear(self):
+        """Drops every chat from the cache."""
+        with self._lock:
+            for stripe in range(GENERATION_STRIPES):
+                self._generations[stripe] += 1
+            self._entries.clear()
+            self._size = 0
+
+    def reset_stats(self):
+        with self._lock:
+            self._hits = self._misses = self._evictions = 0
+
+    def stats(self) -> dict:
+        """Returns the hit rate and memory usage of the cache."""
+        with self._lock:
+            reads = self._hits + self._misses
+            return {
+                "chats": len(self._entries),
+                "messages": sum(len(entry.messages) for entry in self._entries.values()),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / reads if reads else 0.0,
+                "evictions": self._evictions,
+                "memory_bytes": self._size,
+                "max_memory_bytes": self.max_bytes,
+                "messages_per_chat": self.per_chat,
+            }
+
+    # ---------- helpers, callers must hold the lock ---------- #
+    def _bump(self, chat_id: int):
+        self._generations[chat_id % GENERATION_STRIPES] += 1
+
+    def _drop(self, chat_id: int):
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            self._evictions += 1
+
+def _estimate_size(message: dict) -> int:
+    return sys.getsizeof(message["text"]) + MESSAGE_OVERHEAD_BYTES
+
+message_cache = RecentMessageCache(
+    per_chat=int(os.environ.get("MESSAGE_CACHE_PER_CHAT", default="100")),
+    max_bytes=int(os.environ.get("MESSAGE_CACHE_MAX_BYTES", default=str(64 * 1024 * 1024))),
+)
+
+# keep this worker's cache coherent with writes made by other workers
+events.subscribe("chat", message_cache.invalidate)
+events.subscribe("chat_messages", message_cache.invalidate)
+events.subscribe("user", lambda _user_id: message_cache.clear())
+events.subscribe_reset(message_cache.clear)
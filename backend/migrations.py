@@ -0,0 +1,239 @@
+## This class contains versioned schema migrations for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# 'SQLModel.metadata.create_all' creates missing tables but never alters existing ones, so changes
+# to tables of a deployed database (new indexes, new columns, data backfills) are shipped as
+# numbered migrations. Applied versions are recorded in the 'schema_migrations' table. Every
+# migration is idempotent, so it is also safe on a fresh database whose tables 'create_all'
+# already created in their latest shape. A migration that SQLite refuses to run inside a transaction,
+# such as changing the journal mode, is marked non-transactional and runs just before its version row
+# is recorded.
+
+import logging
+import sqlite3
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Union
+
+from sqlalchemy.engine import Engine
+
+from backend import archive
+from backend.mentions import UsernameDirectory, extract_usernames
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Union[str, Callable[[sqlite3.Cursor], None]]
+    transactional: bool = True
+
+def _backfill_chat_summaries(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        INSERT INTO chat_summaries (chat_id, last_message_id, last_user_id, preview, last_activity_at)
+        SELECT chats.id, messages.id, messages.user_id, substr(messages.text, 1, 100),
+               COALESCE(messages.created_at, chats.created_at)
+        FROM chats
+        LEFT JOIN messages ON messages.id = (SELECT MAX(id) FROM messages WHERE messages.chat_id = chats.id)
+        WHERE NOT EXISTS (SELECT 1 FROM chat_summaries WHERE chat_summaries.chat_id = chats.id)
+    """)
+
+def add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str):
+    """
+    Adds a column to a table unless it already has it, since SQLite has no 'ADD COLUMN IF NOT EXISTS'.
+
+    :param cursor - a cursor on the database.
+    :param table - the table to alter.
+    :param column - the name of the new column.
+    :param definition - the type and constraints of the column; a NOT NULL column needs a constant default.
+    """
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _add_versions(cursor: sqlite3.Cursor):
+    for table in ("users", "chats", "messages"):
+        add_column(cursor, table, "version", "INTEGER NOT NULL DEFAULT 1")
+
+def _backfill_message_rollups(cursor: sqlite3.Cursor):
+    # bucket starts are written in the format SQLAlchemy stores datetimes in, so they compare with its parameters
+    buckets = (("hour", "%Y-%m-%d %H:00:00.000000"), ("day", "%Y-%m-%d 00:00:00.000000"))
+    counts = Counter()
+    for granularity, bucket in buckets:
+        for bucket_start, chat_id, user_id, count in cursor.execute(f"""
+            SELECT strftime('{bucket}', created_at), chat_id, user_id, COUNT(*)
+            FROM messages
+            GROUP BY 1, chat_id, user_id
+        """):
+            counts[granularity, bucket_start, chat_id, user_id] += count
+
+    # messages already moved into the archive count too; a chat's archive is the prefix of its
+    # history before its first message in the table, which a stopped archiving run may overlap
+    first_ids = dict(cursor.execute("SELECT chat_id, MIN(id) FROM messages GROUP BY chat_id").fetchall())
+    for chat_id in archive.get_archived_chat_ids():
+        for message_id, user_id, created_at in archive.iter_messages(chat_id):
+            if chat_id in first_ids and message_id >= first_ids[chat_id]:
+                break
+            for granularity, bucket in buckets:
+                counts[granularity, created_at.strftime(bucket), chat_id, user_id] += 1
+
+    cursor.executemany("""
+        INSERT INTO message_rollups (granularity, bucket_start, chat_id, user_id, count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT DO NOTHING
+    """, [(*key, count) for key, count in counts.items()])
+
+def _add_moderation_policies(cursor: sqlite3.Cursor):
+    add_column(cursor, "chats", "moderation_policy", "VARCHAR NOT NULL DEFAULT 'reject'")
+
+def _add_attachment_uploads(cursor: sqlite3.Cursor):
+    add_column(cursor, "attachments", "upload_id", "VARCHAR")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_attachments_upload_id ON attachments (upload_id)")
+
+def _add_member_activity(cursor: sqlite3.Cursor):
+    add_column(cursor, "user_chat_links", "last_activity_at", "DATETIME")
+    cursor.execute("""
+        UPDATE user_chat_links
+        SET last_activity_at = (SELECT last_activity_at FROM chat_summaries
+                                WHERE chat_summaries.chat_id = user_chat_links.chat_id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS ix_user_chat_links_user_id_last_activity_at_chat_id
+        ON user_chat_links (user_id, last_activity_at, chat_id)
+    """)
+
+def _backfill_mentions(cursor: sqlite3.Cursor):
+    directory = UsernameDirectory()
+    directory.load(cursor.execute("SELECT id, username FROM users").fetchall())
+    members = set(cursor.execute("SELECT user_id, chat_id FROM user_chat_links").fetchall())
+    rows = []
+    for message_id, chat_id, author_id, text in cursor.execute(
+        "SELECT id, chat_id, user_id, text FROM messages WHERE text LIKE '%@%'"
+    ).fetchall():
+        for user_id in set(directory.lookup(extract_usernames(text)).values()) - {author_id}:
+            if (user_id, chat_id) in members:
+                rows.append((user_id, message_id, chat_id))
+    cursor.executemany("INSERT OR IGNORE INTO mentions (user_id, message_id, chat_id) VALUES (?, ?, ?)", rows)
+
+# 'users(email)' needs no index of its own: the UNIQUE constraint on email already gives SQLite the
+# 'sqlite_autoindex_users_1' index that 'get_existing_user' uses. Likewise 'user_chat_links(user_id)'
+# is the leading column of the table's primary key, so membership lookups by chat id are the ones
+# that need an index.
+MIGRATIONS = [
+    Migration(1, "index messages by chat and creation time",
+              "CREATE INDEX IF NOT EXISTS ix_messages_chat_id_created_at ON messages (chat_id, created_at)"),
+    Migration(2, "index messages by chat for newest-first reads",
+              "CREATE INDEX IF NOT EXISTS ix_messages_chat_id_id ON messages (chat_id, id)"),
+    Migration(3, "index chat memberships by chat",
+              "CREATE INDEX IF NOT EXISTS ix_user_chat_links_chat_id ON user_chat_links (chat_id)"),
+    Migration(4, "index chats by owner",
+              "CREATE INDEX IF NOT EXISTS ix_chats_owner_id ON chats (owner_id)"),
+    Migration(5, "backfill chat inbox summaries", _backfill_chat_summaries),
+    Migration(6, "index usernames case-insensitively for directory search",
+              "CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username))"),
+    Migration(7, "index emails case-insensitively for directory search",
+              "CREATE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))"),
+    Migration(8, "version users, chats and messages for optimistic concurrency", _add_versions),
+    Migration(9, "backfill hourly and daily message rollups", _backfill_message_rollups),
+    Migration(10, "add a moderation policy to chats", _add_moderation_policies),
+    Migration(11, "index the @mentions of existing messages", _backfill_mentions),
+    Migration(12, "record the upload each attachment was completed from", _add_attachment_uploads),
+    # readers and writers no longer block each other, so a backup reads one snapshot while the app
+    # commits; the mode is stored in the database file (an in-memory database stays in 'memory' mode)
+    Migration(13, "store the database in write-ahead-log mode", "PRAGMA journal_mode=WAL", transactional=False),
+    Migration(14, "order each member's inbox by last activity", _add_member_activity),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+def get_schema_version(cursor: sqlite3.Cursor) -> int:
+    """
+    Returns the newest migration version applied to the database, or 0 if none was applied.
+
+    :param cursor - a cursor on the database.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at DATETIME NOT NULL
+        )
+    """)
+    return cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+def migrate(engine: Engine) -> list[int]:
+    """
+    Applies every pending migration, each in its own transaction together with its version row.
+    Returns immediately after a single version lookup when the database is up to date. Concurrent
+    workers serialize on SQLite's write lock and re-check the version once they hold it.
+
+    :param engine - the engine of the database to migrate.
+    :return - the versions that were applied.
+    """
+    connection = engine.raw_connection()
+    dbapi_connection = connection.driver_connection
+    isolation_level = dbapi_connection.isolation_level
+    try:
+        # manage transactions explicitly so a migration and its version row commit together
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        if get_schema_version(cursor) >= LATEST_VERSION:
+            return []
+
+        applied = []
+        for migration in MIGRATIONS:
+            started = time.perf_counter()
+            if not migration.transactional and get_schema_version(cursor) < migration.version:
+                cursor.execute(migration.upgrade)
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(cursor) >= migration.version:
+                    cursor.execute("COMMIT")
+                    continue
+
+                if callable(migration.upgrade):
+                    migration.upgrade(cursor)
+                elif migration.transactional:
+                    cursor.execute(migration.upgrade)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                    (migration.version, migration.description, datetime.now().isoformat(sep=" ")),
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+            applied.append(migration.version)
+            logger.info("applied migration %s (%s) in %.1f ms", migration.version, migration.description,
+                        (time.perf_counter() - started) * 1000)
+        return applied
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument("--status", action="store_true", help="only print the current and latest versions")
+    args = parser.parse_args()
+
+    from backend.database import create_db_and_tables, engine
+    if args.status:
+        connection = engine.raw_connection()
+        try:
+            version = get_schema_version(connection.driver_connection.cursor())
+        finally:
+            connection.close()
+        print(f"schema version {version}, latest {LATEST_VERSION}")
+        return
+
+    create_db_and_tables()
+    print(f"schema is at version {LATEST_VERSION}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+## This class contains the content moderation filter for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Every message that is sent or edited is scanned for the banned terms of the 'moderation_terms'
+# table. The terms are compiled into one Aho-Corasick automaton, so a scan visits each character of
+# the message once, however many terms there are. Matching ignores case, and a term only matches
+# whole words unless it starts or ends with '*' ("spam*" also matches "spammer", "*spam*" matches
+# anywhere). Each chat's moderation policy decides what happens to a message with a match: it is
+# rejected, its matches are masked with '*', or it is stored as is and flagged for admins.
+#
+# The automaton is immutable. A reload builds a new one next to the current one and then swaps the
+# reference, so messages are scanned without taking a lock and never wait for a reload. Replacing
+# the term list publishes a "moderation_terms" event, on which every other worker reloads in the
+# background.
+
+import logging
+import random
+import string
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from backend import events
+from backend.entities import ModerationTermInDB
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("reject", "mask", "flag")
+WILDCARD = "*"
+MASK = "*"
+# transitions are keyed by 'state * ALPHABET + code point' in a single dict
+ALPHABET = 0x110000
+
+@dataclass(frozen=True)
+class Term:
+    text: str
+    # whether the characters before and after a match must not be letters or digits
+    word_start: bool
+    word_end: bool
+
+@dataclass(frozen=True)
+class Match:
+    start: int
+    end: int
+    term: Term
+
+@dataclass(frozen=True)
+class Verdict:
+    action: Optional[str]
+    text: str
+    terms: list[str]
+
+def parse_term(line: str) -> Optional[Term]:
+    """
+    :param line - a banned term, optionally with a leading or trailing '*' wildcard.
+    :return - the term as matched, or None if the line holds no term.
+    """
+    pattern = line.strip().lower()
+    body = pattern.strip(WILDCARD)
+    if not body:
+        return None
+    return Term(body, not pattern.startswith(WILDCARD) and body[0].isalnum(),
+                not pattern.endswith(WILDCARD) and body[-1].isalnum())
+
+class TermMatcher:
+    """An Aho-Corasick automaton finding every occurrence of a set of terms in one pass over a text."""
+
+    def __init__(self, terms: Iterable[str] = ()):
+        self.terms: list[Term] = []
+        self._goto: dict[int, int] = {}
+        self._fail = [0]
+        # per state, the indexes of the terms ending there, including those ending at its suffixes
+        self._outputs: list[tuple] = [()]
+        children: list[list[tuple[int, int]]] = [[]]
+
+        seen = set()
+        for line in terms:
+            term = parse_term(line)
+            if term is None or term in seen:
+                continue
+            seen.add(term)
+            state = 0
+            for code in map(ord, term.text):
+                key = state * ALPHABET + code
+                child = self._goto.get(key)
+                if child is None:
+                    child = self._goto[key] = len(self._outputs)
+                    self._fail.append(0)
+                    self._outputs.append(())
+                    children.append([])
+                    children[state].append((code, child))
+                state = child
+            self._outputs[state] += (len(self.terms),)
+            self.terms.append(term)
+
+        # failure links in breadth-first order, so a state's failure target is always complete
+        queue = deque(child for _code, child in children[0])
+        while queue:
+            state = queue.popleft()
+            for code, child in children[state]:
+                fallback = self._fail[state]
+                target = self._goto.get(fallback * ALPHABET + code)
+                while target is None and fallback:
+                    fallback = self._fail[fallback]
+                    target = self._goto.get(fallback * ALPHABET + code)
+                self._fail[child] = target or 0
+                self._outputs[child] += self._outputs[self._fail[child]]
+                queue.append(child)
+
+    @property
+    def states(self) -> int:
+        return len(self._outputs)
+
+    def find(self, text: str) -> list[Match]:
+        """
+        :param text - the text to scan.
+        :return - every occurrence of a term in the text, by end position.
+        """
+        folded = _fold(text)
+        goto, fail, outputs, terms = self._goto.get, self._fail, self._outputs, self.terms
+        matches = []
+        state = 0
+        for end, code in enumerate(map(ord, folded), 1):
+            target = goto(state * ALPHABET + code)
+            while target is None and state:
+                state = fail[state]
+                target = goto(state * ALPHABET + code)
+            state = target or 0
+            for index in outputs[state]:
+                term = terms[index]
+                start = end - len(term.text)
+                if term.word_start and start > 0 and folded[start - 1].isalnum():
+                    continue
+                if term.word_end and end < len(folded) and folded[end].isalnum():
+                    continue
+                matches.append(Match(start, end, term))
+        return matches
+
+class ModerationFilter:
+    """Scans message texts with the current term matcher and applies a chat's moderation policy."""
+
+    def __init__(self):
+        self.matcher = TermMatcher()
+        self.engine: Optional[Engine] = None
+        self.loaded_at: Optional[datetime] = None
+        self.build_ms = 0.0
+        self.reloads = 0
+        self._reload_lock = threading.Lock()
+        self._reload_pending = False
+        self._reloading = False
+        self._stats_lock = threading.Lock()
+        self._scanned = 0
+        self._scan_seconds = 0.0
+        self._actions = dict.fromkeys(POLICIES, 0)
+
+    def replace(self, terms: Iterable[str]) -> TermMatcher:
+        """Compiles a term list and swaps it in; messages being scanned meanwhile use the previous one."""
+        started = time.perf_counter()
+        matcher = TermMatcher(terms)
+        self.build_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.matcher = matcher
+        self.loaded_at = datetime.now()
+        self.reloads += 1
+        logger.info("loaded %s moderation terms in %.1f ms", len(matcher.terms), self.build_ms)
+        return matcher
+
+    def load(self, session: Session) -> TermMatcher:
+        """Loads the term list from the database."""
+        return self.replace(session.exec(select(ModerationTermInDB.term)).all())
+
+    def start(self, engine: Engine):
+        self.engine = engine
+        with Session(engine) as session:
+            self.load(session)
+
+    def reload_in_background(self, *_args):
+        """Reloads the term list on a background thread; reloads requested meanwhile are coalesced into one."""
+        if self.engine is None:
+            return
+        with self._reload_lock:
+            self._reload_pending = True
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, name="moderation-reload", daemon=True).start()
+
+    def moderate(self, text: str, policy: Optional[str] = None, resolve_policy=None) -> Verdict:
+        """
+        :param text - the text of a message.
+        :param policy - the moderation policy of the message's chat.
+        :param resolve_policy - a function returning the policy, only called if the text has a match.
+        :return - the action taken (None if nothing matched), the text to store, and the matched terms.
+        """
+        started = time.perf_counter()
+        matches = self.matcher.find(text)
+        elapsed = time.perf_counter() - started
+        action = None
+        if matches:
+            action = policy or resolve_policy()
+        with self._stats_lock:
+            self._scanned += 1
+            self._scan_seconds += elapsed
+            if action is not None:
+                self._actions[action] += 1
+        if action is None:
+            return Verdict(None, text, [])
+
+        terms = sorted({match.term.text for match in matches})
+        if action == "mask":
+            text = _mask(text, matches)
+        return Verdict(action, text, terms)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "terms": len(self.matcher.terms),
+                "states": self.matcher.states,
+                "loaded_at": self.loaded_at,
+                "build_ms": self.build_ms,
+                "reloads": self.reloads,
+                "scanned": self._scanned,
+                "mean_scan_us": round(self._scan_seconds / self._scanned * 1e6, 1) if self._scanned else None,
+                "actions": dict(self._actions),
+            }
+
+    def _reload(self):
+        while True:
+            with self._reload_lock:
+                if not self._reload_pending:
+                    self._reloading = False
+                    return
+                self._reload_pending = False
+            try:
+                with Session(self.engine) as session:
+                    self.load(session)
+            except Exception:
+                logger.exception("reloading moderation terms failed")
+
+def _fold(text: str) -> str:
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    # a few characters lower-case to several ('İ'), which would shift the match positions
+    return "".join(lower if len(lower := char.lower()) == 1 else char for char in text)
+
+def _mask(text: str, matches: list[Match]) -> str:
+    characters = list(text)
+    for match in matches:
+        characters[match.start:match.end] = MASK * (match.end - match.start)
+    return "".join(characters)
+
+def benchmark(term_count: int, message_count: int = 2000, message_length: int = 200, seed: int = 0) -> dict:
+    """
+    Measures the matcher on random words against a naive scan testing each term in turn.
+
+    :param term_count - the number of banned terms.
+    :param message_count - the number of messages scanned.
+    :param message_length - the approximate length of each message in characters.
+    :return - the build time, and the scan throughput of both the matcher and the naive scan.
+    """
+    generator = random.Random(seed)
+
+    def word() -> str:
+        return "".join(generator.choices(string.ascii_lowercase, k=generator.randint(3, 9)))
+
+    terms = [word() for _ in range(term_count)]
+    messages = []
+    for _ in range(message_count):
+        words = []
+        while sum(map(len, words)) + len(words) < message_length:
+            words.append(generator.choice(terms) if generator.random() < 0.01 else word())
+        messages.append(" ".join(words))
+    characters = sum(map(len, messages))
+
+    started = time.perf_counter()
+    matcher = TermMatcher(terms)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matched = sum(1 for message in messages if matcher.find(message))
+    scan_seconds = time.perf_counter() - started
+
+    # the naive scan is far slower, so it is timed on a sample
+    sample = messages[:max(1, min(len(messages), 200_000 // max(term_count, 1)))]
+    started = time.perf_counter()
+    for message in sample:
+        folded = message.lower()
+        [term for term in terms if term in folded]
+    naive_seconds = (time.perf_counter() - started) / len(sample) * len(messages)
+
+    return {
+        "terms": term_count,
+        "states": matcher.states,
+        "build_ms": round(build_seconds * 1000, 1),
+        "messages": message_count,
+        "matched_messages": matched,
+        "chars_per_second": round(characters / scan_seconds),
+        "us_per_message": round(scan_seconds / message_count * 1e6, 1),
+        "naive_us_per_message": round(naive_seconds / message_count * 1e6, 1),
+    }
+
+moderation_filter = ModerationFilter()
+events.subscribe("moderation_terms", moderation_filter.reload_in_background)
+events.subscribe_reset(moderation_filter.reload_in_background)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the moderation term matcher.")
+    parser.add_argument("--terms", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="the term list sizes to benchmark")
+    parser.add_argument("--messages", type=int, default=2000, help="the number of messages scanned per size")
+    parser.add_argument("--length", type=int, default=200, help="the length of each message in characters")
+    args = parser.parse_args()
+
+    for term_count in args.terms:
+        result = benchmark(term_count, args.messages, args.length)
+        print(f"{result['terms']:>7} terms  build {result['build_ms']:>8.1f} ms  "
+              f"{result['chars_per_second'] / 1e6:6.2f} M chars/s  {result['us_per_message']:>7.1f} us/message  "
+              f"(naive {result['naive_us_per_message']:.1f} us/message)")
+
+if __name__ == "__main__":
+    main()
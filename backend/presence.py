@@ -0,0 +1,206 @@
+## This class contains the in-memory presence service for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# "Online" and "typing" state is short-lived and rewritten every few seconds by every client, so it
+# never touches SQLite. Each heartbeat or typing report (re)schedules the key on a hashed timer
+# wheel: one slot per second, each slot a dict of the keys that expire in it. Scheduling, cancelling
+# and expiring a key are O(1), and the wheel is advanced lazily on access, so no thread scans it.
+#
+# Chat membership, needed to decide who may see a chat's presence, is cached per chat and dropped
+# through the invalidation bus when memberships change, so the presence routes only query the
+# database the first time a chat is seen.
+#
+# Presence is kept per server process. Deployments with several workers need sticky routing of
+# the presence routes (e.g. by user id) for every client to see the same state.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, Optional
+
+from backend import events
+
+presence_ttl = int(os.environ.get("PRESENCE_TTL_SECONDS", default="30"))
+typing_ttl = int(os.environ.get("TYPING_TTL_SECONDS", default="6"))
+max_keys = int(os.environ.get("PRESENCE_MAX_KEYS", default="200000"))
+max_cached_chats = int(os.environ.get("PRESENCE_MEMBER_CACHE_CHATS", default="10000"))
+
+class TimerWheel:
+    """
+    A hashed timer wheel with one-second slots. Keys must not be scheduled further ahead than the
+    number of slots, so every entry of a slot is due when the wheel reaches it.
+    """
+
+    def __init__(self, slots: int, on_expire: Callable[[Hashable], None], clock: Callable[[], float]):
+        self.slots = slots
+        self._wheel: list[dict[Hashable, int]] = [{} for _ in range(slots)]
+        self._deadlines: dict[Hashable, int] = {}
+        self._on_expire = on_expire
+        self._clock = clock
+        self._tick = int(clock())
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def schedule(self, key: Hashable, ttl: int):
+        if not 0 < ttl < self.slots:
+            raise ValueError(f"ttl must be between 1 and {self.slots - 1} seconds")
+        self.cancel(key)
+        deadline = self._tick + ttl
+        self._deadlines[key] = deadline
+        self._wheel[deadline % self.slots][key] = deadline
+
+    def cancel(self, key: Hashable):
+        deadline = self._deadlines.pop(key, None)
+        if deadline is not None:
+            del self._wheel[deadline % self.slots][key]
+
+    def advance(self):
+        """Expires every key whose deadline has passed."""
+        now = int(self._clock())
+        # after an idle period longer than one rotation, every slot is visited once
+        for tick in range(max(self._tick + 1, now - self.slots + 1), now + 1):
+            slot = self._wheel[tick % self.slots]
+            if slot:
+                expired = list(slot)
+                slot.clear()
+                for key in expired:
+                    del self._deadlines[key]
+                    self._on_expire(key)
+        self._tick = max(self._tick, now)
+
+class PresenceService:
+    """Tracks online users and per-chat typing users with automatic expiry; every operation is O(1) per user."""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, max_keys: int = max_keys,
+                 max_cached_chats: int = max_cached_chats):
+        self.max_keys = max_keys
+        self.max_cached_chats = max_cached_chats
+        self._wheel = TimerWheel(max(presence_ttl, typing_ttl) + 2, self._expire, clock)
+        self._typing: dict[int, set[int]] = {}
+        self._members: OrderedDict[int, frozenset[int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def heartbeat(self, user_id: int) -> bool:
+        """
+        Marks a user as online for the presence TTL.
+
+        :param user_id - id of the user.
+        :return - False if the service is at capacity and the heartbeat was dropped.
+        """
+        with self._lock:
+            self._wheel.advance()
+            return self._schedule(("online", user_id), presence_ttl)
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool) -> bool:
+        """
+        Marks a user as typing in a chat for the typing TTL, or clears the mark. Typing counts as a heartbeat.
+
+        :param chat_id - id of the chat.
+        :param user_id - id of the user.
+        :param typing - whether the user is typing.
+        :return - False if the service is at capacity and the report was dropped.
+        """
+        with self._lock:
+            self._wheel.advance()
+            key = ("typing", chat_id, user_id)
+            if not typing:
+                self._wheel.cancel(key)
+                self._expire(key)
+                return True
+            if not self._schedule(key, typing_ttl):
+                return False
+            self._typing.setdefault(chat_id, set()).add(user_id)
+            return self._schedule(("online", user_id), presence_ttl)
+
+    def online(self, user_ids: Iterable[int]) -> list[int]:
+        """
+        :param user_ids - ids of the users to check.
+        :return - the given users that are online, in ascending order.
+        """
+        with self._lock:
+            self._wheel.advance()
+            return sorted(user_id for user_id in user_ids if ("online", user_id) in self._wheel)
+
+    def typing(self, chat_id: int) -> list[int]:
+        """
+        :param chat_id - id of the chat.
+        :return - the users typing in the chat, in ascending order.
+        """
+        with self._lock:
+            self._wheel.advance()
+            return sorted(self._typing.get(chat_id, ()))
+
+    def get_members(self, chat_id: int) -> Optional[frozenset[int]]:
+        """
+        :param chat_id - id of the chat.
+        :return - the cached member ids of the chat, or None if they are not cached.
+        """
+        with self._lock:
+            members = self._members.get(chat_id)
+            if members is not None:
+                self._members.move_to_end(chat_id)
+            return members
+
+    def cache_members(self, chat_id: int, members: Iterable[int]) -> frozenset[int]:
+        members = frozenset(members)
+        with self._lock:
+            self._members[chat_id] = members
+            self._members.move_to_end(chat_id)
+            while len(self._members) > self.max_cached_chats:
+                self._members.popitem(last=False)
+        return members
+
+    def invalidate_members(self, chat_id: int):
+        with self._lock:
+            self._members.pop(chat_id, None)
+
+    def clear_members(self):
+        with self._lock:
+            self._members.clear()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._wheel._deadlines):
+                self._wheel.cancel(key)
+            self._typing.clear()
+            self._members.clear()
+            self.dropped = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._wheel.advance()
+            return {
+                "tracked_keys": len(self._wheel),
+                "max_keys": self.max_keys,
+                "typing_chats": len(self._typing),
+                "cached_chats": len(self._members),
+                "dropped": self.dropped,
+            }
+
+    def _schedule(self, key: tuple, ttl: int) -> bool:
+        if key not in self._wheel and len(self._wheel) >= self.max_keys:
+            self.dropped += 1
+            return False
+        self._wheel.schedule(key, ttl)
+        return True
+
+    def _expire(self, key: tuple):
+        if key[0] == "typing":
+            _, chat_id, user_id = key
+            typing = self._typing.get(chat_id)
+            if typing is not None:
+                typing.discard(user_id)
+                if not typing:
+                    del self._typing[chat_id]
+
+presence = PresenceService()
+
+events.subscribe("membership", presence.invalidate_members)
+events.subscribe("chat", presence.invalidate_members)
+events.subscribe_reset(presence.clear_members)
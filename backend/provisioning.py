@@ -0,0 +1,255 @@
+## This class contains bulk user provisioning for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Onboarding creates thousands of accounts from a CSV (with a "username,email,password" header)
+# or NDJSON file. Registering them one at a time costs a duplicate check, a bcrypt hash and a
+# commit per account, and bcrypt is CPU-bound, so a single process hashes a few accounts per
+# second. Here rows are handled in batches: one query per batch finds taken usernames and emails,
+# the passwords of the batch are hashed in parallel on a process pool using every core, and the
+# accounts are created with one insert per batch. Rows that cannot be created are reported with
+# their row number and the reason, and the run reports its rate in accounts per second.
+#
+# Uploads are spooled to a private file for the "provision_users" job, whose parameters only hold
+# the file's path, so passwords never reach the jobs table. The file is deleted when the job ends.
+# Files are read as UTF-8 with an optional byte order mark, which spreadsheet programs add to CSV exports.
+
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterable, Iterator, Optional, TextIO
+
+from sqlmodel import Session
+
+from backend import auth, jobs
+from backend import database as db
+
+logger = logging.getLogger(__name__)
+
+provision_dir = os.environ.get("PROVISION_DIR", default="backend/provisioning")
+max_bytes = int(os.environ.get("PROVISION_MAX_BYTES", default=str(50 * 1024 * 1024)))
+batch_size = int(os.environ.get("PROVISION_BATCH_SIZE", default="500"))
+hash_workers = int(os.environ.get("PROVISION_WORKERS", default=str(os.cpu_count() or 1)))
+FORMATS = ("csv", "ndjson")
+FIELDS = ("username", "email", "password")
+# rows with errors beyond this many are counted but not listed
+MAX_REPORTED_ERRORS = 1000
+
+@dataclass
+class ProvisioningReport:
+    rows: int = 0
+    created: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    errors: list[dict] = field(default_factory=list)
+
+    @property
+    def accounts_per_second(self) -> Optional[float]:
+        return round(self.created / self.seconds, 1) if self.seconds else None
+
+    def add_error(self, row: int, username: Optional[str], error: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "username": username, "error": error})
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "accounts_per_second": self.accounts_per_second}
+
+    @classmethod
+    def from_dict(cls, values: Optional[dict]) -> "ProvisioningReport":
+        values = dict(values or {})
+        values.pop("accounts_per_second", None)
+        return cls(**values)
+
+def read_rows(file: TextIO, format: str) -> Iterator[tuple[int, Optional[dict]]]:
+    """
+    :param file - the CSV or NDJSON file, opened as text.
+    :param format - "csv" or "ndjson".
+    :return - the row number and the values of each row; the values are None for a row that is not a JSON object.
+    """
+    if format == "csv":
+        for number, values in enumerate(csv.DictReader(file), 1):
+            yield number, values
+        return
+
+    number = 0
+    for line in file:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            values = json.loads(line)
+        except ValueError:
+            values = None
+        yield number, values if isinstance(values, dict) else None
+
+def provision(rows: Iterable[tuple[int, Optional[dict]]], session: Session, workers: Optional[int] = None,
+              size: Optional[int] = None, report: Optional[ProvisioningReport] = None,
+              on_batch: Optional[Callable[[ProvisioningReport], None]] = None,
+              executor: Optional[Executor] = None) -> ProvisioningReport:
+    """
+    Creates an account for every valid row, a batch at a time.
+
+    :param rows - the row numbers and values, as returned by 'read_rows'.
+    :param session - a Session object for database retrieval.
+    :param workers - the number of processes hashing passwords.
+    :param size - the number of rows per batch.
+    :param report - the report of an interrupted run to continue, if any.
+    :param on_batch - called with the report after each committed batch.
+    :param executor - the pool hashing passwords, instead of a new process pool.
+    :return - the number of rows read and accounts created, the rows that failed and the rate.
+    """
+    workers = workers or hash_workers
+    size = size or batch_size
+    report = report or ProvisioningReport()
+    # forking a server process would copy its threads, locks and open database connections
+    pool = executor or ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+    seen_usernames, seen_emails = set(), set()
+    try:
+        for batch in _batches(rows, size):
+            started = time.perf_counter()
+            _provision_batch(batch, session, pool, workers, report, seen_usernames, seen_emails)
+            report.rows += len(batch)
+            report.seconds = round(report.seconds + time.perf_counter() - started, 3)
+            if on_batch is not None:
+                on_batch(report)
+    finally:
+        if executor is None:
+            pool.shutdown()
+    logger.info("provisioned %s of %s accounts in %.1f s (%s accounts/s)", report.created, report.rows,
+                report.seconds, report.accounts_per_second)
+    return report
+
+def _provision_batch(batch: list[tuple[int, Optional[dict]]], session: Session, pool: Executor, workers: int,
+                     report: ProvisioningReport, seen_usernames: set[str], seen_emails: set[str]):
+    candidates = []
+    for number, values in batch:
+        if values is None:
+            report.add_error(number, None, "invalid_row")
+            continue
+        username = values.get("username")
+        missing = [name for name in FIELDS if not isinstance(values.get(name), str) or not values[name].strip()]
+        if missing:
+            report.add_error(number, username if isinstance(username, str) else None, f"missing_{missing[0]}")
+        elif "@" not in values["email"]:
+            report.add_error(number, username, "invalid_email")
+        elif username in seen_usernames:
+            report.add_error(number, username, "duplicate_username")
+        elif values["email"] in seen_emails:
+            report.add_error(number, username, "duplicate_email")
+        else:
+            seen_usernames.add(username)
+            seen_emails.add(values["email"])
+            candidates.append((number, values))
+
+    taken_usernames, taken_emails = db.get_taken_usernames_and_emails(
+        [values["username"] for _, values in candidates], [values["email"] for _, values in candidates], session
+    )
+    accepted = []
+    for number, values in candidates:
+        if values["username"] in taken_usernames:
+            report.add_error(number, values["username"], "duplicate_username")
+        elif values["email"] in taken_emails:
+            report.add_error(number, values["username"], "duplicate_email")
+        else:
+            accepted.append((number, values))
+    if not accepted:
+        return
+
+    passwords = [values["password"] for _, values in accepted]
+    hashes = pool.map(auth.hash_password, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+    created = db.create_users([
+        {"username": values["username"], "email": values["email"], "hashed_password": hashed_password}
+        for (_, values), hashed_password in zip(accepted, hashes)
+    ], session)
+    report.created += len(created)
+    # accounts whose username or email was registered since the check
+    created_usernames = {username for _, username in created}
+    for number, values in accepted:
+        if values["username"] not in created_usernames:
+            report.add_error(number, values["username"], "duplicate_username_or_email")
+
+def _batches(rows: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def create_spool(format: str) -> str:
+    """Creates an empty file readable only by this user, for an uploaded user list, and returns its path."""
+    os.makedirs(provision_dir, exist_ok=True)
+    path = os.path.join(provision_dir, f"{uuid.uuid4().hex}.{format}")
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    return path
+
+def format_of(filename_or_content_type: str) -> Optional[str]:
+    """Guesses the format of a user list from its file name or content type."""
+    value = filename_or_content_type.lower()
+    if value.endswith(".csv") or "csv" in value:
+        return "csv"
+    if value.endswith((".ndjson", ".jsonl")) or "ndjson" in value or "jsonl" in value:
+        return "ndjson"
+    return None
+
+def _run_provision_users_job(context: jobs.JobContext):
+    path, format = context.params["path"], context.params["format"]
+    report = ProvisioningReport.from_dict(context.checkpoint)
+    try:
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            total = sum(1 for _ in read_rows(file, format))
+        context.progress(report.rows, total)
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            provision(itertools.islice(read_rows(file, format), report.rows, None), context.session, report=report,
+                      on_batch=lambda report: context.progress(report.rows, checkpoint=report.to_dict()))
+    except jobs.JobInterrupted:
+        # the file is kept, so the job resumes after the last committed batch
+        raise
+    except BaseException:
+        remove_spool(path)
+        raise
+    remove_spool(path)
+
+def remove_spool(path: str):
+    """Deletes an uploaded user list, if it still exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+jobs.register("provision_users", _run_provision_users_job)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create user accounts in bulk from a CSV or NDJSON file.")
+    parser.add_argument("path", help="a CSV file with a username,email,password header, or an NDJSON file")
+    parser.add_argument("--format", choices=FORMATS, help="the file format; guessed from the extension by default")
+    parser.add_argument("--workers", type=int, default=hash_workers, help="the number of processes hashing passwords")
+    parser.add_argument("--batch-size", type=int, default=batch_size, help="the number of rows per transaction")
+    args = parser.parse_args()
+
+    format = args.format or format_of(args.path)
+    if format is None:
+        parser.error("cannot tell the format from the file name, pass --format")
+
+    from backend.database import create_db_and_tables, engine
+    create_db_and_tables()
+
+    def print_progress(report: ProvisioningReport):
+        print(f"{report.rows} rows, {report.created} created, {report.failed} failed, "
+              f"{report.accounts_per_second} accounts/s")
+
+    with open(args.path, newline="", encoding="utf-8-sig") as file, Session(engine) as session:
+        report = provision(read_rows(file, format), session, args.workers, args.batch_size, on_batch=print_progress)
+    for error in report.errors:
+        print(f"row {error['row']}: {error['error']} ({error['username']})")
+    if report.failed > len(report.errors):
+        print(f"... and {report.failed - len(report.errors)} more failed rows")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+## This class contains the slow-query analyzer for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# In diagnostics mode every statement the engine sends to SQLite is timed through SQLAlchemy's cursor
+# events. Statements slower than the threshold are grouped by fingerprint, i.e. the statement with
+# its literals and IN lists collapsed, so 'WHERE id IN (?, ?, ?)' and 'WHERE id IN (?)' count as one.
+# The first sample of each fingerprint keeps its parameters, with long or secret-looking values redacted,
+# and the 'EXPLAIN QUERY PLAN' output, run
+# on the same connection, whose rows are reduced to flags such as SCAN (a full table scan) or
+# TEMP B-TREE (a sort without a usable index).
+#
+# The aggregate is kept per server process, bounded by the number of fingerprints, and is logged
+# periodically by a reporter thread while the analyzer is enabled.
+
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+enabled = os.environ.get("QUERY_ANALYZER", default="0") == "1"
+threshold_ms = float(os.environ.get("SLOW_QUERY_MS", default="100"))
+report_interval = float(os.environ.get("QUERY_REPORT_SECONDS", default="300"))
+max_fingerprints = int(os.environ.get("QUERY_MAX_FINGERPRINTS", default="500"))
+# number of fingerprints written to the log by each periodic report
+REPORT_TOP = 10
+# longest string parameter kept in a sample; longer ones (message texts, tokens) only keep their length
+MAX_PARAMETER_LENGTH = 32
+# parameters that look like password hashes, e.g. '$2b$12$...', are never kept
+SECRET_PARAMETER = re.compile(r"^\$[\w-]+\$")
+# named parameters whose values are never kept
+SECRET_NAMES = ("password", "token", "secret")
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+VALUES_LIST = re.compile(r"(\(\?\.\.\.\))(?:\s*,\s*\(\?\.\.\.\))+")
+WHITESPACE = re.compile(r"\s+")
+
+# 'EXPLAIN QUERY PLAN' detail prefixes and the flag each one raises
+PLAN_FLAGS = (
+    ("SCAN", "SCAN"),
+    ("SEARCH", "SEARCH"),
+    ("USE TEMP B-TREE", "TEMP B-TREE"),
+    ("AUTOMATIC", "AUTOMATIC INDEX"),
+    ("CORRELATED", "CORRELATED SUBQUERY"),
+)
+
+def fingerprint(statement: str) -> str:
+    """
+    Normalizes a statement so that executions differing only in literals or list lengths match.
+
+    :param statement - the SQL sent to the database.
+    """
+    statement = STRING_LITERAL.sub("?", statement)
+    statement = NUMBER_LITERAL.sub("?", statement)
+    statement = PLACEHOLDER_LIST.sub("(?...)", statement)
+    statement = VALUES_LIST.sub(r"\1", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+def plan_flags(plan: list[str]) -> list[str]:
+    """
+    :param plan - the detail column of each 'EXPLAIN QUERY PLAN' row.
+    :return - the flags raised by the plan, in alphabetical order.
+    """
+    flags = set()
+    for detail in plan:
+        for prefix, flag in PLAN_FLAGS:
+            if detail.startswith(prefix):
+                flags.add(flag)
+    return sorted(flags)
+
+class QueryAnalyzer:
+    """Aggregates statements slower than a threshold by fingerprint, with one explained sample each."""
+
+    def __init__(self, threshold_ms: float = threshold_ms, enabled: bool = enabled,
+                 max_fingerprints: int = max_fingerprints):
+        self.threshold_ms = threshold_ms
+        self.enabled = enabled
+        self.max_fingerprints = max_fingerprints
+        self._queries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.statements = 0
+        self.slow_statements = 0
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def install(self, engine: Engine):
+        """
+        Times every statement executed by the engine.
+
+        :param engine - the Engine to analyze.
+        """
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._on_error)
+
+    def record(self, statement: str, parameters, elapsed_ms: float, cursor=None):
+        """
+        Adds a slow statement to the aggregate.
+
+        :param statement - the SQL sent to the database.
+        :param parameters - the parameters it was executed with.
+        :param elapsed_ms - the execution time in milliseconds.
+        :param cursor - the DBAPI cursor it ran on, used to explain the first sample of a fingerprint.
+        """
+        key = fingerprint(statement)
+        with self._lock:
+            self.slow_statements += 1
+            query = self._queries.get(key)
+            if query is None and len(self._queries) >= self.max_fingerprints:
+                self.dropped += 1
+                return
+            explain = query is None
+
+        # explained outside the lock; a concurrent first sample of the same fingerprint is explained twice at worst
+        plan = self._explain(cursor, statement, parameters) if explain and cursor is not None else []
+
+        with self._lock:
+            query = self._queries.setdefault(key, {
+                "fingerprint": key,
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "sample_statement": statement,
+                "sample_parameters": _summarize_parameters(parameters),
+                "plan": plan,
+                "flags": plan_flags(plan),
+            })
+            query["count"] += 1
+            query["total_ms"] += elapsed_ms
+            query["max_ms"] = max(query["max_ms"], elapsed_ms)
+
+    def queries(self, limit: Optional[int] = None) -> list[dict]:
+        """
+        :param limit - the maximum number of fingerprints returned.
+        :return - the aggregated fingerprints, by descending total time.
+        """
+        with self._lock:
+            queries = [{**query, "avg_ms": query["total_ms"] / query["count"]} for query in self._queries.values()]
+        queries.sort(key=lambda query: query["total_ms"], reverse=True)
+        return queries[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self.statements = 0
+            self.slow_statements = 0
+            self.dropped = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "threshold_ms": self.threshold_ms,
+                "statements": self.statements,
+                "slow_statements": self.slow_statements,
+                "fingerprints": len(self._queries),
+                "max_fingerprints": self.max_fingerprints,
+                "dropped": self.dropped,
+            }
+
+    def start_reporter(self, interval: float = report_interval):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._report_loop, args=(interval,), name="query-analyzer",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop_reporter(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def report(self):
+        """Logs the fingerprints with the highest total time."""
+        for query in self.queries(REPORT_TOP):
+            logger.warning("slow query x%d total %.1f ms avg %.1f ms max %.1f ms [%s]: %s",
+                           query["count"], query["total_ms"], query["avg_ms"], query["max_ms"],
+                           ", ".join(query["flags"]), query["fingerprint"])
+
+    def _report_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            if self.enabled:
+                self.report()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("query_started")
+        if not started:
+            # the analyzer was enabled while this statement ran
+            return
+        elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+        with self._lock:
+            self.statements += 1
+        if elapsed_ms >= self.threshold_ms:
+            if executemany:
+                parameters = parameters[0] if parameters else ()
+            self.record(statement, parameters, elapsed_ms, cursor)
+
+    def _on_error(self, context):
+        # a statement that raised never reaches 'after_cursor_execute', so its start time is dropped here
+        connection = context.connection
+        started = connection.info.get("query_started") if connection is not None else None
+        if started and context.statement is not None:
+            started.pop()
+
+    def _explain(self, cursor, statement: str, parameters) -> list[str]:
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return []
+        try:
+            # a separate DBAPI cursor bypasses the engine's events, so explaining is never analyzed itself
+            rows = cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        except Exception:
+            logger.debug("could not explain %s", statement, exc_info=True)
+            return []
+        return [row[-1] for row in rows]
+
+def _summarize_parameters(parameters) -> list:
+    if isinstance(parameters, dict):
+        return [_redact(value, name) for name, value in parameters.items()]
+    return [_redact(value) for value in parameters or ()]
+
+def _redact(value, name: str = "") -> str:
+    if isinstance(value, (str, bytes)):
+        if any(secret in name.lower() for secret in SECRET_NAMES) or (
+                isinstance(value, str) and SECRET_PARAMETER.match(value)):
+            return "<redacted>"
+        if len(value) > MAX_PARAMETER_LENGTH:
+            return f"<{type(value).__name__} of {len(value)} characters>"
+    return repr(value)
+
+query_analyzer = QueryAnalyzer()
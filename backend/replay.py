@@ -0,0 +1,346 @@
+## This class contains the traffic replay tool for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Replays a session captured by 'backend/capture.py' against a local instance. The trace's ids are
+# pseudonyms, so the replay first rebuilds a matching synthetic dataset: a user for every user in
+# the trace, a chat for every chat, owned by the first user who used it and joined by the users who
+# used it before anyone added them, and a message for every message the trace refers to (written by
+# the user who edited or deleted it), on top of a number of seed messages per chat.
+#
+# Requests are then sent at the captured offsets, divided by the speed-up, with the same open-loop
+# arrivals and latency statistics as 'backend/loadtest.py'. Bodies are synthesized at their captured
+# size. Requests that cannot be rebuilt without the data the capture leaves out (e.g. uploads and
+# profile changes) are skipped and counted, and replayed statuses that differ from the captured
+# ones are reported per route.
+#
+#   python -m backend.replay backend/traffic/capture.ndjson --speed 10
+#   python -m backend.replay trace.ndjson --target http://127.0.0.1:8000 --speed 1 --json
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+from backend import capture, loadtest
+from backend.loadtest import RouteStats, VirtualUser
+
+PATH_PARAMETER = re.compile(r"\{(\w+)\}")
+MEMBERSHIP_ROUTES = ("PUT /chats/{chat_id}/users/{user_id}", "DELETE /chats/{chat_id}/users/{user_id}")
+MESSAGE_OWNER_ROUTES = ("PUT /chats/{chat_id}/messages/{message_id}", "DELETE /chats/{chat_id}/messages/{message_id}")
+# the size of the JSON around a message text or chat name, e.g. '{"text": ""}'
+BODY_OVERHEAD = 12
+
+@dataclass
+class TraceRecord:
+    offset_ms: float
+    route: str
+    path_ids: dict
+    query: list
+    user: Optional[int]
+    request_bytes: int
+    status: int
+    response_bytes: int
+    duration_ms: float
+
+@dataclass
+class DatasetPlan:
+    """The synthetic users, chats and messages a trace needs, by their trace ids."""
+    users: list[int] = field(default_factory=list)
+    # chat -> (owner, initial members including the owner)
+    chats: dict[int, tuple[int, list[int]]] = field(default_factory=dict)
+    # message -> (chat, author)
+    messages: dict[int, tuple[int, int]] = field(default_factory=dict)
+
+@dataclass
+class Dataset:
+    """The real ids the trace ids were mapped to."""
+    users: dict[int, VirtualUser] = field(default_factory=dict)
+    chats: dict[int, int] = field(default_factory=dict)
+    messages: dict[int, int] = field(default_factory=dict)
+
+def read_sessions(path: str) -> list[list[TraceRecord]]:
+    """
+    Reads the capture sessions of a trace file.
+
+    :param path - the trace file written by the traffic capture.
+    :return - the records of each session, in the order they were captured.
+    """
+    sessions = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                if record.get("version") != capture.FORMAT_VERSION:
+                    raise ValueError(f"unsupported trace version {record.get('version')}")
+                sessions.append([])
+            elif sessions:
+                sessions[-1].append(TraceRecord(*record))
+    return sessions
+
+def plan_dataset(records: list[TraceRecord]) -> DatasetPlan:
+    """
+    Works out the users, chats and messages that must exist for the trace to replay like it was
+    captured. A user who first appears in a chat by being added to it, or whose requests to it
+    failed, is not an initial member.
+    """
+    plan = DatasetPlan()
+    users, chats, added = {}, {}, set()
+
+    def use_user(user: Optional[int]):
+        if user is not None:
+            users.setdefault(user, None)
+
+    for record in records:
+        use_user(record.user)
+        for name, value in record.query:
+            if name == "ids" and value:
+                for user in value.split(","):
+                    use_user(int(user))
+        chat = record.path_ids.get("chat_id")
+        target = record.path_ids.get("user_id")
+        use_user(target)
+        if chat is None:
+            continue
+
+        # only requests that succeeded show that their user could access the chat
+        user = record.user if record.status < 400 else None
+        owner, members = chats.setdefault(chat, (user, []))
+        if owner is None and user is not None:
+            chats[chat] = (user, members)
+        if record.route in MEMBERSHIP_ROUTES and target not in members:
+            added.add((chat, target))
+        if user is not None and user not in members and (chat, user) not in added:
+            members.append(user)
+
+        message = record.path_ids.get("message_id")
+        for name, value in record.query:
+            if name == "before" and value:
+                message = message or int(value)
+        if message is not None and message not in plan.messages:
+            author = user if record.route in MESSAGE_OWNER_ROUTES else None
+            plan.messages[message] = (chat, author)
+
+    plan.users = list(users)
+    for chat, (owner, members) in chats.items():
+        owner = owner if owner is not None else (plan.users[0] if plan.users else None)
+        if owner is None:
+            continue
+        plan.chats[chat] = (owner, [owner] + [member for member in members if member != owner])
+    for message, (chat, author) in list(plan.messages.items()):
+        if chat not in plan.chats:
+            del plan.messages[message]
+            continue
+        owner, members = plan.chats[chat]
+        if author is not None and author not in members:
+            members.append(author)
+        plan.messages[message] = (chat, author if author is not None else owner)
+    return plan
+
+# ---------- setup ----------- #
+async def build_dataset(client: httpx.AsyncClient, plan: DatasetPlan, messages_per_chat: int, text_size: int,
+                        concurrency: int, prefix: str, rng: random.Random) -> Dataset:
+    """
+    Creates the planned users, chats and messages through the API.
+
+    :param messages_per_chat - the number of seed messages written to every chat before the referenced ones.
+    :param text_size - the length of seed message texts.
+    :param prefix - a prefix making the usernames unique to this replay.
+    """
+    dataset = Dataset()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create_user(user: int):
+        username = f"{prefix}-{user}"
+        async with semaphore:
+            user_id, headers = await loadtest.register_user(client, username)
+        dataset.users[user] = VirtualUser(id=user_id, username=username, headers=headers)
+
+    await asyncio.gather(*(create_user(user) for user in plan.users))
+
+    async def create_chat(chat: int, owner: VirtualUser, members: list[VirtualUser]):
+        async with semaphore:
+            response = await client.post("/chats", json={"name": f"replay {chat}"}, headers=owner.headers)
+            response.raise_for_status()
+            chat_id = dataset.chats[chat] = response.json()["chat"]["id"]
+            for member in members:
+                await client.put(f"/chats/{chat_id}/users/{member.id}", headers=owner.headers)
+            for _ in range(messages_per_chat):
+                author = rng.choice([owner] + members)
+                await client.post(f"/chats/{chat_id}/messages", json={"text": "x" * text_size}, headers=author.headers)
+
+    await asyncio.gather(*(
+        create_chat(chat, dataset.users[owner], [dataset.users[member] for member in members if member != owner])
+        for chat, (owner, members) in plan.chats.items()
+    ))
+
+    # referenced messages are written in trace order, so older trace ids get older messages
+    for message, (chat, author) in sorted(plan.messages.items()):
+        response = await client.post(f"/chats/{dataset.chats[chat]}/messages", json={"text": "x" * text_size},
+                                     headers=dataset.users[author].headers)
+        response.raise_for_status()
+        dataset.messages[message] = response.json()["message"]["id"]
+    return dataset
+
+# ---------- traffic ----------- #
+def build_request(record: TraceRecord, dataset: Dataset, rng: random.Random, prefix: str) -> Optional[dict]:
+    """
+    Rebuilds the request of a trace record against the dataset.
+
+    :return - the arguments of 'httpx.AsyncClient.request', or None if the request cannot be rebuilt.
+    """
+    method, _, template = record.route.partition(" ")
+    user = dataset.users.get(record.user)
+    real_ids = {"chat_id": dataset.chats, "message_id": dataset.messages,
+                "user_id": {trace: user.id for trace, user in dataset.users.items()}}
+
+    path = template
+    for name in PATH_PARAMETER.findall(template):
+        real_id = real_ids.get(name, {}).get(record.path_ids.get(name))
+        if real_id is None:
+            return None
+        path = path.replace(f"{{{name}}}", str(real_id))
+
+    params = []
+    for name, value in record.query:
+        if name == "q":
+            params.append((name, (user or rng.choice(list(dataset.users.values()))).username[:3]))
+        elif name == "before" and value:
+            if int(value) not in dataset.messages:
+                return None
+            params.append((name, str(dataset.messages[int(value)])))
+        elif name == "ids" and value:
+            params.append((name, ",".join(str(real_ids["user_id"].get(int(part), 0)) for part in value.split(","))))
+        elif value is not None:
+            params.append((name, value))
+
+    request = {"method": method, "url": path, "params": params, "headers": user.headers if user else {}}
+    size = max(1, record.request_bytes - BODY_OVERHEAD)
+    if record.route in ("POST /chats/{chat_id}/messages", "PUT /chats/{chat_id}/messages/{message_id}"):
+        request["json"] = {"text": "x" * size}
+    elif record.route in ("POST /chats", "PUT /chats/{chat_id}"):
+        request["json"] = {"name": "x" * size}
+    elif record.route == "PUT /chats/{chat_id}/typing":
+        request["json"] = {"typing": True}
+    elif record.route == "POST /auth/token":
+        login = user or rng.choice(list(dataset.users.values()))
+        request["data"] = {"username": login.username, "password": login.username}
+    elif record.route == "POST /auth/registration":
+        username = f"{prefix}-new-{rng.randrange(10 ** 9)}"
+        request["json"] = {"username": username, "email": f"{username}@loadtest.invalid", "password": username}
+    elif method in ("POST", "PUT") and record.request_bytes:
+        # e.g. uploads and profile changes, whose bodies the capture does not keep
+        return None
+    return request
+
+async def replay(client: httpx.AsyncClient, records: list[TraceRecord], dataset: Dataset, speed: float,
+                 rng: random.Random, prefix: str) -> tuple[dict[str, RouteStats], dict, float]:
+    """
+    Sends the requests of a trace at their captured offsets divided by 'speed', with open-loop arrivals.
+
+    :return - the per-route statistics, the per-route numbers of skipped requests and of statuses
+    that differ from the captured ones, and the measured wall-clock duration of the replay.
+    """
+    stats: dict[str, RouteStats] = defaultdict(RouteStats)
+    outcomes = defaultdict(lambda: {"skipped": 0, "status_mismatches": 0})
+    start_offset = records[0].offset_ms if records else 0.0
+
+    async def fire(scheduled: float, record: TraceRecord, request: dict):
+        try:
+            response = await client.request(**request)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = None
+        stats[record.route].record((time.perf_counter() - scheduled) * 1000, status)
+        if status != record.status:
+            outcomes[record.route]["status_mismatches"] += 1
+
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        request = build_request(record, dataset, rng, prefix)
+        if request is None:
+            outcomes[record.route]["skipped"] += 1
+            continue
+        scheduled = started + (record.offset_ms - start_offset) / 1000 / speed
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(fire(scheduled, record, request)))
+    await asyncio.gather(*tasks)
+    return stats, dict(outcomes), time.perf_counter() - started
+
+# ---------- entry points ----------- #
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    sessions = read_sessions(args.trace)
+    if not sessions:
+        raise ValueError(f"{args.trace} contains no capture session")
+    records = sessions[args.session]
+    plan = plan_dataset(records)
+    message_sizes = [record.request_bytes - BODY_OVERHEAD for record in records
+                     if record.route == "POST /chats/{chat_id}/messages" and record.request_bytes > BODY_OVERHEAD]
+    text_size = sum(message_sizes) // len(message_sizes) if message_sizes else 100
+
+    if args.target:
+        connect = httpx.AsyncClient(base_url=args.target, limits=httpx.Limits(max_connections=args.connections),
+                                    timeout=args.timeout)
+    else:
+        connect = loadtest.in_process_client(args.connections)
+
+    async with connect as client:
+        prefix = f"replay-{int(time.time())}-{rng.randrange(10 ** 6)}"
+        dataset = await build_dataset(client, plan, args.messages_per_chat, text_size, args.setup_concurrency,
+                                      prefix, rng)
+        stats, outcomes, duration = await replay(client, records, dataset, args.speed, rng, prefix)
+
+    captured = defaultdict(RouteStats)
+    for record in records:
+        captured[record.route].record(record.duration_ms, record.status)
+    captured_duration = (records[-1].offset_ms - records[0].offset_ms) / 1000 if records else 0.0
+
+    routes = {}
+    for route in sorted(set(stats) | set(outcomes)):
+        summary = stats[route].summary(duration) if route in stats else {}
+        captured_summary = captured[route].summary(captured_duration)
+        routes[route] = {**summary, **outcomes.get(route, {"skipped": 0, "status_mismatches": 0}),
+                         "captured_p50_ms": captured_summary["p50_ms"], "captured_p99_ms": captured_summary["p99_ms"]}
+
+    report = loadtest.format_report({route: stats[route] for route in stats}, duration)
+    skipped = sum(outcome["skipped"] for outcome in outcomes.values())
+    mismatches = sum(outcome["status_mismatches"] for outcome in outcomes.values())
+    report += f"\n{len(records)} captured requests, {skipped} skipped, {mismatches} with a different status"
+    return {"duration": duration, "dataset": {"users": len(dataset.users), "chats": len(dataset.chats),
+                                              "messages": len(dataset.messages)},
+            "routes": routes, "report": report}
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays captured Pony Express traffic against a local instance.")
+    parser.add_argument("trace", help="trace file written by the traffic capture")
+    parser.add_argument("--session", type=int, default=-1, help="index of the capture session to replay (default: the last)")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up of the replay, e.g. 10 for ten times faster")
+    parser.add_argument("--target", help="base URL of a running server; defaults to an in-process app")
+    parser.add_argument("--messages-per-chat", type=int, default=20, help="seed messages written to every chat")
+    parser.add_argument("--connections", type=int, default=1000, help="maximum concurrent connections")
+    parser.add_argument("--setup-concurrency", type=int, default=50, help="concurrent requests while building the dataset")
+    parser.add_argument("--timeout", type=float, default=30.0, help="request timeout in seconds (remote targets)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a reproducible dataset")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps({key: value for key, value in result.items() if key != "report"}, indent=2))
+    else:
+        print(result["report"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+## This class contains admin-only diagnostic routes for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+
+import json
+from datetime import datetime, timedelta
+from typing import Literal, Optional
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+from backend import backups, compression, contention, events, jobs, provisioning
+from backend import database as db
+from backend.allocations import allocation_profiler
+from backend.auth import get_admin_user
+from backend.capture import trace_file, traffic_recorder
+from backend.concurrency import release_slot
+from backend.cpu_profiler import MAX_RATE, MAX_SECONDS, CpuProfile, cpu_profiler, default_rate
+from backend.entities import (
+    JobInDB,
+    JobResponse,
+    MessageFlag,
+    MessageFlagCollection,
+    ModerationTerms,
+    RollupBucket,
+    RollupRanking,
+    RollupSeries,
+    RollupTotal,
+    UserImportReport,
+    UserImportResponse,
+    UserInDB
+)
+from backend.message_cache import message_cache
+from backend.moderation import moderation_filter
+from backend.presence import presence
+from backend.query_analyzer import query_analyzer
+from backend.single_flight import chat_reads
+
+admin_router = APIRouter(prefix="/admin", tags=["Admin"], dependencies=[Depends(get_admin_user)])
+
+# the most buckets an analytics series may span, e.g. a little over a year of hours
+MAX_ROLLUP_BUCKETS = 10000
+
+# Returns the hit rate and memory usage of the recent-message cache.
+@admin_router.get("/cache/messages", description="Returns hit rate and memory usage of the recent-message cache.")
+def get_message_cache_stats():
+    return message_cache.stats()
+
+# Returns the generation and delivery counters of this worker's cache invalidation subscriber.
+@admin_router.get("/events", description="Returns the state of this worker's cache invalidation subscriber.")
+def get_event_bus_stats():
+    if events.subscriber is None:
+        return {"worker_id": events.worker_id, "generation": None}
+    return events.subscriber.stats()
+
+# Queues a background job recomputing every chat's inbox summary from its messages.
+@admin_router.post("/jobs/rebuild-summaries", status_code=202, response_model=JobResponse, description="Queues a job rebuilding the inbox summary of every chat.")
+def rebuild_chat_summaries(user: UserInDB = Depends(get_admin_user), session: Session = Depends(db.get_session)):
+    job = jobs.enqueue(session, "rebuild_chat_summaries", {}, user.id)
+    session.commit()
+    session.refresh(job)
+    jobs.notify()
+    return JobResponse(job=jobs.to_job(job))
+
+# Queues a background job deleting stored attachment blobs that no attachment refers to anymore.
+@admin_router.post("/jobs/collect-blobs", status_code=202, response_model=JobResponse, description="Queues a job deleting unreferenced attachment blobs.")
+def collect_blobs(user: UserInDB = Depends(get_admin_user), session: Session = Depends(db.get_session)):
+    job = jobs.enqueue(session, "collect_blobs", {}, user.id)
+    session.commit()
+    session.refresh(job)
+    jobs.notify()
+    return JobResponse(job=jobs.to_job(job))
+
+# Queues a background job taking an online backup of the database; writers are not blocked while it runs.
+@admin_router.post("/backups", status_code=202, response_model=JobResponse, description="Queues a job backing up the database.")
+def backup_database(user: UserInDB = Depends(get_admin_user), session: Session = Depends(db.get_session)):
+    job = jobs.enqueue(session, "backup_database", {}, user.id)
+    session.commit()
+    session.refresh(job)
+    jobs.notify()
+    return JobResponse(job=jobs.to_job(job))
+
+# Returns the compressed database snapshots in the backup directory, newest first, with their checksums.
+@admin_router.get("/backups", description="Returns the database snapshots in the backup directory.")
+def get_backups():
+    return {"directory": backups.backup_dir, "keep": backups.keep, "snapshots": backups.list_snapshots()}
+
+# Queues a background job refreshing the query planner's statistics and vacuuming free pages.
+@admin_router.post("/jobs/maintenance", status_code=202, response_model=JobResponse, description="Queues a job running ANALYZE and the incremental vacuum.")
+def maintain_database(user: UserInDB = Depends(get_admin_user), session: Session = Depends(db.get_session)):
+    job = jobs.enqueue(session, "database_maintenance", {}, user.id)
+    session.commit()
+    session.refresh(job)
+    jobs.notify()
+    return JobResponse(job=jobs.to_job(job))
+
+# Returns the worker pool size and completion counters of this worker's job runner.
+@admin_router.get("/jobs", description="Returns the state of this worker's background job runner.")
+def get_job_runner_stats():
+    if jobs.runner is None:
+        return {"worker_id": events.worker_id, "workers": None}
+    return jobs.runner.stats()
+
+# Returns the number of tracked presence keys and cached chat memberships of this worker.
+@admin_router.get("/presence", description="Returns memory usage of this worker's presence service.")
+def get_presence_stats():
+    return presence.stats()
+
+# Returns how many chat reads led a load and how many shared the load of a concurrent identical read.
+@admin_router.get("/coalescing", description="Returns leader, follower and fallback counts of coalesced chat reads.")
+def get_coalescing_stats():
+    return chat_reads.stats()
+
+# Returns the compression ratio of responses and the hit rate of the compressed-body cache.
+@admin_router.get("/compression", description="Returns response compression totals and compressed-body cache usage.")
+def get_compression_stats():
+    return {
+        "encodings": list(compression.ENCODERS),
+        "responses": compression.compression_stats,
+        "cache": compression.compressed_cache.stats(),
+    }
+
+# Returns the statements slower than the analyzer's threshold, grouped by fingerprint, by descending
+# total time, each with one sample's parameters and query plan.
+@admin_router.get("/queries", description="Returns slow statements grouped by fingerprint, with their query plans.")
+def get_slow_queries(limit: int = Query(50, ge=1, le=500, description="The maximum number of fingerprints returned.")):
+    return {**query_analyzer.stats(), "queries": query_analyzer.queries(limit)}
+
+# Turns the slow-query analyzer on or off for this worker, or changes its threshold.
+@admin_router.put("/queries", description="Enables or disables the slow-query analyzer and sets its threshold.")
+def configure_slow_queries(enabled: Optional[bool] = Query(None, description="Whether statements are analyzed."),
+                           threshold_ms: Optional[float] = Query(None, ge=0, description="The latency above which a statement is recorded.")):
+    if enabled is not None:
+        query_analyzer.enabled = enabled
+    if threshold_ms is not None:
+        query_analyzer.threshold_ms = threshold_ms
+    return query_analyzer.stats()
+
+# Clears the slow-query aggregate of this worker.
+@admin_router.delete("/queries", status_code=204, description="Clears the slow-query aggregate.")
+def reset_slow_queries():
+    query_analyzer.reset()
+
+# Returns the allocations of the requests sampled by the allocation profiler, aggregated per route, by
+# descending largest peak, with the sites holding the most memory at the end of a request.
+@admin_router.get("/memory", description="Returns peak and net allocated bytes and top allocation sites per route.")
+def get_allocations(limit: int = Query(50, ge=1, le=500, description="The maximum number of routes returned.")):
+    return {**allocation_profiler.stats(), "routes": allocation_profiler.routes(limit)}
+
+# Turns allocation profiling on or off for this worker, or changes the share of requests it traces.
+@admin_router.put("/memory", description="Enables or disables the allocation profiler and sets its sample rate.")
+def configure_allocations(enabled: Optional[bool] = Query(None, description="Whether requests are profiled."),
+                          sample_rate: Optional[float] = Query(None, ge=0, le=1, description="The share of requests traced.")):
+    if enabled is not None:
+        allocation_profiler.enabled = enabled
+    if sample_rate is not None:
+        allocation_profiler.sample_rate = sample_rate
+    return allocation_profiler.stats()
+
+# Clears the per-route allocation aggregate of this worker.
+@admin_router.delete("/memory", status_code=204, description="Clears the per-route allocation aggregate.")
+def reset_allocations():
+    allocation_profiler.reset()
+
+# Takes a snapshot of the traced memory. The first one becomes the baseline and keeps tracing on
+# until it is dropped; later ones return the sites whose memory grew the most since the baseline.
+@admin_router.post("/memory/snapshots", description="Takes a memory snapshot and compares it against the baseline snapshot.")
+def take_memory_snapshot():
+    return allocation_profiler.snapshot()
+
+# Drops the baseline snapshot and stops tracing.
+@admin_router.delete("/memory/snapshots", status_code=204, description="Drops the baseline memory snapshot and stops tracing.")
+def clear_memory_snapshot():
+    allocation_profiler.clear_snapshot()
+
+# Returns the state of this worker's traffic capture.
+@admin_router.get("/capture", description="Returns the state of the traffic capture.")
+def get_capture_stats():
+    return traffic_recorder.stats()
+
+# Starts a new capture session, appended to the trace file, or stops capturing. A new trace file can
+# only be named, and is always created in the directory of 'TRAFFIC_CAPTURE_PATH'.
+@admin_router.put("/capture", description="Starts or stops capturing sanitized request traces.")
+def configure_capture(enabled: bool = Query(..., description="Whether requests are captured."),
+                      file: Optional[str] = Query(None, description="The name of the trace file in the capture directory; defaults to the current one.")):
+    if enabled:
+        traffic_recorder.start(trace_file(file) if file is not None else None)
+    else:
+        traffic_recorder.stop()
+    return traffic_recorder.stats()
+
+# Starts sampling the stacks of this worker's threads for a few seconds, optionally only counting
+# stacks that pass through one route's endpoint, e.g. "GET /chats/{chat_id}". Returns right away;
+# the result is read from 'GET /admin/profiles/cpu' once the profile finished.
+@admin_router.post("/profiles/cpu", status_code=202, description="Starts a sampling CPU profile of this worker.")
+def start_cpu_profile(request: Request,
+                      seconds: float = Query(10, gt=0, le=MAX_SECONDS, description="How long to sample."),
+                      rate: float = Query(default_rate, gt=0, le=MAX_RATE, description="The number of samples per second."),
+                      route: Optional[str] = Query(None, description="Only count stacks of this route, e.g. 'GET /chats/{chat_id}'."),
+                      include_idle: bool = Query(False, description="Also count threads that are waiting.")):
+    route_codes = frozenset()
+    if route is not None:
+        method, _, path = route.partition(" ")
+        endpoints = [candidate.endpoint for candidate in request.app.routes
+                     if isinstance(candidate, APIRoute) and candidate.path == path and method.upper() in candidate.methods]
+        if not endpoints:
+            raise HTTPException(status_code=422, detail={
+                "error": "unknown_route",
+                "error_description": f"no route '{route}'"
+            })
+        route_codes = frozenset(endpoint.__code__ for endpoint in endpoints)
+
+    profile = cpu_profiler.start(seconds, rate, route, route_codes, include_idle)
+    if profile is None:
+        raise HTTPException(status_code=409, detail={
+            "error": "profile_running",
+            "error_description": "a CPU profile is already running on this worker"
+        })
+    return profile.summary()
+
+# Returns the state of the running or most recent CPU profile, with the functions holding the most samples.
+@admin_router.get("/profiles/cpu", description="Returns the state and top functions of the latest CPU profile.")
+def get_cpu_profile(limit: int = Query(20, ge=1, le=500, description="The maximum number of functions listed.")):
+    return _latest_cpu_profile().summary(limit)
+
+# Returns the samples of the running or most recent CPU profile as collapsed stacks, which flame
+# graph tools (flamegraph.pl, speedscope, inferno) read directly.
+@admin_router.get("/profiles/cpu/collapsed", response_class=PlainTextResponse, description="Returns the latest CPU profile as collapsed stacks.")
+def get_cpu_profile_collapsed():
+    return PlainTextResponse(_latest_cpu_profile().collapsed())
+
+# Ends the running CPU profile early, keeping its samples.
+@admin_router.delete("/profiles/cpu", status_code=204, description="Stops the running CPU profile.")
+def stop_cpu_profile():
+    cpu_profiler.stop()
+
+# Returns how often database writes were retried because SQLite was busy, and how many edits lost a version check.
+@admin_router.get("/contention", description="Returns write retry and version conflict counters of this worker.")
+def get_contention_stats():
+    return contention.stats()
+
+# Returns the number of messages per hour or day within a range, optionally of one chat or user, from the message rollups.
+@admin_router.get("/analytics/messages", response_model=RollupSeries, description="Returns message volume per hour or day, optionally for one chat or user.")
+def get_message_volume(granularity: Literal["hour", "day"] = Query("day", description="The size of each bucket."),
+                       start: Optional[datetime] = Query(None, description="The start of the range; defaults to 7 days before the end."),
+                       end: Optional[datetime] = Query(None, description="The end of the range (exclusive); defaults to now."),
+                       chat_id: Optional[int] = Query(None, description="Only count messages of this chat."),
+                       user_id: Optional[int] = Query(None, description="Only count messages of this user."),
+                       session: Session = Depends(db.get_session)):
+    start, end = _analytics_range(granularity, start, end)
+    buckets = db.get_message_volume(session, granularity, start, end, chat_id, user_id)
+    return _to_series(granularity, start, end, buckets)
+
+# Returns the number of users who sent a message, per hour or day within a range, from the message rollups.
+# The total is the number of distinct users over the whole range.
+@admin_router.get("/analytics/active-users", response_model=RollupSeries, description="Returns the number of users who sent messages, per hour or day.")
+def get_active_users(granularity: Literal["hour", "day"] = Query("day", description="The size of each bucket."),
+                     start: Optional[datetime] = Query(None, description="The start of the range; defaults to 7 days before the end."),
+                     end: Optional[datetime] = Query(None, description="The end of the range (exclusive); defaults to now."),
+                     session: Session = Depends(db.get_session)):
+    start, end = _analytics_range(granularity, start, end)
+    return _to_series(granularity, start, end, db.get_active_users(session, granularity, start, end),
+                      total=db.count_active_users(session, granularity, start, end))
+
+# Returns the chats or users that sent the most messages within a range, from the message rollups.
+@admin_router.get("/analytics/top", response_model=RollupRanking, description="Returns the chats or users with the most messages within a range.")
+def get_message_ranking(by: Literal["chat", "user"] = Query("chat", description="Rank chats or users."),
+                        start: Optional[datetime] = Query(None, description="The start of the range; defaults to 7 days before the end."),
+                        end: Optional[datetime] = Query(None, description="The end of the range (exclusive); defaults to now."),
+                        limit: int = Query(10, ge=1, le=100, description="The maximum number of chats or users returned."),
+                        session: Session = Depends(db.get_session)):
+    start, end = _analytics_range("hour", start, end)
+    ranking = db.get_message_ranking(session, by, start, end, limit)
+    return RollupRanking(by=by, start=start, end=end,
+                         ranking=[RollupTotal(id=entity_id, count=count) for entity_id, count in ranking])
+
+# Returns the size of this worker's banned-term automaton, its last reload and the actions taken on messages.
+@admin_router.get("/moderation", description="Returns the state of this worker's moderation filter.")
+def get_moderation_stats():
+    return moderation_filter.stats()
+
+# Replaces the banned terms of the moderation filter. Every worker compiles the new list in the background
+# and keeps moderating messages with the previous one until it is done.
+@admin_router.put("/moderation/terms", description="Replaces the banned terms of the moderation filter.")
+def replace_moderation_terms(moderation_terms: ModerationTerms, session: Session = Depends(db.get_session)):
+    db.replace_moderation_terms(moderation_terms.terms, session)
+    return moderation_filter.stats()
+
+# Returns the most recent messages flagged by the moderation filter in chats with the "flag" policy.
+@admin_router.get("/moderation/flags", response_model=MessageFlagCollection, description="Returns the most recently flagged messages.")
+def get_message_flags(chat_id: Optional[int] = Query(None, description="Only return flags of this chat."),
+                      limit: int = Query(100, ge=1, le=1000, description="The maximum number of flags returned."),
+                      session: Session = Depends(db.get_session)):
+    flags = [MessageFlag(id=flag.id, message_id=flag.message_id, chat_id=flag.chat_id, user_id=flag.user_id,
+                         terms=flag.terms.split(","), created_at=flag.created_at)
+             for flag in db.get_message_flags(session, chat_id, limit)]
+    return MessageFlagCollection(meta={"count": len(flags)}, flags=flags)
+
+# Creates user accounts in bulk from a CSV file with a "username,email,password" header, or from NDJSON
+# objects with those fields. The body is streamed to a private file and the accounts are created by a
+# background job, whose report lists every row that failed and the accounts created per second.
+@admin_router.post("/users/import", status_code=202, response_model=UserImportResponse, response_model_exclude_none=True, description="Queues a job creating the users of a CSV or NDJSON file.")
+async def import_users(request: Request, format: Optional[Literal["csv", "ndjson"]] = Query(None, description="The file format; taken from the Content-Type by default."),
+                       user: UserInDB = Depends(get_admin_user), session: Session = Depends(db.get_session)):
+    format = format or provisioning.format_of(request.headers.get("content-type", ""))
+    if format is None:
+        raise HTTPException(status_code=422, detail={
+            "error": "unknown_format",
+            "error_description": "pass format=csv or format=ndjson, or a text/csv or application/x-ndjson Content-Type"
+        })
+    release_slot(request)
+    path = await run_in_threadpool(provisioning.create_spool, format)
+    received = 0
+    try:
+        async with await anyio.open_file(path, "wb") as file:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > provisioning.max_bytes:
+                    raise HTTPException(status_code=413, detail={
+                        "error": "import_too_large",
+                        "error_description": f"imports are limited to {provisioning.max_bytes} bytes"
+                    })
+                await file.write(chunk)
+        # the job only knows the file, so passwords are never written to the jobs table
+        job = await run_in_threadpool(_enqueue_import, path, format, user.id, session)
+    except BaseException:
+        await run_in_threadpool(provisioning.remove_spool, path)
+        raise
+    return UserImportResponse(job=jobs.to_job(job))
+
+# Returns the progress of a bulk user import, with the rows that failed so far.
+# If it does not exist, returns a 404 HTTP status code.
+@admin_router.get("/users/import/{job_id}", response_model=UserImportResponse, response_model_exclude_none=True, description="Returns the progress and report of a bulk user import.")
+def get_user_import(job_id: int, session: Session = Depends(db.get_session)):
+    job = session.get(JobInDB, job_id)
+    if job is None or job.kind != "provision_users":
+        raise db.EntityNotFoundException(entity_name="Import", entity_id=job_id)
+    # the job checkpoints its report after every batch
+    report = UserImportReport(**json.loads(job.checkpoint)) if job.checkpoint else None
+    return UserImportResponse(job=jobs.to_job(job), report=report)
+
+def _enqueue_import(path: str, format: str, user_id: int, session: Session) -> JobInDB:
+    job = jobs.enqueue(session, "provision_users", {"path": path, "format": format}, user_id)
+    session.commit()
+    session.refresh(job)
+    jobs.notify()
+    return job
+
+def _analytics_range(granularity: str, start: Optional[datetime], end: Optional[datetime]) -> tuple[datetime, datetime]:
+    end = _to_local(end) if end is not None else datetime.now()
+    start = _to_local(start) if start is not None else end - timedelta(days=7)
+    bucket = timedelta(hours=1) if granularity == "hour" else timedelta(days=1)
+    if start >= end or (end - start) / bucket > MAX_ROLLUP_BUCKETS:
+        raise HTTPException(status_code=422, detail={
+            "error": "invalid_range",
+            "error_description": f"start must be before end, at most {MAX_ROLLUP_BUCKETS} {granularity}s apart"
+        })
+    return start, end
+
+def _to_local(moment: datetime) -> datetime:
+    # the rollups hold naive local times, like every other timestamp of the database
+    return moment.astimezone().replace(tzinfo=None) if moment.tzinfo else moment
+
+def _to_series(granularity: str, start: datetime, end: datetime, buckets: list[tuple[datetime, int]],
+               total: Optional[int] = None) -> RollupSeries:
+    return RollupSeries(granularity=granularity, start=start, end=end,
+                        total=sum(count for _, count in buckets) if total is None else total,
+                        buckets=[RollupBucket(bucket_start=bucket, count=count) for bucket, count in buckets])
+
+def _latest_cpu_profile() -> CpuProfile:
+    profile = cpu_profiler.profile
+    if profile is None:
+        raise HTTPException(status_code=404, detail={
+            "error": "no_profile",
+            "error_description": "no CPU profile has been taken on this worker"
+        })
+    return profile
@@ -0,0 +1,229 @@
+## This class contains attachment upload and download routes for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+
+import os
+import re
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from urllib.parse import quote
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
+from sqlmodel import Session
+
+from backend import blobs
+from backend.concurrency import release_slot
+from backend import database as db
+from backend.auth import get_current_user
+from backend.entities import (
+    Attachment,
+    AttachmentCollection,
+    AttachmentInDB,
+    Upload,
+    UploadCreate,
+    UploadInDB,
+    UploadResponse,
+    UserInDB,
+)
+
+attachments_router = APIRouter(prefix="/chats", tags=["Attachments"])
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+# returned by '_parse_range' for a well-formed range that lies outside the file
+UNSATISFIABLE = (-1, -1)
+
+# Starts a resumable upload of an attachment to the chat. The file's bytes are sent afterwards with
+# 'PUT /chats/{chat_id}/uploads/{upload_id}', in as many chunks as the client likes.
+@attachments_router.post("/{chat_id}/uploads", status_code=201, response_model=UploadResponse, response_model_exclude_none=True, description="If the current user is a member of the chat, starts a resumable attachment upload.")
+def create_upload(chat_id: int, upload_create: UploadCreate,
+                  current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        return UploadResponse(upload=_to_upload(db.create_upload(chat_id, upload_create, current_user, session)))
+
+# Returns the number of bytes received for an upload, so an interrupted upload resumes from there.
+@attachments_router.get("/{chat_id}/uploads/{upload_id}", response_model=UploadResponse, response_model_exclude_none=True, description="Returns the offset an interrupted upload resumes from.")
+def get_upload(chat_id: int, upload_id: str,
+               current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        return UploadResponse(upload=_to_upload(db.get_upload(chat_id, upload_id, current_user, session)))
+
+def _get_open_upload(chat_id: int, upload_id: str, current_user: UserInDB = Depends(get_current_user),
+                     session: Session = Depends(db.get_session)) -> tuple[UploadInDB, Session]:
+    db.is_member_of_chat(chat_id, current_user, session)
+    upload = db.get_upload(chat_id, upload_id, current_user, session)
+    session.expunge(upload)
+    # return the pooled connection while the request body streams in; 'complete_upload' checks one out again
+    session.close()
+    return upload, session
+
+# Appends a chunk of the file, starting at 'offset', which must equal the number of bytes received so far.
+# The request body is streamed to disk. Once every byte arrived, the upload becomes an attachment
+# that can be sent with a message through 'attachment_ids'.
+@attachments_router.put("/{chat_id}/uploads/{upload_id}", response_model=UploadResponse, response_model_exclude_none=True, description="Appends a chunk of bytes to an upload at the given offset.")
+async def append_upload(request: Request, offset: int = Query(..., ge=0, description="The offset of the chunk, i.e. the number of bytes already received."),
+                        open_upload: tuple[UploadInDB, Session] = Depends(_get_open_upload)):
+    upload, session = open_upload
+    release_slot(request)
+    # chunks of the same upload are appended one request at a time
+    part = await run_in_threadpool(blobs.open_part, upload.id)
+    if part is None:
+        # another request completed the upload while this one waited for the part
+        attachment = await run_in_threadpool(db.get_upload_attachment, upload.id, session)
+        if attachment is None:
+            raise db.EntityNotFoundException(entity_name="Upload", entity_id=upload.id)
+        return UploadResponse(upload=_to_upload(upload, upload.size, attachment))
+
+    file = anyio.wrap_file(part)
+    try:
+        received = os.fstat(part.fileno()).st_size
+        if offset != received:
+            raise HTTPException(status_code=409, detail={
+                "error": "offset_mismatch",
+                "error_description": "the chunk does not start at the number of bytes received",
+                "offset": received,
+            })
+
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > upload.size:
+                await file.flush()
+                await file.truncate(offset)
+                raise HTTPException(status_code=413, detail={
+                    "error": "upload_too_large",
+                    "error_description": f"the upload was declared as {upload.size} bytes"
+                })
+            await file.write(chunk)
+        await file.flush()
+
+        attachment = None
+        if received == upload.size:
+            # still holding the lock, so no other request appends to or completes the part
+            attachment = await run_in_threadpool(db.complete_upload, upload, session)
+    finally:
+        await file.aclose()
+    return UploadResponse(upload=_to_upload(upload, received, attachment))
+
+# Returns the attachments of a message in the chat.
+@attachments_router.get("/{chat_id}/messages/{message_id}/attachments", response_model=AttachmentCollection, description="If the current user is a member of the chat, returns the attachments of a message.")
+def get_message_attachments(chat_id: int, message_id: int,
+                            current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        message = db.get_message_by_id(message_id, session)
+        if message.chat_id != chat_id:
+            raise db.EntityNotFoundException(entity_name="Message", entity_id=message_id)
+        attachments = db.get_message_attachments(message.id, session)
+        return AttachmentCollection(meta={"count": len(attachments)},
+                                    attachments=[_to_attachment(attachment) for attachment in attachments])
+
+# Downloads an attachment. Honors single byte ranges ('Range', 'If-Range') and conditional requests
+# ('If-None-Match', 'If-Modified-Since'); the content hash is a strong ETag, since content never changes.
+@attachments_router.get("/{chat_id}/attachments/{attachment_id}", response_class=Response, description="If the current user is a member of the chat, downloads an attachment, honoring Range and conditional headers.")
+def download_attachment(chat_id: int, attachment_id: int, request: Request,
+                        current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    db.is_member_of_chat(chat_id, current_user, session)
+    attachment = db.get_attachment(chat_id, attachment_id, session)
+    etag = f'"{attachment.sha256}"'
+    last_modified = format_datetime(attachment.created_at.astimezone(), usegmt=True)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": last_modified,
+        "cache-control": "private, max-age=31536000, immutable",
+        "content-disposition": f"attachment; filename*=UTF-8''{quote(attachment.filename)}",
+    }
+
+    if _not_modified(request, etag, attachment):
+        return Response(status_code=304, headers=headers)
+
+    size = attachment.size
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if "range" in request.headers and (if_range is None or if_range == etag):
+        byte_range = _parse_range(request.headers["range"], size)
+        if byte_range == UNSATISFIABLE:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+
+    if byte_range is None:
+        return FileRangeResponse(blobs.object_path(attachment.sha256), 0, size, 200, headers,
+                                 attachment.content_type)
+
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{size}"
+    return FileRangeResponse(blobs.object_path(attachment.sha256), start, end - start + 1, 206, headers,
+                             attachment.content_type)
+
+class FileRangeResponse(Response):
+    """
+    Sends 'count' bytes of a file from 'offset'. Uses the ASGI zero-copy send extension when the
+    server offers it, and otherwise streams the file in chunks, so it never sits in memory whole.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, offset: int, count: int, status_code: int, headers: dict, media_type: str):
+        super().__init__(status_code=status_code, headers={**headers, "content-length": str(count)},
+                         media_type=media_type)
+        self.path = path
+        self.offset = offset
+        self.count = count
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file,
+                            "offset": self.offset, "count": self.count, "more_body": False})
+            return
+
+        remaining = self.count
+        async with await anyio.open_file(self.path, "rb") as file:
+            await file.seek(self.offset)
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def _parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    # only single ranges are served; malformed or multi-range headers are ignored (None), as RFC 9110 allows
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        if int(last) == 0 or size == 0:
+            return UNSATISFIABLE
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return UNSATISFIABLE
+    return start, end
+
+def _not_modified(request: Request, etag: str, attachment: AttachmentInDB) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return attachment.created_at.astimezone().replace(microsecond=0) <= since
+    return False
+
+def _to_attachment(attachment: AttachmentInDB) -> Attachment:
+    return Attachment(**attachment.model_dump())
+
+def _to_upload(upload: UploadInDB, offset: Optional[int] = None, attachment: Optional[AttachmentInDB] = None) -> Upload:
+    return Upload(id=upload.id, filename=upload.filename, size=upload.size,
+                  offset=blobs.get_offset(upload.id) if offset is None else offset,
+                  attachment=_to_attachment(attachment) if attachment is not None else None)
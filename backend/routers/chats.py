@@ -1,25 +1,32 @@
 ## This class contains backend methods for the Spring 2024 CS 4550 Pony Express application.
 # Author: Riley Kraabel
 
-from fastapi import APIRouter, Depends, Query
-from typing import Optional
+from fastapi import APIRouter, Depends, Query, Response
+from backend import jobs
+from backend.contention import if_match_version, set_etag
+from typing import Literal, Optional
 from sqlmodel import Session
 from backend import database as db
 from backend.auth import get_current_user
+from backend.compression import compressible
+from backend.single_flight import chat_reads
 from backend.entities import (
     ChatMetadata,
     UserInDB,
     MessageResponse,
     GetChatResponse,
-    ChatCollection,
     ChatResponse,
+    InboxCollection,
+    JobResponse,
     UserCollection,
     MessageCollection,
     CreateMessage,
     ChatCreate,
     ChatUpdate,
     RemovedUserCollection,
-    MessageCreate
+    MessageCreate,
+    ModerationPolicyResponse,
+    ModerationPolicyUpdate
 )
 
 ##### note: need to adjust the backend router methods to account for different access status codes ****
@@ -35,15 +42,29 @@ def add_new_chat(new_chat: ChatCreate,
 
 # If the chat exists and the current user is the owner of it, updates its' chat name. 
 # If it does not exist, retruns a 404 HTTP status code. 
+# The chat's ETag may be sent in 'If-Match' (412 if the chat changed since); a concurrent edit returns 409.
 @chats_router.put("/{chat_id}", response_model=ChatResponse, description="If the chat exists and the current user is the owner, updates the name.")
-def update_chat(chat_id: int, chat_update: ChatUpdate, 
+def update_chat(chat_id: int, chat_update: ChatUpdate, response: Response,
+                expected_version: Optional[int] = Depends(if_match_version),
                 current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     chat = db.get_chat_by_id(chat_id, session)
     if chat:
         if db.is_member_of_chat(chat.id, current_user, session):
             if db.is_owner_of_chat(chat.id, current_user, session):
-                return ChatResponse(chat=db.update_chat(chat.id, chat_update.name, session))
+                chat = db.update_chat(chat.id, chat_update.name, session, expected_version)
+                set_etag(response, chat.version)
+                return ChatResponse(chat=chat)
         
+# If the chat exists and the current user is the owner of it, deletes the chat along with its memberships and messages.
+# The chat is gone as soon as the response is sent; its messages are purged in chunks by the returned background job.
+# If it does not exist, returns a 404 HTTP status code.
+@chats_router.delete("/{chat_id}", status_code=202, response_model=JobResponse, description="If the chat exists and the current user is the owner, deletes the chat and queues a job purging its messages.")
+def delete_chat(chat_id: int, 
+                current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        if db.is_owner_of_chat(chat_id, current_user, session):
+            return JobResponse(job=jobs.to_job(db.delete_chat(chat_id, current_user, session)))
+
 # If the chat exists and the user to be added exists, they are added to the list of users for the chat.
 # If it does not exist, returns a 404 HTTP status code.
 @chats_router.put("/{chat_id}/users/{user_id}", status_code=201, response_model=UserCollection, description="If the current user is the owner of the specified chat, adds a new user to the chat.")
@@ -82,15 +103,19 @@ def remove_user_from_chat(chat_id: int, user_id: int,
 ## ------------------- assignment 5c methods ----------------- ##
 # If the chat exists, the message exists, and the current user is the owner of the message, updates the message text.
 # If it does not exist, returns a 404 HTTP status code.
+# The message's ETag may be sent in 'If-Match' (412 if the message changed since); a concurrent edit returns 409.
 @chats_router.put("/{chat_id}/messages/{message_id}", status_code=200, response_model=MessageResponse, description="If the chat exists, the message exists, and the current user is the owner of the message, they can update its' contents.")
-def update_message(chat_id: int, message_id: int, message_create: MessageCreate, 
+def update_message(chat_id: int, message_id: int, message_create: MessageCreate, response: Response,
+                   expected_version: Optional[int] = Depends(if_match_version),
                    current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     chat = db.get_chat_by_id(chat_id, session)
     if chat: 
         message = db.get_message_by_id(message_id, session)
         if message:
             if db.is_owner_of_message(message.id, current_user, session):
-                return MessageResponse(message=db.update_message(message.id, message_create.text, session))
+                message = db.update_message(message.id, message_create.text, session, expected_version)
+                set_etag(response, message.version)
+                return MessageResponse(message=message)
             
 # If the chat exists, the message exists, and the current user if the owner of the message, deletes the message.
 # If it does not exist, returns a 404 HTTP status code.
@@ -104,59 +129,101 @@ def delete_message(chat_id: int, message_id: int,
             if db.is_owner_of_message(message.id, current_user, session):
                 db.delete_message(message.id, session)
 
-# Returns a list representation of all chats the currently logged in user is apart of.
-@chats_router.get("", response_model=ChatCollection, description="Returns a list of chats the current user is in, sorted by the name of the chat, along with the number of chats.")
-def get_all_chats(current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
-    chats = db.get_all_chats(current_user, session)
-    if len(chats) > 0:
-        return ChatCollection(meta={"count": len(chats)}, chats=sorted(chats, key=lambda chat: chat.id))
-    
-    return ChatCollection(meta={"count": len(chats)}, chats=[])
+# Returns a page of the chats the currently logged in user is apart of, with each chat's last activity and last message.
+# Chats are sorted by id, or by last activity (most recent first) when 'sort' is "recent".
+@chats_router.get("", response_model=InboxCollection, response_model_exclude_none=True, description="Returns a list of chats the current user is in, sorted by id or by last activity, along with the number of chats.")
+@compressible(cache=True)
+def get_all_chats(sort: Literal["id", "recent"] = Query("id", description="Sort chats by id or by most recent activity."),
+                  limit: Optional[int] = Query(None, ge=1, le=1000, description="The maximum number of chats to return."),
+                  cursor: Optional[str] = Query(None, description="The 'next_cursor' of the previous page."),
+                  current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    chats, next_cursor = db.get_all_chats(current_user, session, sort, limit, cursor)
+    return InboxCollection(meta={"count": db.count_chats_of_user(current_user, session)}, chats=chats,
+                           next_cursor=next_cursor)
 
 # If the chat exists, return the chat for the given id (int) The user is allowed to specify additional data they want returned. 
 # If it does not exist, returns a 404 HTTP status code.
+# Concurrent identical reads of the chat by its members share one load and serialized body.
 @chats_router.get("/{chat_id}", status_code=200, response_model=GetChatResponse, response_model_exclude_none=True, description="If the chat with the specified id exists and the current user is a member, it is returned.")
+@compressible(cache=True)
 def get_chat(chat_id: int, 
              include: Optional[list[str]] = Query(None, description="Include additional data (e.g., users or messages) in the response."),
              current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     if db.is_member_of_chat(chat_id, current_user, session):
-        chat = db.get_chat_by_id(chat_id, session)
-        metadata = ChatMetadata(message_count=len(chat.messages), user_count=len(chat.users))
-        chat_response = GetChatResponse(meta=metadata, chat=chat)
-
-        if include:
-            if "messages" in include:
-                chat_response.messages = db.get_all_messages_from_chat(chat_id, session)
-            if "users" in include:
-                chat_response.users = chat.users
+        include = tuple(sorted(set(include or ())))
+        body, version = chat_reads.do(chat_id, ("chat", include), lambda: _load_chat(chat_id, include, session))
+        return Response(content=body, media_type="application/json", headers={"ETag": f'"{version}"'})
 
-        return chat_response
+def _load_chat(chat_id: int, include: tuple[str, ...], session: Session) -> tuple[bytes, int]:
+    chat = db.get_chat_by_id(chat_id, session)
+    users = db.get_all_users_from_chat(chat_id, session)
+    metadata = ChatMetadata(message_count=db.get_message_count(chat_id, session), user_count=len(users))
+    messages = db.get_recent_messages(chat_id, session)[0] if "messages" in include else None
+    # built in one call, so the included rows are validated into response models before serializing
+    chat_response = GetChatResponse(meta=metadata, chat=chat, messages=messages,
+                                    users=users if "users" in include else None)
+    return chat_response.model_dump_json(exclude_none=True).encode(), chat.version
 
 # If the chat exists, returns a list of messages for the chat using the given id (str), along with a count of the messages in the chat (int). 
 # If it does not exist, returns a 404 HTTP status code. 
+# An optional 'limit' returns only the newest messages, and 'before' pages back from a message id (into archived history if needed).
+# The count is always the total number of messages in the chat.
+# Concurrent identical reads of the messages by the chat's members share one load and serialized body.
 @chats_router.get("/{chat_id}/messages", response_model=MessageCollection, description="If the chat exists and the current user is a member, return a list of messages using the input id.")
+@compressible(cache=True)
 def get_messages_from_chat(chat_id: int, 
+                           limit: Optional[int] = Query(None, ge=1, description="Only return the newest 'limit' messages."),
+                           before: Optional[int] = Query(None, description="Only return messages older than this message id."),
                            current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     if db.is_member_of_chat(chat_id, current_user, session):
-        chat = db.get_chat_by_id(chat_id, session)
-        return MessageCollection(meta={"count": len(chat.messages)},
-                             messages=chat.messages)
+        body = chat_reads.do(chat_id, ("messages", limit, before),
+                             lambda: _load_messages(chat_id, limit, before, session))
+        return Response(content=body, media_type="application/json")
+
+def _load_messages(chat_id: int, limit: Optional[int], before: Optional[int], session: Session) -> bytes:
+    messages, total = db.get_recent_messages(chat_id, session, limit, before)
+    return MessageCollection(meta={"count": total}, messages=messages).model_dump_json().encode()
 
 # If the chat exists, returns a list of the users for the chat using the given id (str), along with a count of the number of users in the chat (int). 
 # If it does not exist, returns a 404 HTTP status code.
 @chats_router.get("/{chat_id}/users", response_model=UserCollection, description="If the chat exists and the current user is a member, returns a list of the users in the input chat id.")
+@compressible(cache=True)
 def get_users_from_chat(chat_id: int, 
                         current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        users = db.get_all_users_from_chat(chat_id, session)
+        return UserCollection(meta={"count": len(users)}, users=users)
+
+# If the chat exists and the current user is a member, returns what happens to its messages containing banned terms.
+@chats_router.get("/{chat_id}/moderation", response_model=ModerationPolicyResponse, description="If the chat exists and the current user is a member, returns its moderation policy.")
+def get_moderation_policy(chat_id: int,
+                          current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     if db.is_member_of_chat(chat_id, current_user, session):
         chat = db.get_chat_by_id(chat_id, session)
-        return UserCollection(meta={"count": len(chat.users)}, users=chat.users)
+        return ModerationPolicyResponse(chat_id=chat.id, policy=chat.moderation_policy)
+
+# If the chat exists and the current user is the owner, sets whether new and edited messages containing banned
+# terms are rejected, have those terms masked, or are kept and flagged for admins.
+@chats_router.put("/{chat_id}/moderation", response_model=ModerationPolicyResponse, description="If the chat exists and the current user is the owner, changes its moderation policy.")
+def update_moderation_policy(chat_id: int, policy_update: ModerationPolicyUpdate,
+                             current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    if db.is_member_of_chat(chat_id, current_user, session):
+        if db.is_owner_of_chat(chat_id, current_user, session):
+            chat = db.update_moderation_policy(chat_id, policy_update.policy, session)
+            return ModerationPolicyResponse(chat_id=chat.id, policy=chat.moderation_policy)
 
 # If a chat with the specified chat_id exists and the current user is a member of the chat, adds a new message within the chat. 
 # If it does not exist, returns a 404 HTTP status code.
-@chats_router.post("/{chat_id}/messages", status_code=201, response_model=MessageResponse, description="If the chat exists and the current user is a member, creates a new message in the specified chat.")
-def add_new_message(chat_id: int, new_message: CreateMessage,
+@chats_router.post("/{chat_id}/messages", status_code=201, response_model=MessageResponse, response_model_exclude_none=True, description="If the chat exists and the current user is a member, creates a new message in the specified chat.")
+def add_new_message(chat_id: int, new_message: CreateMessage, response: Response,
                     current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
     if db.is_member_of_chat(chat_id, current_user, session):
         chat = db.get_chat_by_id(chat_id, session)
         if chat: 
-            return MessageResponse(message=db.send_message(new_message.text, current_user, chat.id, session))
\ No newline at end of file
+            message = db.send_message(new_message.text, current_user, chat.id, session, new_message.attachment_ids)
+            set_etag(response, message.version)
+            if not new_message.attachment_ids:
+                return MessageResponse(message=message)
+            return MessageResponse(message=message, attachments=[
+                attachment.model_dump() for attachment in db.get_message_attachments(message.id, session)
+            ])
@@ -0,0 +1,36 @@
+## This class contains routes for polling background jobs in the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlmodel import Session
+
+from backend import database as db
+from backend import jobs
+from backend.auth import admin_usernames, get_current_user
+from backend.entities import JobInDB, JobResponse, UserInDB
+
+jobs_router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+# Returns the status, percent complete and throughput of a job started by the current user (or of any job, for admins).
+# If it does not exist, returns a 404 HTTP status code.
+@jobs_router.get("/{job_id}", response_model=JobResponse, response_model_exclude_none=True, description="Returns the status and progress of a background job.")
+def get_job(job_id: int, current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    return JobResponse(job=jobs.to_job(_get_visible_job(job_id, current_user, session)))
+
+# Cancels a queued job, or asks a running job to stop at its next checkpoint.
+# Jobs that already finished, or that cannot be stopped halfway, are returned unchanged.
+@jobs_router.post("/{job_id}/cancel", response_model=JobResponse, response_model_exclude_none=True, description="Cancels a background job started by the current user.")
+def cancel_job(job_id: int, current_user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+    job = _get_visible_job(job_id, current_user, session)
+    return JobResponse(job=jobs.to_job(jobs.request_cancel(job, session)))
+
+def _get_visible_job(job_id: int, current_user: UserInDB, session: Session) -> JobInDB:
+    job = session.get(JobInDB, job_id)
+    if job is None:
+        raise db.EntityNotFoundException(entity_name="Job", entity_id=job_id)
+    if job.created_by != current_user.id and current_user.username not in admin_usernames:
+        raise HTTPException(status_code=403, detail={
+            "error": "no_permission",
+            "error_description": "requires permission to view job"
+        })
+    return job
@@ -0,0 +1,51 @@
+## This class contains presence and typing-indicator routes for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# These routes are polled every few seconds by every client, so they identify the user from the
+# access token alone and read membership from the presence service's cache; none of them touches
+# the database once a chat's members are cached.
+
+from fastapi import APIRouter, Depends, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
+from sqlmodel import Session
+
+from backend import database as db
+from backend.auth import get_current_user_id
+from backend.entities import ChatPresence, TypingUpdate
+from backend.presence import presence
+
+presence_router = APIRouter(tags=["Presence"])
+
+# Marks the current user as online for the next PRESENCE_TTL_SECONDS seconds.
+@presence_router.post("/users/me/heartbeat", status_code=204, description="Marks the current user as online.")
+async def heartbeat(user_id: int = Depends(get_current_user_id)):
+    presence.heartbeat(user_id)
+    return Response(status_code=204)
+
+# Marks the current user as typing in the chat for the next TYPING_TTL_SECONDS seconds, or clears the mark.
+@presence_router.put("/chats/{chat_id}/typing", status_code=204, description="If the current user is a member of the chat, reports that they started or stopped typing.")
+async def set_typing(chat_id: int, typing_update: TypingUpdate, user_id: int = Depends(get_current_user_id),
+                     session: Session = Depends(db.get_session)):
+    await _check_member(chat_id, user_id, session)
+    presence.set_typing(chat_id, user_id, typing_update.typing)
+    return Response(status_code=204)
+
+# Returns which members of the chat are online and which are typing, as user ids.
+@presence_router.get("/chats/{chat_id}/presence", response_model=ChatPresence, description="If the current user is a member of the chat, returns the online and typing members.")
+async def get_chat_presence(chat_id: int, user_id: int = Depends(get_current_user_id),
+                            session: Session = Depends(db.get_session)):
+    members = await _check_member(chat_id, user_id, session)
+    return ChatPresence(chat_id=chat_id, online=presence.online(members),
+                        typing=[typing for typing in presence.typing(chat_id) if typing in members])
+
+async def _check_member(chat_id: int, user_id: int, session: Session) -> frozenset[int]:
+    members = presence.get_members(chat_id)
+    if members is None:
+        # only the first request for a chat, or the first after its membership changed, queries the database
+        members = presence.cache_members(chat_id, await run_in_threadpool(db.get_member_ids, chat_id, session))
+    if user_id not in members:
+        raise HTTPException(status_code=403, detail={
+            "error": "no_permission",
+            "error_description": "requires permission to view chat"
+        })
+    return members
@@ -1,37 +1,80 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from typing import Optional
 from sqlmodel import Session
 
+from backend import auth
 from backend import database as db
 from backend.auth import get_current_user, InvalidToken
+from backend.contention import if_match_version, set_etag
+from backend.compression import compressible
 from backend.entities import (   
     UserInDB, 
     UserCollection,
+    UserPage,
     UserResponse,
     ChatCollection,
+    MentionPage,
     UserUpdate
 )
 
 users_router = APIRouter(prefix="/users", tags=["Users"])
 
+# the maximum number of ids accepted by a batch lookup
+MAX_BATCH_IDS = 500
+
 # Returns the user currently logged in. 
 @users_router.get("/me", response_model=UserResponse, description="Returns the current user.")
-def get_current_user(user: UserInDB = Depends(get_current_user)):
+def get_current_user(response: Response, user: UserInDB = Depends(get_current_user)):
+    set_etag(response, user.version)
     return UserResponse(user=user)
 
 # Updates the currently logged in user's username or email, depending on their choice. 
+# The user's ETag may be sent in 'If-Match' (412 if the user changed since); a concurrent edit returns 409.
+# The route above shadows 'get_current_user', so the auth dependency is named through its module.
 @users_router.put("/me", response_model=UserResponse, status_code=200, description="Updates the username/email of the current user.")
-def update_current_user(user_update: UserUpdate, user: UserInDB = Depends(get_current_user), session: Session = Depends(db.get_session)):
+def update_current_user(user_update: UserUpdate, response: Response,
+                        expected_version: Optional[int] = Depends(if_match_version),
+                        user: UserInDB = Depends(auth.get_current_user), session: Session = Depends(db.get_session)):
     if user:
-        return UserResponse(user=db.update_user(user, user_update, session))
+        user = db.update_user(user, user_update, session, expected_version)
+        set_etag(response, user.version)
+        return UserResponse(user=user)
     
     raise InvalidToken()
 
-# Returns a list of users sorted by id (str), along with a count of all users (int).
-@users_router.get("", response_model=UserCollection, description="Get all users from the system, along with a count.")
-def get_all_users(session: Session = Depends(db.get_session)):
-    users = db.get_all_users(session)
-    return UserCollection(meta={"count": len(users)}, 
-                          users=sorted(users, key=lambda user: user.id))
+# Returns a page of the messages mentioning the current user with '@username' in the chats they are a member of,
+# newest first, read from the mentions index.
+@users_router.get("/me/mentions", response_model=MentionPage, response_model_exclude_none=True, description="Returns a page of the messages mentioning the current user, newest first.")
+def get_current_user_mentions(limit: int = Query(50, ge=1, le=200, description="The maximum number of messages to return."),
+                              cursor: Optional[str] = Query(None, description="The 'next_cursor' of the previous page."),
+                              user: UserInDB = Depends(auth.get_current_user), session: Session = Depends(db.get_session)):
+    mentions, next_cursor = db.get_mentions(user.id, session, limit, cursor)
+    return MentionPage(mentions=mentions, next_cursor=next_cursor)
+
+# Returns a page of users sorted by id (str), 100 unless 'limit' says otherwise, along with a count of all users (int).
+# When 'ids' is given, returns only the users with those ids (a batch lookup), along with a count of the users found.
+@users_router.get("", response_model=UserPage, response_model_exclude_none=True, description="Get a page of users from the system, or the users with the given ids, along with a count.")
+@compressible(cache=True)
+def get_all_users(ids: Optional[str] = Query(None, description="Comma-separated user ids to look up, e.g. 1,2,3."),
+                  limit: int = Query(100, ge=1, le=1000, description="The maximum number of users to return."),
+                  cursor: Optional[str] = Query(None, description="The 'next_cursor' of the previous page."),
+                  session: Session = Depends(db.get_session)):
+    if ids is not None:
+        users = db.get_users_by_ids(_parse_ids(ids), session)
+        return UserPage(meta={"count": len(users)}, users=users)
+
+    users, next_cursor = db.get_all_users(session, limit, cursor)
+    return UserPage(meta={"count": db.count_users(session)}, users=users, next_cursor=next_cursor)
+
+# Returns the users whose username starts with the query (case-insensitive), optionally matching emails too, along with a count.
+# Declared before '/{user_id}' so "search" is not parsed as a user id.
+@users_router.get("/search", response_model=UserCollection, description="Search users by username (or email) prefix.")
+def search_users(q: str = Query(..., min_length=1, max_length=100, description="The prefix to search for."),
+                 limit: int = Query(20, ge=1, le=100, description="The maximum number of users to return."),
+                 email: bool = Query(False, description="Also match users whose email starts with the query."),
+                 session: Session = Depends(db.get_session)):
+    users = db.search_users(q, session, limit, include_email=email)
+    return UserCollection(meta={"count": len(users)}, users=users)
 
 # If the user exists, returns a user for a given user id (str). If they do not exist, returns a 404 HTTP status code.
 @users_router.get("/{user_id}", response_model=UserResponse, description="Get a user from a given id.")
@@ -40,7 +83,20 @@ def get_user_by_id(user_id: int, session: Session = Depends(db.get_session)):
 
 # Returns a list of chats for a given user (by user id), along with a count of the total of chats sent (int). 
 @users_router.get("/{user_id}/chats", response_model=ChatCollection, description="Returns a list of chats for a given user, found by user id.")
+@compressible(cache=True)
 def get_user_chats(user_id: int, session: Session = Depends(db.get_session)):
     user = db.get_user_by_id(user_id, session)
     return ChatCollection(meta={"count": len(user.chats)},
-                          chats=user.chats)
\ No newline at end of file
+                          chats=user.chats)
+
+def _parse_ids(ids: str) -> list[int]:
+    try:
+        user_ids = sorted({int(user_id) for user_id in ids.split(",") if user_id.strip()})
+    except ValueError:
+        user_ids = None
+    if not user_ids or len(user_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=422, detail={
+            "error": "invalid_ids",
+            "error_description": f"ids must be 1 to {MAX_BATCH_IDS} comma-separated integers"
+        })
+    return user_ids
@@ -0,0 +1,89 @@
+## This class contains the read-only row types of collection queries for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# Collection routes only read, so loading ORM entities for them pays for identity-map entries,
+# instance state, relationship bookkeeping and the password hash of every user, only to copy the
+# data into response models. Their queries select just the columns a response needs into the
+# '__slots__' classes below instead. Users are de-duplicated per query by 'UserRows', so a page of
+# 10,000 messages written by 20 people holds 20 user rows (or dicts), not 10,000.
+#
+# The response models read these rows through their attributes, exactly as they read entities.
+
+from datetime import datetime
+from typing import Optional
+
+from backend.entities import UserInDB
+
+# the columns of a user included in responses, in the order 'UserRow' takes them
+USER_COLUMNS = ("id", "username", "email", "created_at")
+
+def user_columns(user=UserInDB) -> tuple:
+    """
+    :param user - the users entity, or an alias of it when a statement joins users more than once.
+    :return - the columns selected for a 'UserRow', in order.
+    """
+    return tuple(getattr(user, column) for column in USER_COLUMNS)
+
+class UserRow:
+    __slots__ = USER_COLUMNS
+
+    def __init__(self, id: int, username: str, email: str, created_at: datetime):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.created_at = created_at
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "username": self.username, "email": self.email, "created_at": self.created_at}
+
+class ChatPreviewRow:
+    __slots__ = ("message_id", "user", "text")
+
+    def __init__(self, message_id: int, user: UserRow, text: str):
+        self.message_id = message_id
+        self.user = user
+        self.text = text
+
+class InboxChatRow:
+    __slots__ = ("id", "name", "owner", "created_at", "last_activity_at", "last_message")
+
+    def __init__(self, id: int, name: str, owner: UserRow, created_at: datetime, last_activity_at: datetime,
+                 last_message: Optional[ChatPreviewRow]):
+        self.id = id
+        self.name = name
+        self.owner = owner
+        self.created_at = created_at
+        self.last_activity_at = last_activity_at
+        self.last_message = last_message
+
+class UserRows:
+    """Builds one 'UserRow' (and one dict, for cached messages) per distinct user id."""
+
+    __slots__ = ("_rows", "_dicts")
+
+    def __init__(self):
+        self._rows: dict[int, UserRow] = {}
+        self._dicts: dict[int, dict] = {}
+
+    def row(self, values) -> Optional[UserRow]:
+        """
+        :param values - the 'user_columns' values of a result row; all None for an unmatched outer join.
+        :return - the shared row of the user, or None.
+        """
+        user_id = values[0]
+        if user_id is None:
+            return None
+        row = self._rows.get(user_id)
+        if row is None:
+            row = self._rows[user_id] = UserRow(*values)
+        return row
+
+    def dict(self, user_id: int) -> dict:
+        """
+        :param user_id - id of a user already added through 'row'.
+        :return - the shared dict of the user, matching the User model.
+        """
+        user = self._dicts.get(user_id)
+        if user is None:
+            user = self._dicts[user_id] = self._rows[user_id].to_dict()
+        return user
@@ -0,0 +1,123 @@
+## This class contains single-flight coalescing of chat reads for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# When a popular chat changes, every member's client refetches it within a few milliseconds. The
+# first of those identical reads becomes the leader and runs the database load and serialization;
+# reads with the same key that arrive while it runs wait for its body instead of repeating the work.
+# Authorization is not part of the shared work: every request checks membership before joining.
+#
+# A read must never be answered by a load that started before a write the reader could already
+# see. Keys therefore carry a per-chat generation, which the mutators bump after committing (and
+# the invalidation bus bumps for writes of other workers), so reads arriving after a write start a
+# new load. Followers wait a bounded time, and load on their own if the leader fails or is slow.
+
+import os
+import threading
+from typing import Callable, Hashable, Optional, TypeVar
+
+from backend import events
+
+wait_seconds = float(os.environ.get("COALESCE_WAIT_SECONDS", default="2"))
+# number of striped generation counters, shared by chats whose ids are equal modulo the count
+GENERATION_STRIPES = 1024
+
+T = TypeVar("T")
+
+class _Flight:
+    __slots__ = ("done", "value", "failed")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+class SingleFlight:
+    """Runs at most one load per key at a time and hands its result to every concurrent caller."""
+
+    def __init__(self, wait_seconds: float = wait_seconds):
+        self.wait_seconds = wait_seconds
+        self._flights: dict[tuple, _Flight] = {}
+        self._generations = [0] * GENERATION_STRIPES
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def do(self, scope: int, key: Hashable, load: Callable[[], T]) -> T:
+        """
+        Returns the result of 'load', shared with every caller of the same scope and key while it runs.
+
+        :param scope - the id of the chat the load reads; 'invalidate' on it starts new loads.
+        :param key - identifies the load within the scope, e.g. the route and its query parameters.
+        :param load - the function loading the result; its result must not be modified by callers.
+        :return - the result of this caller's or a concurrent caller's load.
+        """
+        flight_key = (scope, self._generations[scope % GENERATION_STRIPES], key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = _Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if leader:
+            try:
+                flight.value = load()
+                return flight.value
+            except BaseException:
+                flight.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[flight_key]
+                flight.done.set()
+
+        if flight.done.wait(self.wait_seconds) and not flight.failed:
+            return flight.value
+        # the leader failed (e.g. with a 404 its followers should see themselves) or is too slow
+        with self._lock:
+            if flight.failed:
+                self.failures += 1
+            else:
+                self.timeouts += 1
+        return load()
+
+    def invalidate(self, scope: int):
+        """
+        Makes later callers of the scope start a new load instead of joining a running one.
+
+        :param scope - the id of the changed chat.
+        """
+        with self._lock:
+            self._generations[scope % GENERATION_STRIPES] += 1
+
+    def clear(self):
+        with self._lock:
+            for stripe in range(GENERATION_STRIPES):
+                self._generations[stripe] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+                "wait_seconds": self.wait_seconds,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.leaders = self.followers = self.timeouts = self.failures = 0
+
+chat_reads = SingleFlight()
+
+events.subscribe("chat", chat_reads.invalidate)
+events.subscribe("chat_messages", chat_reads.invalidate)
+events.subscribe("membership", chat_reads.invalidate)
+events.subscribe("user", lambda _user_id: chat_reads.clear())
+events.subscribe_reset(chat_reads.clear)
@@ -0,0 +1,123 @@
+## This class contains the startup warmup for the Spring 2024 CS 4550 Pony Express application.
+# Author: Riley Kraabel
+#
+# After a deploy, the first requests used to pay for everything a worker does only once: importing
+# the JWT and bcrypt libraries, initializing the bcrypt backend, compiling every SQL statement on
+# first use, and opening the pooled database connections. 'start' does this work on a background
+# thread once the lifespan has started, and records how long each phase took. The server accepts
+# requests meanwhile, and 'GET /health/ready' answers 503 until the warmup finishes.
+#
+# 'main.py' imports this module first, so the "import" phase covers importing the whole app.
+
+import time
+
+started_at = time.perf_counter()
+
+import logging
+import os
+import threading
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session
+
+from backend import auth
+from backend import database as db
+
+# the number of pooled connections opened at startup; later connections open on demand
+warmup_connections = int(os.environ.get("WARMUP_CONNECTIONS", default="8"))
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_ready = False
+_phases: dict[str, float] = {}
+_statements = 0
+
+def record_phase(name: str, phase_started_at: float):
+    """
+    Records the duration of a startup phase.
+
+    :param name - the name of the phase, e.g. "database".
+    :param phase_started_at - the 'time.perf_counter()' at which the phase started.
+    """
+    with _lock:
+        _phases[name] = round((time.perf_counter() - phase_started_at) * 1000, 1)
+
+def start(engine: Engine) -> threading.Thread:
+    """
+    Warms the worker up on a background thread, so the server accepts requests (and reports itself
+    not ready) in the meantime.
+
+    :param engine - the engine whose statement cache and connection pool are warmed.
+    :return - the warmup thread.
+    """
+    thread = threading.Thread(target=_run_logged, args=(engine,), name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+def _run_logged(engine: Engine):
+    try:
+        run(engine)
+    except Exception:
+        # the worker stays not ready, so the load balancer keeps routing around it
+        logger.exception("warmup failed")
+
+def run(engine: Engine, connections: int = warmup_connections):
+    """
+    Warms the worker up and marks it ready. Called once the database is created and migrated.
+
+    :param engine - the engine whose statement cache and connection pool are warmed.
+    :param connections - the number of pooled connections to open.
+    """
+    global _ready, _statements
+    phase_started_at = time.perf_counter()
+    with Session(engine) as session:
+        auth.warm_up(session)
+    record_phase("crypto", phase_started_at)
+
+    phase_started_at = time.perf_counter()
+    with Session(engine) as session:
+        statements = db.warm_statements(session)
+    record_phase("statements", phase_started_at)
+
+    phase_started_at = time.perf_counter()
+    _prime_pool(engine, connections)
+    record_phase("pool", phase_started_at)
+
+    record_phase("total", started_at)
+    with _lock:
+        _ready = True
+        _statements = statements
+    logger.info("ready after %s ms (%s; %s reads warmed)", _phases["total"],
+                ", ".join(f"{name} {ms} ms" for name, ms in _phases.items() if name != "total"), statements)
+
+def _prime_pool(engine: Engine, connections: int):
+    # a QueuePool keeps at most 'size' idle connections; other pools reuse a single one
+    size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+    opened = []
+    try:
+        for _ in range(min(connections, size)):
+            opened.append(engine.raw_connection())
+    finally:
+        # returning them leaves them idle in the pool, ready for the first requests
+        for connection in opened:
+            connection.close()
+
+def is_ready() -> bool:
+    with _lock:
+        return _ready
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "ready": _ready,
+            "phases_ms": dict(_phases),
+            "statements": _statements,
+        }
+
+def reset():
+    """Marks the worker as not ready, e.g. while it shuts down."""
+    global _ready
+    with _lock:
+        _ready = False
@@ -180,16 +180,17 @@ function AddUser({ chatId }) {
     const [users, setUsers] = useState([]);
     const [selectedUser, setSelectedUser] = useState(0);
     const [addUser, setAddUser] = useState(false);
+    const [search, setSearch] = useState("");
 
-    // Retrieve all users from the database //
-    const { data: allUsersData } = useQuery("allUsers", async () => {
-        const response = await fetch("http://127.0.0.1:8000/users", {
+    // Search the user directory by username prefix; nothing is fetched until something is typed //
+    const { data: allUsersData } = useQuery(["searchUsers", search], async () => {
+        const response = await fetch(`http://127.0.0.1:8000/users/search?q=${encodeURIComponent(search)}&limit=20`, {
             headers: {
                 Authorization: `Bearer ${token}`,
             },
         });
         return response.json();
-    });
+    }, { enabled: search.length > 0, keepPreviousData: true });
 
     // Retrieve all users in the current chat //
     const { data: chatUsersData } = useQuery(["chatUsers", chatId], async () => {
@@ -203,13 +204,16 @@ function AddUser({ chatId }) {
 
     // Filter out the users who are already in the chat; only display the ones not present //
     useEffect(() => {
-        if (allUsersData && chatUsersData) {
+        if (search.length === 0) {
+            setUsers([]);
+        }
+        else if (allUsersData?.users && chatUsersData) {
             const filteredUsers = allUsersData.users.filter(user =>
                 !chatUsersData.users.find(chatUser => chatUser.id === user.id)
             );
             setUsers(filteredUsers);
         }
-    }, [allUsersData, chatUsersData]);
+    }, [allUsersData, chatUsersData, search]);
 
     // method to handle when the user changes //
     const handleUserChange = (e) => {
@@ -256,6 +260,7 @@ function AddUser({ chatId }) {
 
     return (
         <div className="flex flex-row justify-between items-center ml-3 mb-3">
+            <FormInput type="search" value={search} onChange={(e) => setSearch(e.target.value)} placeholder="search users" />
             <select className="border-2 rounded border-white-900 bg-zinc-800 w-1/2" onChange={handleUserChange} value={selectedUser}>
                 <option value="" disabled>add a user</option>
                 {users.map(user => (
@@ -37,7 +37,7 @@ function LeftNav() {
   const { data } = useQuery({
     queryKey: ["chats"],
     queryFn: () => (
-      fetch("http://127.0.0.1:8000/chats", {
+      fetch("http://127.0.0.1:8000/chats?sort=recent", {
         headers: {
           Authorization: `Bearer ${token}`
         },
@@ -0,0 +1,82 @@
+import tracemalloc
+
+import pytest
+
+from backend.allocations import AllocationProfiler, allocation_profiler
+
+@pytest.fixture(autouse=True)
+def profiler(monkeypatch):
+    monkeypatch.setattr(allocation_profiler, "enabled", False)
+    yield allocation_profiler
+    allocation_profiler.clear_snapshot()
+    allocation_profiler.reset()
+
+def test_sampled_requests_record_peak_net_and_sites():
+    profiler = AllocationProfiler(enabled=True, sample_rate=1)
+    measurement = profiler.begin()
+    assert tracemalloc.is_tracing()
+    assert profiler.begin() is None
+
+    held = bytearray(200_000)
+    transient = bytearray(500_000)
+    del transient
+    profiler.end(measurement, "GET /chats/{chat_id}")
+
+    assert not tracemalloc.is_tracing()
+    [route] = profiler.routes()
+    assert route["route"] == "GET /chats/{chat_id}"
+    assert route["max_peak_bytes"] >= 700_000
+    assert 200_000 <= route["max_net_bytes"] < 500_000
+    assert "allocations_test.py" in route["top_sites"][0]["site"]
+    assert profiler.stats()["skipped"] == 1
+    assert len(held) == 200_000
+
+def test_tracing_started_elsewhere_is_left_on():
+    tracemalloc.start()
+    try:
+        profiler = AllocationProfiler(enabled=True, sample_rate=1)
+        profiler.end(profiler.begin(), "GET /chats")
+        assert tracemalloc.is_tracing()
+        profiler.snapshot()
+        profiler.clear_snapshot()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+def test_unsampled_requests_are_not_traced():
+    profiler = AllocationProfiler(enabled=True, sample_rate=0)
+    assert profiler.begin() is None
+    assert AllocationProfiler(enabled=False, sample_rate=1).begin() is None
+
+def test_route_aggregates_are_reported_to_admins(client, login, admin_headers):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "burst"}, headers=headers).json()["chat"]["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "hi"}, headers=headers)
+
+    stats = client.put("/admin/memory", params={"enabled": True, "sample_rate": 1}, headers=admin_headers).json()
+    assert (stats["enabled"], stats["sample_rate"]) == (True, 1)
+    for _ in range(3):
+        client.get(f"/chats/{chat_id}", params={"include": ["messages", "users"]}, headers=headers)
+    client.put("/admin/memory", params={"enabled": False}, headers=admin_headers)
+
+    routes = {route["route"]: route for route in client.get("/admin/memory", headers=admin_headers).json()["routes"]}
+    assert routes["GET /chats/{chat_id}"]["count"] == 3
+    assert routes["GET /chats/{chat_id}"]["max_peak_bytes"] > 0
+
+    assert client.delete("/admin/memory", headers=admin_headers).status_code == 204
+    assert client.get("/admin/memory", headers=admin_headers).json()["routes"] == []
+    assert client.get("/admin/memory", headers=login("ripley")).status_code == 403
+
+def test_snapshot_diffs_show_growth_since_the_baseline(client, admin_headers):
+    baseline = client.post("/admin/memory/snapshots", headers=admin_headers).json()
+    assert baseline["sites"] == []
+    assert tracemalloc.is_tracing()
+
+    grown = [bytes(1000) + bytes([index % 256]) for index in range(300)]
+    diff = client.post("/admin/memory/snapshots", headers=admin_headers).json()
+    assert diff["baseline_at"] == baseline["baseline_at"]
+    assert any("allocations_test.py" in site["site"] and site["size_diff"] >= 300_000 for site in diff["sites"])
+
+    assert client.delete("/admin/memory/snapshots", headers=admin_headers).status_code == 204
+    assert not tracemalloc.is_tracing()
+    assert len(grown) == 300
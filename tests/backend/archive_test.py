@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import delete, func, select
+
+from backend import archive, migrations
+from backend.entities import AttachmentInDB, MessageFlagInDB, MessageInDB, MessageRollupInDB
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "archive_dir", str(tmp_path))
+    monkeypatch.setattr(archive, "BLOCK_SIZE", 2)
+
+def _chat_with_messages(client, headers, count):
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=headers).json()["chat"]["id"]
+    for index in range(count):
+        client.post(f"/chats/{chat_id}/messages", json={"text": f"message {index}"}, headers=headers)
+    return chat_id
+
+def _age_messages(session, count):
+    messages = session.exec(select(MessageInDB).order_by(MessageInDB.id).limit(count)).all()
+    for message in messages:
+        message.created_at = datetime.now() - timedelta(days=365)
+        session.add(message)
+    session.commit()
+
+def test_archived_messages_are_read_back_in_order(client, session, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 6)
+    _age_messages(session, 4)
+
+    assert archive.archive_old_messages(session, datetime.now() - timedelta(days=30)) == 4
+    assert len(session.exec(select(MessageInDB)).all()) == 2
+
+    response = client.get(f"/chats/{chat_id}/messages", headers=headers)
+    assert response.json()["meta"]["count"] == 6
+    assert [message["text"] for message in response.json()["messages"]] == [f"message {index}" for index in range(6)]
+
+def test_messages_are_archived_in_batches_with_their_attachments_and_flags(client, session, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 6)
+    _age_messages(session, 5)
+    message_ids = session.exec(select(MessageInDB.id).order_by(MessageInDB.id)).all()
+    user_id = session.get(MessageInDB, message_ids[0]).user_id
+    for message_id in (message_ids[0], message_ids[5]):
+        session.add(AttachmentInDB(chat_id=chat_id, message_id=message_id, user_id=user_id, sha256="0" * 64,
+                                   filename="map.png", content_type="image/png", size=1))
+        session.add(MessageFlagInDB(chat_id=chat_id, message_id=message_id, user_id=user_id, terms="xenomorph"))
+    session.commit()
+
+    assert archive.archive_old_messages(session, datetime.now() - timedelta(days=30), batch_size=2) == 5
+    assert len(archive._read_index(chat_id)["segments"]) == 3
+    assert session.exec(select(AttachmentInDB.message_id)).all() == [message_ids[5]]
+    assert session.exec(select(MessageFlagInDB.message_id)).all() == [message_ids[5]]
+    texts = [message["text"] for message in client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"]]
+    assert texts == [f"message {index}" for index in range(6)]
+
+def test_paging_continues_past_the_hot_range(client, session, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 6)
+    _age_messages(session, 4)
+    archive.archive_old_messages(session, datetime.now() - timedelta(days=30))
+
+    newest = client.get(f"/chats/{chat_id}/messages", params={"limit": 3}, headers=headers).json()["messages"]
+    assert [message["text"] for message in newest] == ["message 3", "message 4", "message 5"]
+
+    older = client.get(f"/chats/{chat_id}/messages", params={"limit": 3, "before": newest[0]["id"]},
+                       headers=headers).json()["messages"]
+    assert [message["text"] for message in older] == ["message 0", "message 1", "message 2"]
+    assert older[0]["user"]["username"] == "ripley"
+
+def test_rollup_backfill_counts_archived_messages(client, session, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 6)
+    _age_messages(session, 4)
+    archive.archive_old_messages(session, datetime.now() - timedelta(days=30))
+    session.exec(delete(MessageRollupInDB))
+    session.commit()
+
+    connection = session.get_bind().raw_connection()
+    migrations._backfill_message_rollups(connection.cursor())
+    connection.commit()
+
+    def total(granularity, **filters):
+        statement = select(func.sum(MessageRollupInDB.count)).where(MessageRollupInDB.granularity == granularity)
+        for column, value in filters.items():
+            statement = statement.where(getattr(MessageRollupInDB, column) == value)
+        return session.exec(statement).one()
+
+    assert total("hour") == total("day") == 6
+    year_ago = (datetime.now() - timedelta(days=365)).replace(hour=0, minute=0, second=0, microsecond=0)
+    assert total("day", chat_id=chat_id, bucket_start=year_ago) == 4
+
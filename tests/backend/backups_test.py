@@ -0,0 +1,128 @@
+import gzip
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine
+
+from backend import backups, jobs
+from backend.entities import JobInDB
+from backend.jobs import JobRunner
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "live.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT)")
+    connection.executemany("INSERT INTO notes (body) VALUES (?)", [("x" * 500,) for _ in range(2000)])
+    connection.commit()
+    connection.close()
+    return path
+
+def _restore(snapshot_path: str, tmp_path) -> sqlite3.Connection:
+    restored = tmp_path / "restored.db"
+    with gzip.open(snapshot_path) as snapshot, open(restored, "wb") as file:
+        file.write(snapshot.read())
+    return sqlite3.connect(restored)
+
+def test_backup_copies_a_live_database_in_steps(database, tmp_path):
+    stop = threading.Event()
+
+    def write():
+        writer = sqlite3.connect(database, timeout=30)
+        while not stop.is_set():
+            writer.execute("INSERT INTO notes (body) VALUES ('live')")
+            writer.commit()
+            time.sleep(0.01)
+        writer.close()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        result = backups.backup(database, str(tmp_path / "backups"), pages=8, sleep_ms=1)
+    finally:
+        stop.set()
+        writer.join()
+
+    assert result["steps"] > 1
+    assert result["compressed_bytes"] < result["bytes"]
+    assert backups.verify(result["path"])
+    restored = _restore(result["path"], tmp_path)
+    assert restored.execute("SELECT COUNT(*) FROM notes WHERE body != 'live'").fetchone()[0] == 2000
+    assert restored.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+
+def test_backup_that_keeps_restarting_finishes_in_one_step(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, "max_restarts", 1)
+    writer = sqlite3.connect(database)
+
+    def write_between_steps(copied, total):
+        writer.execute("INSERT INTO notes (body) VALUES ('restart')")
+        writer.commit()
+
+    result = backups.backup(database, str(tmp_path), pages=16, sleep_ms=0, on_step=write_between_steps)
+    writer.close()
+    assert (result["restarts"], result["single_step"]) == (2, True)
+    assert _restore(result["path"], tmp_path).execute("SELECT COUNT(*) FROM notes").fetchone()[0] >= 2000
+
+def test_backup_of_a_wal_database_copies_one_snapshot_while_writers_commit(database, tmp_path):
+    writer = sqlite3.connect(database, timeout=0.1)
+    writer.execute("PRAGMA journal_mode=WAL")
+
+    def write_between_steps(copied, total):
+        writer.execute("INSERT INTO notes (body) VALUES ('heartbeat')")
+        writer.commit()
+
+    result = backups.backup(database, str(tmp_path), pages=16, sleep_ms=0, on_step=write_between_steps)
+    writer.close()
+    assert (result["snapshot"], result["restarts"], result["single_step"]) == (True, 0, False)
+    assert result["steps"] > 1
+    restored = _restore(result["path"], tmp_path)
+    assert restored.execute("SELECT COUNT(*) FROM notes").fetchone()[0] == 2000
+
+def test_snapshots_are_rotated_and_checksummed(database, tmp_path):
+    directory = str(tmp_path / "backups")
+    paths = [backups.backup(database, directory, keep_snapshots=2)["path"] for _ in range(3)]
+
+    assert [snapshot["name"] for snapshot in backups.list_snapshots(directory)] == [
+        os.path.basename(path) for path in reversed(paths[1:])
+    ]
+    assert not os.path.exists(paths[0] + ".sha256")
+    with open(paths[2], "ab") as snapshot:
+        snapshot.write(b"corrupt")
+    assert not backups.verify(paths[2])
+
+def test_maintenance_analyzes_and_vacuums_free_pages(database):
+    backups.enable_incremental_vacuum(database)
+    connection = sqlite3.connect(database)
+    connection.execute("DELETE FROM notes")
+    connection.commit()
+    assert connection.execute("PRAGMA freelist_count").fetchone()[0] > 0
+
+    result = backups.maintain(database, sleep_ms=0)
+    assert result["incremental_vacuum"] and result["free_pages"] > 0
+    assert result["free_pages_left"] == 0
+    assert connection.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] >= 0
+
+def test_scheduled_jobs_are_queued_once_per_interval(session):
+    assert set(jobs.enqueue_due(session)) == {"backup_database", "database_maintenance", "expire_uploads"}
+    assert jobs.enqueue_due(session) == []
+
+def test_backup_jobs_run_against_the_database_file(tmp_path, monkeypatch, client, admin_headers):
+    monkeypatch.setattr(backups, "backup_dir", str(tmp_path / "backups"))
+    response = client.post("/admin/backups", headers=admin_headers)
+    assert (response.status_code, response.json()["job"]["kind"]) == (202, "backup_database")
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'pony.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        job = jobs.enqueue(session, "backup_database", {})
+        session.commit()
+        job_id = job.id
+    JobRunner(engine).run_until_idle()
+    with Session(engine) as session:
+        assert session.get(JobInDB, job_id).status == "succeeded"
+
+    [snapshot] = client.get("/admin/backups", headers=admin_headers).json()["snapshots"]
+    assert snapshot["name"].startswith("pony-") and len(snapshot["sha256"]) == 64
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from backend import capture
+from backend.capture import TrafficRecorder, traffic_recorder
+
+@pytest.fixture
+def recorder(tmp_path):
+    traffic_recorder.start(str(tmp_path / "trace.ndjson"))
+    yield traffic_recorder
+    traffic_recorder.stop()
+
+def _lines(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+def test_captured_requests_are_sanitized(client, login, recorder):
+    headers = login("ripley")
+    client.post("/chats", json={"name": "first"}, headers=headers)
+    chat_id = client.post("/chats", json={"name": "second"}, headers=headers).json()["chat"]["id"]
+    message_id = client.post(f"/chats/{chat_id}/messages", json={"text": "launch codes"},
+                             headers=headers).json()["message"]["id"]
+    client.get(f"/chats/{chat_id}/messages", params={"limit": 5, "before": message_id + 1}, headers=headers)
+    client.get("/users/search", params={"q": "rip"}, headers=headers)
+    client.get("/admin/queries", headers=headers)
+    recorder.stop()
+
+    header, *records = _lines(recorder.path)
+    assert header["version"] == 1
+    text = open(recorder.path).read()
+    assert "launch codes" not in text and "ripley" not in text and "Bearer" not in text
+
+    routes = [record[1] for record in records]
+    assert routes == ["POST /auth/registration", "POST /auth/token", "POST /chats", "POST /chats",
+                      "POST /chats/{chat_id}/messages", "GET /chats/{chat_id}/messages", "GET /users/search"]
+    send, read, search = records[4], records[5], records[6]
+    # the only chat used by id is the first one the trace sees
+    assert send[2] == {"chat_id": 1} and send[4] == 1
+    assert send[5] > len("launch codes") and send[6] == 201
+    assert read[3] == [["limit", "5"], ["before", "1"]]
+    assert search[3] == [["q", None]]
+    assert all(record[0] <= later[0] for record, later in zip(records, records[1:]))
+
+def test_capture_sessions_restart_ids_and_stop_at_the_size_limit(tmp_path):
+    path = str(tmp_path / "small.ndjson")
+    recorder = TrafficRecorder(path=path, max_bytes=200)
+    recorder.start()
+    for index in range(10):
+        recorder.record({"route": type("Route", (), {"path": "/chats/{chat_id}"}), "method": "GET",
+                         "path_params": {"chat_id": str(100 + index % 2)}}, 0.0, 7, 0, 200, 10)
+    assert recorder.stats()["dropped"] > 0
+    recorder.max_bytes = 10 ** 6
+    recorder.start()
+    recorder.record({"route": type("Route", (), {"path": "/chats/{chat_id}"}), "method": "GET",
+                     "path_params": {"chat_id": "101"}}, 0.0, None, 0, 200, 10)
+    recorder.stop()
+
+    lines = _lines(path)
+    headers = [index for index, line in enumerate(lines) if isinstance(line, dict)]
+    assert len(headers) == 2
+    first_session = lines[1:headers[1]]
+    assert 0 < len(first_session) < 10
+    assert [record[2]["chat_id"] for record in first_session[:2]] == [1, 2]
+    assert lines[-1][2] == {"chat_id": 1} and lines[-1][4] is None
+
+def test_admins_can_only_name_trace_files_in_the_capture_directory(client, admin_headers, tmp_path, monkeypatch):
+    monkeypatch.setattr(capture, "capture_path", str(tmp_path / "traffic" / "capture.ndjson"))
+    (tmp_path / "traffic").mkdir()
+    (tmp_path / "traffic" / "escape.ndjson").symlink_to(tmp_path / "outside.ndjson")
+    for name in ("../outside.ndjson", "/tmp/evil.ndjson", "notes.txt", "escape.ndjson"):
+        response = client.put("/admin/capture", params={"enabled": True, "file": name}, headers=admin_headers)
+        assert (response.status_code, response.json()["detail"]["error"]) == (422, "invalid_file")
+
+    try:
+        response = client.put("/admin/capture", params={"enabled": True, "file": "second.ndjson"}, headers=admin_headers)
+        assert response.status_code == 200
+        assert traffic_recorder.path == str((tmp_path / "traffic" / "second.ndjson").resolve())
+    finally:
+        traffic_recorder.stop()
+
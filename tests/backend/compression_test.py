@@ -0,0 +1,51 @@
+import gzip
+
+from backend import compression
+from backend.compression import choose_encoding, compressed_cache
+
+def _chat_with_messages(client, headers, count):
+    chat_id = client.post("/chats", json={"name": "busy"}, headers=headers).json()["chat"]["id"]
+    for index in range(count):
+        client.post(f"/chats/{chat_id}/messages", json={"text": f"message number {index}"}, headers=headers)
+    return chat_id
+
+def test_choose_encoding_respects_quality():
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding("identity") is None
+    assert choose_encoding("*") == next(iter(compression.ENCODERS))
+
+def test_large_collections_are_compressed(client, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 30)
+
+    response = client.get(f"/chats/{chat_id}/messages", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert len(response.json()["messages"]) == 30
+
+def test_small_responses_are_not_compressed(client, login):
+    headers = login("ripley")
+    response = client.get("/users/me", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+def test_identical_bodies_reuse_cached_compression(client, login):
+    headers = {**login("ripley"), "Accept-Encoding": "gzip"}
+    chat_id = _chat_with_messages(client, headers, 30)
+    compressed_cache.clear()
+
+    first = client.get(f"/chats/{chat_id}/messages", headers=headers)
+    second = client.get(f"/chats/{chat_id}/messages", headers=headers)
+    assert first.json() == second.json()
+    assert compressed_cache.stats()["hits"] == 1
+
+    client.post(f"/chats/{chat_id}/messages", json={"text": "one more"}, headers=headers)
+    third = client.get(f"/chats/{chat_id}/messages", headers=headers)
+    assert len(third.json()["messages"]) == 31
+    assert compressed_cache.stats()["hits"] == 1
+
+def test_compressed_body_round_trips():
+    body = b'{"messages": []}' * 200
+    assert gzip.decompress(compression.ENCODERS["gzip"](body, 6)) == body
@@ -3,7 +3,12 @@ from fastapi.testclient import TestClient
 from sqlmodel import Session, SQLModel, StaticPool, create_engine
 
 from backend.main import app
+from backend import auth
 from backend import database as db
+from backend.jobs import JobRunner
+from backend.mentions import username_directory
+from backend.message_cache import message_cache
+from backend.presence import presence
 
 @pytest.fixture
 def session():
@@ -13,6 +18,10 @@ def session():
         poolclass=StaticPool
     )
     SQLModel.metadata.create_all(engine)
+    message_cache.clear()
+    message_cache.reset_stats()
+    presence.clear()
+    username_directory.clear()
     with Session(engine) as session:
         yield session
 
@@ -28,3 +37,27 @@ def client(session):
 
     app.dependency_overrides.clear()
 
+
+@pytest.fixture
+def login(client):
+    def _login(username):
+        client.post(
+            "/auth/registration",
+            json={"username": username, "email": f"{username}@example.com", "password": username},
+        )
+        response = client.post("/auth/token", data={"username": username, "password": username})
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    return _login
+
+
+@pytest.fixture
+def admin_headers(login, monkeypatch):
+    monkeypatch.setattr(auth, "admin_usernames", {"ash"})
+    return login("ash")
+
+
+@pytest.fixture
+def run_jobs(session):
+    # runs every queued job in the test's thread, against the test database
+    return JobRunner(session.get_bind()).run_until_idle
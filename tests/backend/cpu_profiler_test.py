@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from backend.cpu_profiler import SamplingProfiler, cpu_profiler
+
+def _spin(stop: threading.Event):
+    total = 0
+    while not stop.is_set():
+        total += sum(range(1000))
+    return total
+
+def _churn(stop: threading.Event):
+    while not stop.is_set():
+        sorted(str(number) for number in range(1000))
+
+@pytest.fixture
+def busy_threads():
+    stop = threading.Event()
+    threads = [threading.Thread(target=target, args=(stop,)) for target in (_spin, _churn)]
+    # a thread that only waits, and is therefore left out of the samples
+    threads.append(threading.Thread(target=stop.wait))
+    for thread in threads:
+        thread.start()
+    yield
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+def test_samples_busy_threads_as_collapsed_stacks(busy_threads):
+    profiler = SamplingProfiler()
+    profile = profiler.start(seconds=0.3, rate=200)
+    assert profiler.start(seconds=1) is None
+    assert profiler.wait(5)
+
+    summary = profile.summary()
+    assert summary["status"] == "finished"
+    assert summary["samples"] > 0 and summary["idle_samples"] > 0
+    functions = [function["function"] for function in summary["top_functions"]]
+    assert any(function.startswith("_spin (") for function in functions)
+    assert any(function.startswith("_churn") for function in functions)
+
+    lines = profile.collapsed().splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert not any(line.rsplit(" ", 1)[0].split(";")[-1].startswith("wait (threading.py") for line in lines)
+
+def test_route_filter_keeps_only_stacks_through_the_endpoint(busy_threads):
+    profiler = SamplingProfiler()
+    profile = profiler.start(seconds=0.3, rate=200, route="spin", route_codes=frozenset({_spin.__code__}))
+    profiler.wait(5)
+
+    assert profile.filtered > 0
+    assert profile.collapsed()
+    assert all("_spin (" in line for line in profile.collapsed().splitlines())
+
+def test_admins_start_and_read_profiles(client, admin_headers, login):
+    response = client.post("/admin/profiles/cpu", params={"seconds": 0.2, "route": "GET /chats/{chat_id}"},
+                           headers=admin_headers)
+    assert response.status_code == 202
+    assert response.json()["status"] == "running"
+    assert client.post("/admin/profiles/cpu", headers=admin_headers).status_code == 409
+    cpu_profiler.wait(5)
+
+    summary = client.get("/admin/profiles/cpu", headers=admin_headers).json()
+    assert (summary["status"], summary["route"]) == ("finished", "GET /chats/{chat_id}")
+    response = client.get("/admin/profiles/cpu/collapsed", headers=admin_headers)
+    assert response.headers["content-type"].startswith("text/plain")
+
+    assert client.post("/admin/profiles/cpu", params={"route": "GET /nowhere"}, headers=admin_headers).status_code == 422
+    assert client.post("/admin/profiles/cpu", params={"seconds": 600}, headers=admin_headers).status_code == 422
+    assert client.post("/admin/profiles/cpu", headers=login("ripley")).status_code == 403
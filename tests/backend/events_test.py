@@ -0,0 +1,75 @@
+import os
+
+from sqlmodel import delete, select
+
+from backend import events
+from backend.entities import CacheEventInDB
+from backend.message_cache import message_cache
+
+
+def _subscriber(session):
+    subscriber = events.EventSubscriber(session.get_bind())
+    subscriber.generation = events._current_generation(session)
+    return subscriber
+
+def _publish_from_other_worker(session, entity, entity_id):
+    session.add(CacheEventInDB(entity=entity, entity_id=entity_id, origin="other-worker"))
+    session.commit()
+
+def test_events_from_other_workers_invalidate_cache(session):
+    subscriber = _subscriber(session)
+    message_cache.load(7, [{"id": 1, "text": "hi"}], total=1, generation=message_cache.generation(7))
+
+    _publish_from_other_worker(session, "chat_messages", 7)
+    assert subscriber.poll_once(session) == 1
+    assert message_cache.get(7) is None
+    assert subscriber.generation == 1
+
+def test_own_events_are_skipped(session):
+    subscriber = _subscriber(session)
+    message_cache.load(7, [{"id": 1, "text": "hi"}], total=1, generation=message_cache.generation(7))
+
+    events.publish(session, "chat_messages", 7)
+    session.commit()
+    subscriber.poll_once(session)
+    assert message_cache.get(7) is not None
+
+def test_missed_events_reset_caches(session):
+    subscriber = _subscriber(session)
+    _publish_from_other_worker(session, "user", 1)
+    _publish_from_other_worker(session, "user", 2)
+    session.exec(delete(CacheEventInDB).where(CacheEventInDB.id == 1))
+    session.commit()
+    message_cache.load(7, [{"id": 1, "text": "hi"}], total=1, generation=message_cache.generation(7))
+
+    subscriber.poll_once(session)
+    assert subscriber.resets == 1
+    assert subscriber.generation == 2
+    assert message_cache.get(7) is None
+
+def test_membership_changes_are_published(client, session, login):
+    owner = login("ripley")
+    login("bishop")
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=owner).json()["chat"]["id"]
+
+    assert client.put(f"/chats/{chat_id}/users/2", headers=owner).status_code == 201
+    response = client.delete(f"/chats/{chat_id}/users/2", headers=owner)
+    assert response.status_code == 200
+    assert [user["username"] for user in response.json()["users"]] == ["ripley"]
+
+    published = session.exec(select(CacheEventInDB).where(CacheEventInDB.entity == "membership")).all()
+    assert [event.entity_id for event in published] == [chat_id, chat_id]
+
+def test_forked_workers_get_their_own_id():
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_end, events.worker_id.encode())
+        os._exit(0)
+    os.close(write_end)
+    child_worker_id = os.read(read_end, 100).decode()
+    os.close(read_end)
+    os.waitpid(pid, 0)
+
+    assert child_worker_id.startswith(f"{pid}-")
+    assert child_worker_id != events.worker_id
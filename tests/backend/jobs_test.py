@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import update
+
+from backend import jobs
+from backend.entities import ChatSummaryInDB, JobInDB
+
+processed = []
+
+def _count_to(context):
+    start = context.checkpoint["next"] if context.checkpoint else 0
+    for item in range(start, context.params["to"]):
+        processed.append(item)
+        if context.params.get("cancel_at") == item:
+            context.session.exec(update(JobInDB).where(JobInDB.id == context.job_id).values(cancel_requested=True))
+            context.session.commit()
+        context.progress(item + 1, context.params["to"], checkpoint={"next": item + 1})
+
+def _explode(context):
+    raise RuntimeError("boom")
+
+jobs.register("test_count", _count_to)
+jobs.register("test_explode", _explode)
+
+@pytest.fixture(autouse=True)
+def clear_processed():
+    processed.clear()
+
+def _enqueue(session, kind, params):
+    job = jobs.enqueue(session, kind, params)
+    session.commit()
+    return job.id
+
+def test_job_runs_and_reports_progress(session, run_jobs):
+    job_id = _enqueue(session, "test_count", {"to": 4})
+    assert run_jobs() == 1
+
+    job = jobs.to_job(session.get(JobInDB, job_id))
+    assert job.status == "succeeded"
+    assert (job.completed, job.total, job.percent) == (4, 4, 100.0)
+    assert processed == [0, 1, 2, 3]
+
+def test_stale_job_resumes_from_checkpoint(session, run_jobs):
+    job_id = _enqueue(session, "test_count", {"to": 6})
+    # a worker claimed the job, checkpointed after three items, then died
+    session.exec(update(JobInDB).where(JobInDB.id == job_id).values(
+        status="running", worker_id="dead-worker", completed=3, checkpoint='{"next": 3}',
+        started_at=datetime.now(), heartbeat_at=datetime.now() - timedelta(minutes=5),
+    ))
+    session.commit()
+
+    runner = jobs.JobRunner(session.get_bind())
+    assert runner.requeue_stale(session) == 1
+    assert runner.run_until_idle() == 1
+    assert processed == [3, 4, 5]
+    session.expire_all()
+    assert session.get(JobInDB, job_id).status == "succeeded"
+
+def test_cancelling_queued_and_running_jobs(session, run_jobs):
+    queued_id = _enqueue(session, "test_count", {"to": 3})
+    jobs.request_cancel(session.get(JobInDB, queued_id), session)
+    running_id = _enqueue(session, "test_count", {"to": 10, "cancel_at": 2})
+
+    assert run_jobs() == 1
+    session.expire_all()
+    assert session.get(JobInDB, queued_id).status == "cancelled"
+    running = session.get(JobInDB, running_id)
+    assert running.status == "cancelled"
+    assert running.completed == 3
+    assert processed == [0, 1, 2]
+
+def test_failed_job_records_error(session, run_jobs):
+    job_id = _enqueue(session, "test_explode", {})
+    run_jobs()
+    session.expire_all()
+    job = session.get(JobInDB, job_id)
+    assert (job.status, job.error) == ("failed", "boom")
+
+def test_rebuild_chat_summaries_job(client, session, login, run_jobs):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "stale"}, headers=headers).json()["chat"]["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "latest"}, headers=headers)
+    summary = session.get(ChatSummaryInDB, chat_id)
+    summary.preview = "wrong"
+    session.add(summary)
+    session.commit()
+
+    _enqueue(session, "rebuild_chat_summaries", {})
+    run_jobs()
+    session.expire_all()
+    assert session.get(ChatSummaryInDB, chat_id).preview == "latest"
+
+def test_jobs_are_only_visible_to_their_creator(client, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = client.post("/chats", json={"name": "doomed"}, headers=headers).json()["chat"]["id"]
+    job_id = client.delete(f"/chats/{chat_id}", headers=headers).json()["job"]["id"]
+
+    assert client.get(f"/jobs/{job_id}", headers=headers).status_code == 200
+    assert client.get(f"/jobs/{job_id}", headers=other_headers).status_code == 403
+    assert client.get("/jobs/999", headers=headers).status_code == 404
+    # purging a deleted chat cannot be cancelled
+    assert client.post(f"/jobs/{job_id}/cancel", headers=headers).json()["job"]["status"] == "queued"
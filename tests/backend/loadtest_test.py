@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+import glob
+import os
+import random
+import tempfile
+
+from backend import loadtest
+from backend.main import app
+
+
+def test_arrivals_are_scheduled_independently_of_responses():
+    times = loadtest.arrival_times(rate=200, duration=5, rng=random.Random(1))
+    assert times == sorted(times)
+    assert 800 < len(times) < 1200
+    assert times[-1] < 5
+
+def test_percentiles_use_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([], 99) == 0.0
+
+def test_in_process_run_reports_every_route():
+    args = argparse.Namespace(target=None, users=3, members_per_chat=1, rate=100, duration=0.5,
+                              mix="get_chats=1,get_chat=1,get_messages=1,send_message=1,membership=1",
+                              connections=20, setup_concurrency=3, timeout=5, seed=7)
+    pattern = os.path.join(tempfile.gettempdir(), "pony-express-load-*.db")
+    before = set(glob.glob(pattern))
+    try:
+        result = asyncio.run(loadtest.run(args))
+    finally:
+        app.dependency_overrides.clear()
+
+    # the throwaway database is deleted with the client
+    assert set(glob.glob(pattern)) == before
+
+    assert result["routes"]
+    for summary in result["routes"].values():
+        assert 500 not in summary["statuses"]
+        assert summary["p50_ms"] <= summary["p99_ms"]
@@ -0,0 +1,76 @@
+from backend.mentions import UsernameDirectory, extract_usernames
+
+def _user_id(client, headers) -> int:
+    return client.get("/users/me", headers=headers).json()["user"]["id"]
+
+def _mentions(client, headers, **params) -> dict:
+    return client.get("/users/me/mentions", params=params, headers=headers).json()
+
+def test_extracts_distinct_mentions_but_not_emails():
+    text = "@ripley, ask @Kane. or mail ash@example.com (cc @ripley and @lambert-)"
+    assert extract_usernames(text) == ["ripley", "Kane", "lambert"]
+    assert extract_usernames("no mentions @ all") == []
+
+def test_directory_resolves_case_insensitively_unless_ambiguous():
+    directory = UsernameDirectory()
+    directory.load([(1, "ripley"), (2, "Kane"), (3, "kane")])
+    assert directory.lookup(["RIPLEY", "Kane", "kane", "KANE", "ash"]) == {"RIPLEY": 1, "Kane": 2, "kane": 3}
+
+    directory.add(1, "ellen")
+    directory.add(4, "Ash")
+    assert directory.lookup(["ripley", "ellen", "ash"]) == {"ellen": 1, "ash": 4}
+
+def test_directory_keeps_registrations_made_during_the_first_load():
+    directory = UsernameDirectory()
+
+    class Result:
+        def all(self):
+            # registered after the load read the users table
+            directory.add(2, "dallas")
+            return [(1, "ripley")]
+
+    class LoadingSession:
+        def exec(self, statement):
+            return Result()
+
+    directory.add(3, "lambert")
+    assert directory.resolve(["ripley", "dallas", "lambert"], LoadingSession()) == {"ripley": 1, "dallas": 2}
+
+def test_mentions_inbox_pages_newest_first(client, login):
+    ripley, kane = login("ripley"), login("kane")
+    ash = login("ash")
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=ripley).json()["chat"]["id"]
+    client.put(f"/chats/{chat_id}/users/{_user_id(client, kane)}", headers=ripley)
+
+    sent = [client.post(f"/chats/{chat_id}/messages", json={"text": text}, headers=ripley).json()["message"]["id"]
+            for text in ("@kane wake up", "hey @KANE and @ash", "@ripley talking to myself", "@Kane. dinner")]
+
+    page = _mentions(client, kane, limit=2)
+    assert [message["id"] for message in page["mentions"]] == [sent[3], sent[1]]
+    page = _mentions(client, kane, limit=2, cursor=page["next_cursor"])
+    assert [message["id"] for message in page["mentions"]] == [sent[0]]
+    assert "next_cursor" not in page
+    # not a member of the chat, and never notified of their own mentions
+    assert _mentions(client, ash)["mentions"] == []
+    assert _mentions(client, ripley)["mentions"] == []
+
+    client.put(f"/chats/{chat_id}/messages/{sent[3]}", json={"text": "dinner"}, headers=ripley)
+    client.delete(f"/chats/{chat_id}/messages/{sent[1]}", headers=ripley)
+    assert [message["text"] for message in _mentions(client, kane)["mentions"]] == ["@kane wake up"]
+
+    client.delete(f"/chats/{chat_id}/users/{_user_id(client, kane)}", headers=ripley)
+    assert _mentions(client, kane)["mentions"] == []
+
+def test_registrations_and_renames_are_resolved(client, login):
+    ripley = login("ripley")
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=ripley).json()["chat"]["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "@nobody loads the directory"}, headers=ripley)
+
+    parker = login("parker")
+    client.put(f"/chats/{chat_id}/users/{_user_id(client, parker)}", headers=ripley)
+    client.put("/users/me", json={"username": "dennis"}, headers=parker)
+    client.post(f"/chats/{chat_id}/messages", json={"text": "@parker?"}, headers=ripley)
+    client.post(f"/chats/{chat_id}/messages", json={"text": "@dennis!"}, headers=ripley)
+
+    assert [message["text"] for message in _mentions(client, parker)["mentions"]] == ["@dennis!"]
+    assert client.get("/users/me/mentions", params={"cursor": "x"}, headers=parker).status_code == 422
@@ -0,0 +1,71 @@
+from backend.message_cache import RecentMessageCache, message_cache
+
+
+def _message(message_id, text="hello"):
+    return {"id": message_id, "text": text}
+
+def test_partial_ring_only_answers_limited_reads():
+    cache = RecentMessageCache(per_chat=3, max_bytes=1_000_000)
+    cache.load(1, [_message(i) for i in range(1, 6)], total=5, generation=cache.generation(1))
+
+    assert cache.get(1) is None
+    messages, total = cache.get(1, limit=2)
+    assert [message["id"] for message in messages] == [4, 5]
+    assert total == 5
+
+def test_append_replace_remove_update_in_place():
+    cache = RecentMessageCache(per_chat=3, max_bytes=1_000_000)
+    cache.load(1, [_message(1), _message(2)], total=2, generation=cache.generation(1))
+
+    cache.append(1, _message(3))
+    cache.replace(1, _message(2, "edited"))
+    cache.remove(1, 1)
+
+    messages, total = cache.get(1)
+    assert [(message["id"], message["text"]) for message in messages] == [(2, "edited"), (3, "hello")]
+    assert total == 2
+
+def test_load_is_discarded_after_concurrent_write():
+    cache = RecentMessageCache(per_chat=3, max_bytes=1_000_000)
+    generation = cache.generation(1)
+    cache.append(1, _message(2))
+    cache.load(1, [_message(1)], total=1, generation=generation)
+
+    assert cache.get(1) is None
+
+def test_append_after_a_load_that_saw_the_message_is_ignored():
+    cache = RecentMessageCache(per_chat=3, max_bytes=1_000_000)
+    # the load reads the chat after the message was committed but before 'append' bumps the generation
+    cache.load(1, [_message(1), _message(2)], total=2, generation=cache.generation(1))
+    cache.append(1, _message(2))
+
+    messages, total = cache.get(1)
+    assert [message["id"] for message in messages] == [1, 2]
+    assert total == 2
+
+def test_lru_eviction_under_memory_budget():
+    cache = RecentMessageCache(per_chat=2, max_bytes=2_000)
+    for chat_id in (1, 2):
+        cache.load(chat_id, [_message(1)], total=1, generation=cache.generation(chat_id))
+    cache.get(1)
+    cache.load(3, [_message(1)], total=1, generation=cache.generation(3))
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["memory_bytes"] <= stats["max_memory_bytes"]
+
+def test_messages_route_serves_newest_messages_from_cache(client, login):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=headers).json()["chat"]["id"]
+    for text in ("one", "two", "three"):
+        client.post(f"/chats/{chat_id}/messages", json={"text": text}, headers=headers)
+
+    response = client.get(f"/chats/{chat_id}/messages", params={"limit": 2}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["meta"]["count"] == 3
+    assert [message["text"] for message in response.json()["messages"]] == ["two", "three"]
+
+    client.get(f"/chats/{chat_id}/messages", params={"limit": 2}, headers=headers)
+    assert message_cache.stats()["hits"] >= 1
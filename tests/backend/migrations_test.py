@@ -0,0 +1,48 @@
+import shutil
+import sqlite3
+
+from sqlmodel import SQLModel, create_engine
+
+from backend import migrations
+
+
+def _index_names(path):
+    connection = sqlite3.connect(path)
+    names = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    connection.close()
+    return names
+
+def test_migrations_upgrade_a_deployed_database(tmp_path):
+    path = tmp_path / "pony_express.db"
+    shutil.copy("backend/pony_express.db", path)
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+
+    assert migrations.migrate(engine) == [migration.version for migration in migrations.MIGRATIONS]
+    assert {"ix_messages_chat_id_created_at", "ix_user_chat_links_chat_id", "ix_chats_owner_id"} <= _index_names(path)
+
+    connection = sqlite3.connect(path)
+    chats, summaries = connection.execute(
+        "SELECT (SELECT COUNT(*) FROM chats), (SELECT COUNT(*) FROM chat_summaries)"
+    ).fetchone()
+    versions = {row[0] for row in connection.execute("SELECT version FROM messages UNION SELECT version FROM users")}
+    journal_mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+    unordered_links = connection.execute("SELECT COUNT(*) FROM user_chat_links WHERE last_activity_at IS NULL").fetchone()[0]
+    messages, hourly, daily = connection.execute("""
+        SELECT (SELECT COUNT(*) FROM messages),
+               (SELECT SUM(count) FROM message_rollups WHERE granularity = 'hour'),
+               (SELECT SUM(count) FROM message_rollups WHERE granularity = 'day')
+    """).fetchone()
+    connection.close()
+    assert chats == summaries
+    assert versions == {1}
+    assert journal_mode == "wal"
+    assert unordered_links == 0
+    assert messages == hourly == daily
+
+def test_migrations_are_a_no_op_when_up_to_date(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    SQLModel.metadata.create_all(engine)
+
+    assert migrations.migrate(engine) == [migration.version for migration in migrations.MIGRATIONS]
+    assert migrations.migrate(engine) == []
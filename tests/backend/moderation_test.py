@@ -0,0 +1,89 @@
+import pytest
+
+from backend.moderation import TermMatcher, benchmark, moderation_filter
+
+@pytest.fixture(autouse=True)
+def empty_term_list():
+    yield
+    moderation_filter.replace([])
+
+@pytest.fixture
+def chat(client, login, admin_headers):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "nostromo"}, headers=headers).json()["chat"]["id"]
+    client.put("/admin/moderation/terms", json={"terms": ["xenomorph", "face hugger", "acid*", "  ", "XENOMORPH"]},
+               headers=admin_headers)
+    return chat_id, headers
+
+def _texts(matcher: TermMatcher, text: str) -> list[str]:
+    return [text[match.start:match.end] for match in matcher.find(text)]
+
+def test_finds_overlapping_terms_in_one_pass():
+    matcher = TermMatcher(["*he*", "*she*", "*hers*", "*his*"])
+    assert _texts(matcher, "ushers") == ["she", "he", "hers"]
+    assert _texts(matcher, "ahishe") == ["his", "she", "he"]
+    assert _texts(TermMatcher(["he", "she", "hers"]), "ushers she") == ["she"]
+
+def test_terms_match_whole_words_unless_wildcarded():
+    matcher = TermMatcher(["spam", "egg*", "*ham", "*bacon*", "$$$"])
+    assert _texts(matcher, "Spam, spammer and antispam") == ["Spam"]
+    assert _texts(matcher, "eggs and eggplant, not legg") == ["egg", "egg"]
+    assert _texts(matcher, "Durham ham hamster") == ["ham", "ham"]
+    assert _texts(matcher, "BACONATOR") == ["BACON"]
+    assert _texts(matcher, "win $$$$ now") == ["$$$", "$$$"]
+    # a character that lower-cases to two characters does not shift match positions
+    assert _texts(matcher, "İ spam") == ["spam"]
+
+def test_reject_policy_refuses_new_and_edited_messages(client, chat):
+    chat_id, headers = chat
+    response = client.post(f"/chats/{chat_id}/messages", json={"text": "a Xenomorph!"}, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"]["error"] == "message_rejected"
+
+    message = client.post(f"/chats/{chat_id}/messages", json={"text": "all clear"}, headers=headers).json()["message"]
+    response = client.put(f"/chats/{chat_id}/messages/{message['id']}", json={"text": "acidic blood"}, headers=headers)
+    assert response.status_code == 422
+    messages = client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"]
+    assert [message["text"] for message in messages] == ["all clear"]
+
+def test_mask_policy_stores_masked_text(client, chat, login):
+    chat_id, headers = chat
+    assert client.put(f"/chats/{chat_id}/moderation", json={"policy": "mask"}, headers=login("kane")).status_code == 403
+    response = client.put(f"/chats/{chat_id}/moderation", json={"policy": "mask"}, headers=headers)
+    assert response.json() == {"chat_id": chat_id, "policy": "mask"}
+
+    message = client.post(f"/chats/{chat_id}/messages", json={"text": "the face hugger is gone"},
+                          headers=headers).json()["message"]
+    assert message["text"] == "the *********** is gone"
+    assert client.get(f"/chats/{chat_id}", headers=headers).json()["chat"]["id"] == chat_id
+
+def test_flag_policy_keeps_messages_and_reports_them(client, chat, admin_headers):
+    chat_id, headers = chat
+    client.put(f"/chats/{chat_id}/moderation", json={"policy": "flag"}, headers=headers)
+    assert client.get(f"/chats/{chat_id}/moderation", headers=headers).json()["policy"] == "flag"
+
+    message = client.post(f"/chats/{chat_id}/messages", json={"text": "acid and a xenomorph"},
+                          headers=headers).json()["message"]
+    assert message["text"] == "acid and a xenomorph"
+    [flag] = client.get("/admin/moderation/flags", params={"chat_id": chat_id}, headers=admin_headers).json()["flags"]
+    assert (flag["message_id"], flag["terms"]) == (message["id"], ["acid", "xenomorph"])
+
+    client.delete(f"/chats/{chat_id}/messages/{message['id']}", headers=headers)
+    assert client.get("/admin/moderation/flags", headers=admin_headers).json()["meta"]["count"] == 0
+    stats = client.get("/admin/moderation", headers=admin_headers).json()
+    assert stats["terms"] == 3 and stats["actions"]["flag"] == 1
+
+def test_reloading_terms_swaps_the_matcher(session):
+    from backend import database as db
+
+    previous = moderation_filter.matcher
+    db.replace_moderation_terms(["Ripley", "ripley", "bishop"], session)
+    assert moderation_filter.matcher is not previous
+    assert moderation_filter.load(session).terms == moderation_filter.matcher.terms
+    assert moderation_filter.moderate("bishop says hi", "mask").text == "****** says hi"
+    assert moderation_filter.moderate("ash says hi", "reject").action is None
+
+def test_benchmark_reports_throughput():
+    result = benchmark(500, message_count=50)
+    assert result["terms"] == 500
+    assert result["chars_per_second"] > 0 and result["naive_us_per_message"] > 0
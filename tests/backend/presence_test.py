@@ -0,0 +1,57 @@
+from backend import presence as presence_module
+from backend.presence import PresenceService, TimerWheel
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_timer_wheel_expires_keys_at_their_deadline():
+    clock = FakeClock()
+    expired = []
+    wheel = TimerWheel(8, expired.append, clock)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 5)
+    wheel.schedule("a", 4)  # rescheduling moves the key to a later slot
+
+    clock.now += 3
+    wheel.advance()
+    assert expired == []
+    clock.now += 1
+    wheel.advance()
+    assert expired == ["a"]
+
+    # an idle period longer than one rotation still expires everything that is due
+    clock.now += 100
+    wheel.advance()
+    assert expired == ["a", "b"]
+    assert len(wheel) == 0
+
+def test_typing_expires_and_counts_as_online(monkeypatch):
+    monkeypatch.setattr(presence_module, "typing_ttl", 3)
+    monkeypatch.setattr(presence_module, "presence_ttl", 10)
+    clock = FakeClock()
+    service = PresenceService(clock=clock)
+
+    service.heartbeat(1)
+    service.set_typing(7, 2, True)
+    assert service.online([1, 2, 3]) == [1, 2]
+    assert service.typing(7) == [2]
+
+    clock.now += 3
+    assert service.typing(7) == []
+    assert service.online([1, 2]) == [1, 2]
+
+    clock.now += 7
+    assert service.online([1, 2]) == []
+    assert service.stats()["tracked_keys"] == 0
+
+def test_capacity_bounds_memory():
+    service = PresenceService(clock=FakeClock(), max_keys=2)
+    assert service.heartbeat(1)
+    assert service.heartbeat(2)
+    assert not service.heartbeat(3)
+    assert service.heartbeat(1)  # refreshing a tracked key is always allowed
+    assert service.stats()["dropped"] == 1
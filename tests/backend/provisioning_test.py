@@ -0,0 +1,80 @@
+import io
+import json
+import os
+
+import pytest
+
+from backend import auth, provisioning
+from backend import database as db
+from backend.entities import JobInDB
+from backend.provisioning import provision, read_rows
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(provisioning, "provision_dir", str(tmp_path / "provisioning"))
+    return tmp_path / "provisioning"
+
+def test_reads_csv_and_ndjson_rows():
+    csv_file = io.StringIO("username,email,password\r\nripley,ripley@example.com,alien\r\nkane,kane@example.com,egg\r\n")
+    assert list(read_rows(csv_file, "csv")) == [
+        (1, {"username": "ripley", "email": "ripley@example.com", "password": "alien"}),
+        (2, {"username": "kane", "email": "kane@example.com", "password": "egg"}),
+    ]
+    ndjson_file = io.StringIO('{"username": "ripley"}\n\nnot json\n[1, 2]\n')
+    assert list(read_rows(ndjson_file, "ndjson")) == [(1, {"username": "ripley"}), (2, None), (3, None)]
+
+def test_provision_reports_each_row_that_fails(session, login):
+    login("ripley")
+    rows = [
+        (1, {"username": "kane", "email": "kane@example.com", "password": "egg"}),
+        (2, {"username": "ripley", "email": "ellen@example.com", "password": "alien"}),
+        (3, {"username": "dallas", "email": "ripley@example.com", "password": "captain"}),
+        (4, {"username": "kane", "email": "kane2@example.com", "password": "egg"}),
+        (5, {"username": "lambert", "email": "lambert", "password": "navigator"}),
+        (6, {"username": "parker", "email": "parker@example.com"}),
+        (7, None),
+        (8, {"username": "brett", "email": "brett@example.com", "password": "jonesy"}),
+    ]
+    batches = []
+    report = provision(rows, session, workers=2, size=3, on_batch=lambda report: batches.append(report.rows))
+
+    assert (report.rows, report.created, report.failed) == (8, 2, 6)
+    assert batches == [3, 6, 8]
+    assert [(error["row"], error["error"]) for error in report.errors] == [
+        (2, "duplicate_username"), (3, "duplicate_email"), (4, "duplicate_username"),
+        (5, "invalid_email"), (6, "missing_password"), (7, "invalid_row"),
+    ]
+    assert report.to_dict()["accounts_per_second"] > 0
+    assert auth.verify_password("jonesy", db.get_existing_user(session, "brett", "").hashed_password)
+
+def test_admin_import_runs_as_a_job_without_storing_passwords(client, admin_headers, session, run_jobs, spool_dir):
+    body = "\n".join(json.dumps({"username": f"crew{i}", "email": f"crew{i}@example.com", "password": f"secret{i}"})
+                     for i in range(5)) + "\n{}\n"
+    response = client.post("/admin/users/import", content=body, headers={**admin_headers, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 202
+    job_id = response.json()["job"]["id"]
+    assert "secret" not in session.get(JobInDB, job_id).params
+    assert len(os.listdir(spool_dir)) == 1
+
+    run_jobs()
+    result = client.get(f"/admin/users/import/{job_id}", headers=admin_headers).json()
+    assert result["job"]["status"] == "succeeded"
+    assert (result["report"]["rows"], result["report"]["created"]) == (6, 5)
+    assert result["report"]["errors"] == [{"row": 6, "error": "missing_username"}]
+    assert os.listdir(spool_dir) == []
+    token = client.post("/auth/token", data={"username": "crew3", "password": "secret3"})
+    assert token.status_code == 200
+
+def test_import_reads_csv_files_with_a_byte_order_mark(client, admin_headers, run_jobs, spool_dir):
+    body = "\ufeffusername,email,password\r\nbishop,bishop@example.com,android\r\n".encode("utf-8")
+    response = client.post("/admin/users/import", content=body, headers={**admin_headers, "Content-Type": "text/csv"})
+    job_id = response.json()["job"]["id"]
+
+    run_jobs()
+    report = client.get(f"/admin/users/import/{job_id}", headers=admin_headers).json()["report"]
+    assert (report["created"], report["errors"]) == (1, [])
+
+def test_admin_import_rejects_unknown_formats(client, admin_headers, spool_dir):
+    response = client.post("/admin/users/import", content="a,b", headers={**admin_headers, "Content-Type": "text/plain"})
+    assert (response.status_code, response.json()["detail"]["error"]) == (422, "unknown_format")
+    assert client.get("/admin/users/import/999", headers=admin_headers).status_code == 404
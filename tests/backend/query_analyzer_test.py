@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import create_engine, text
+
+from backend import auth
+from backend.query_analyzer import QueryAnalyzer, fingerprint, plan_flags, query_analyzer
+
+def _engine(analyzer):
+    engine = create_engine("sqlite://")
+    analyzer.install(engine)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE notes (id INTEGER PRIMARY KEY, author TEXT, body TEXT)"))
+        connection.execute(text("INSERT INTO notes (author, body) VALUES ('ripley', 'a'), ('dallas', 'b')"))
+    return engine
+
+def test_fingerprint_collapses_literals_and_lists():
+    assert fingerprint("SELECT * FROM t WHERE id IN (?, ?, ?)  AND name = 'x'") == \
+        fingerprint("SELECT * FROM t WHERE id IN (?) AND name = 'y'") == "SELECT * FROM t WHERE id IN (?...) AND name = ?"
+    assert fingerprint("SELECT * FROM t WHERE id IN (?, ?) LIMIT 10") == "SELECT * FROM t WHERE id IN (?...) LIMIT ?"
+    assert fingerprint("INSERT INTO t (a, b) VALUES (?, ?), (?, ?)") == "INSERT INTO t (a, b) VALUES (?...)"
+    assert fingerprint("SELECT users_1.id FROM users AS users_1") == "SELECT users_1.id FROM users AS users_1"
+
+def test_plan_flags():
+    assert plan_flags(["SCAN notes", "USE TEMP B-TREE FOR ORDER BY"]) == ["SCAN", "TEMP B-TREE"]
+    assert plan_flags(["SEARCH notes USING INTEGER PRIMARY KEY (rowid=?)"]) == ["SEARCH"]
+
+def test_slow_statements_are_aggregated_with_their_plan():
+    analyzer = QueryAnalyzer(threshold_ms=0, enabled=True)
+    engine = _engine(analyzer)
+    with engine.connect() as connection:
+        for author in ("ripley", "dallas", "kane"):
+            connection.execute(text("SELECT body FROM notes WHERE author = :author"), {"author": author})
+        connection.execute(text("SELECT body FROM notes WHERE id = :id"), {"id": 1})
+
+    queries = {query["fingerprint"]: query for query in analyzer.queries()}
+    scan = queries["SELECT body FROM notes WHERE author = ?"]
+    assert scan["count"] == 3
+    assert scan["flags"] == ["SCAN"]
+    assert scan["sample_parameters"] == ["'ripley'"]
+    assert scan["avg_ms"] == scan["total_ms"] / 3
+    assert queries["SELECT body FROM notes WHERE id = ?"]["flags"] == ["SEARCH"]
+
+def test_disabled_analyzer_and_threshold_skip_statements():
+    analyzer = QueryAnalyzer(threshold_ms=0, enabled=False)
+    engine = _engine(analyzer)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT * FROM notes"))
+    assert analyzer.stats()["statements"] == 0
+
+    analyzer.enabled = True
+    analyzer.threshold_ms = 60_000
+    with engine.connect() as connection:
+        connection.execute(text("SELECT * FROM notes"))
+    assert analyzer.stats()["statements"] == 1
+    assert analyzer.queries() == []
+
+def test_sample_parameters_are_redacted():
+    analyzer = QueryAnalyzer(threshold_ms=0, enabled=True)
+    hashed = "$2b$12$" + "x" * 53
+    analyzer.record("UPDATE users SET hashed_password = ? WHERE id = ?", (hashed, 7), 5.0)
+    analyzer.record("INSERT INTO messages (text) VALUES (?)", ("a long message " * 10,), 5.0)
+    analyzer.record("UPDATE users SET hashed_password = :password", {"password": "short"}, 5.0)
+
+    samples = [query["sample_parameters"] for query in analyzer.queries()]
+    assert ["<redacted>", "7"] in samples
+    assert ["<str of 150 characters>"] in samples
+    assert ["<redacted>"] in samples
+
+def test_failed_statements_do_not_leak_start_times():
+    analyzer = QueryAnalyzer(threshold_ms=0, enabled=True)
+    engine = _engine(analyzer)
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing"))
+        assert connection.info["query_started"] == []
+        connection.execute(text("SELECT * FROM notes"))
+        assert connection.info["query_started"] == []
+
+def test_fingerprints_are_bounded():
+    analyzer = QueryAnalyzer(threshold_ms=0, enabled=True, max_fingerprints=1)
+    analyzer.record("SELECT 1 FROM a", (), 5.0)
+    analyzer.record("SELECT 1 FROM b", (), 5.0)
+    assert [query["fingerprint"] for query in analyzer.queries()] == ["SELECT ? FROM a"]
+    assert analyzer.stats()["dropped"] == 1
+
+def test_admin_queries_route(client, login, monkeypatch):
+    monkeypatch.setattr(auth, "admin_usernames", {"ripley"})
+    headers = login("ripley")
+    query_analyzer.reset()
+    query_analyzer.record("SELECT * FROM chats WHERE name = 'x'", (), 250.0)
+
+    assert client.get("/admin/queries", headers=login("dallas")).status_code == 403
+    response = client.get("/admin/queries", headers=headers).json()
+    assert response["queries"][0]["fingerprint"] == "SELECT * FROM chats WHERE name = ?"
+
+    assert client.delete("/admin/queries", headers=headers).status_code == 204
+    assert client.get("/admin/queries", headers=headers).json()["queries"] == []
@@ -0,0 +1,54 @@
+import argparse
+import asyncio
+
+from backend import replay
+from backend.capture import traffic_recorder
+from backend.main import app
+from backend.replay import TraceRecord
+
+def _record(offset, route, user, path_ids=None, query=None, status=200):
+    return TraceRecord(offset, route, path_ids or {}, query or [], user, 0, status, 100, 5.0)
+
+def test_dataset_plan_follows_the_trace():
+    plan = replay.plan_dataset([
+        _record(0, "GET /chats/{chat_id}", 1, {"chat_id": 1}),
+        _record(1, "GET /chats/{chat_id}/messages", 2, {"chat_id": 1}, [["before", "4"]]),
+        _record(2, "PUT /chats/{chat_id}/users/{user_id}", 1, {"chat_id": 1, "user_id": 3}),
+        _record(3, "GET /chats/{chat_id}", 3, {"chat_id": 1}),
+        _record(4, "DELETE /chats/{chat_id}/messages/{message_id}", 2, {"chat_id": 1, "message_id": 5}),
+    ])
+    assert plan.users == [1, 2, 3]
+    # user 3 is added during the trace, so it must not be a member beforehand
+    assert plan.chats == {1: (1, [1, 2])}
+    assert plan.messages == {4: (1, 1), 5: (1, 2)}
+
+def test_captured_session_replays_with_matching_statuses(client, login, tmp_path):
+    path = str(tmp_path / "trace.ndjson")
+    traffic_recorder.start(path)
+    try:
+        ripley, dallas = login("ripley"), login("dallas")
+        chat_id = client.post("/chats", json={"name": "nostromo"}, headers=ripley).json()["chat"]["id"]
+        client.put(f"/chats/{chat_id}/users/2", headers=ripley)
+        message_id = client.post(f"/chats/{chat_id}/messages", json={"text": "hello"}, headers=dallas).json()["message"]["id"]
+        client.get(f"/chats/{chat_id}", params={"include": ["messages"]}, headers=ripley)
+        client.put(f"/chats/{chat_id}/messages/{message_id}", json={"text": "edited"}, headers=dallas)
+        client.get("/chats", params={"sort": "recent"}, headers=dallas)
+        client.get(f"/chats/{chat_id}/messages", headers=login("kane"))
+    finally:
+        traffic_recorder.stop()
+        app.dependency_overrides.clear()
+
+    args = argparse.Namespace(trace=path, session=-1, speed=50, target=None, messages_per_chat=3, connections=20,
+                              setup_concurrency=5, timeout=5, seed=3)
+    try:
+        result = asyncio.run(replay.run(args))
+    finally:
+        app.dependency_overrides.clear()
+
+    assert result["dataset"] == {"users": 3, "chats": 1, "messages": 1}
+    routes = result["routes"]
+    assert routes["GET /chats/{chat_id}/messages"]["statuses"] == {403: 1}
+    assert routes["PUT /chats/{chat_id}/messages/{message_id}"]["statuses"] == {200: 1}
+    for route, summary in routes.items():
+        assert summary["status_mismatches"] == 0, route
+        assert summary["skipped"] == 0, route
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from backend import database as db
+from backend.entities import MessageRollupInDB
+
+def _send(client, headers, chat_id, count):
+    return [client.post(f"/chats/{chat_id}/messages", json={"text": "hi"}, headers=headers).json()["message"]["id"]
+            for _ in range(count)]
+
+def _range():
+    today = db.bucket_start(datetime.now(), "day")
+    return {"start": today.isoformat(), "end": (today + timedelta(days=1)).isoformat()}
+
+def test_rollups_follow_sent_and_deleted_messages(client, session, login, admin_headers):
+    ripley, dallas = login("ripley"), login("dallas")
+    busy = client.post("/chats", json={"name": "busy"}, headers=ripley).json()["chat"]["id"]
+    quiet = client.post("/chats", json={"name": "quiet"}, headers=ripley).json()["chat"]["id"]
+    client.put(f"/chats/{busy}/users/3", headers=ripley)
+    sent = _send(client, ripley, busy, 3)
+    _send(client, dallas, busy, 2)
+    _send(client, ripley, quiet, 1)
+    client.delete(f"/chats/{busy}/messages/{sent[0]}", headers=ripley)
+
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    volume = client.get("/admin/analytics/messages", params=_range(), headers=admin_headers).json()
+    assert volume["total"] == 5
+    assert [bucket["count"] for bucket in volume["buckets"]] == [5]
+
+    hourly = client.get("/admin/analytics/messages", params={**_range(), "granularity": "hour", "chat_id": busy},
+                        headers=admin_headers).json()
+    assert hourly["total"] == 4
+
+    by_user = client.get("/admin/analytics/messages", params={**_range(), "user_id": 2}, headers=admin_headers).json()
+    assert by_user["total"] == 3
+
+    active = client.get("/admin/analytics/active-users", params=_range(), headers=admin_headers).json()
+    assert (active["total"], active["buckets"][0]["count"]) == (2, 2)
+
+    top = client.get("/admin/analytics/top", params={**_range(), "by": "chat"}, headers=admin_headers).json()
+    assert top["ranking"] == [{"id": busy, "count": 4}, {"id": quiet, "count": 1}]
+
+    assert not any("FROM messages" in statement for statement in statements)
+
+def test_purged_chats_leave_no_rollups(client, session, login, run_jobs):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "doomed"}, headers=headers).json()["chat"]["id"]
+    _send(client, headers, chat_id, 2)
+    assert len(db.get_message_volume(session, "day", datetime.now() - timedelta(days=1), datetime.now() + timedelta(days=1))) == 1
+
+    client.delete(f"/chats/{chat_id}", headers=headers)
+    run_jobs()
+    assert session.query(MessageRollupInDB).count() == 0
+
+def test_analytics_validate_their_range(client, admin_headers, login):
+    params = {"start": "2024-01-02T00:00:00", "end": "2024-01-01T00:00:00"}
+    assert client.get("/admin/analytics/messages", params=params, headers=admin_headers).status_code == 422
+    params = {"start": "2020-01-01T00:00:00", "end": "2024-01-01T00:00:00", "granularity": "hour"}
+    assert client.get("/admin/analytics/messages", params=params, headers=admin_headers).status_code == 422
+    assert client.get("/admin/analytics/top", headers=login("ripley")).status_code == 403
@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from backend import blobs
+from backend.entities import UploadInDB
+from backend.routers.attachments import FileRangeResponse
+
+CONTENT = bytes(range(256)) * 40
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "blob_dir", str(tmp_path))
+    return tmp_path
+
+def _chat(client, headers):
+    return client.post("/chats", json={"name": "files"}, headers=headers).json()["chat"]["id"]
+
+def _upload(client, headers, chat_id, content, chunk_size=4096):
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "notes.bin", "size": len(content)},
+                         headers=headers).json()["upload"]
+    for offset in range(0, len(content), chunk_size):
+        response = client.put(f"/chats/{chat_id}/uploads/{upload['id']}", params={"offset": offset},
+                              content=content[offset:offset + chunk_size], headers=headers)
+        assert response.status_code == 200
+    return response.json()["upload"]
+
+def test_chunked_upload_becomes_attachment_of_a_message(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+
+    upload = _upload(client, headers, chat_id, CONTENT)
+    attachment = upload["attachment"]
+    assert upload["offset"] == len(CONTENT)
+    assert attachment["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+
+    response = client.post(f"/chats/{chat_id}/messages", json={"text": "see attached", "attachment_ids": [attachment["id"]]},
+                           headers=headers)
+    assert response.status_code == 201
+    assert [item["id"] for item in response.json()["attachments"]] == [attachment["id"]]
+
+    message_id = response.json()["message"]["id"]
+    listed = client.get(f"/chats/{chat_id}/messages/{message_id}/attachments", headers=headers).json()
+    assert listed["meta"]["count"] == 1
+
+    # an attachment can only be sent once
+    response = client.post(f"/chats/{chat_id}/messages", json={"text": "again", "attachment_ids": [attachment["id"]]},
+                           headers=headers)
+    assert response.status_code == 422
+
+def test_interrupted_upload_resumes_from_offset(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "big.bin", "size": len(CONTENT)},
+                         headers=headers).json()["upload"]
+    path = f"/chats/{chat_id}/uploads/{upload['id']}"
+
+    client.put(path, params={"offset": 0}, content=CONTENT[:1000], headers=headers)
+    assert client.get(path, headers=headers).json()["upload"]["offset"] == 1000
+
+    response = client.put(path, params={"offset": 0}, content=CONTENT[:1000], headers=headers)
+    assert response.status_code == 409
+    assert response.json()["detail"]["offset"] == 1000
+
+    response = client.put(path, params={"offset": 1000}, content=CONTENT[1000:], headers=headers)
+    assert response.json()["upload"]["attachment"]["size"] == len(CONTENT)
+
+def test_identical_uploads_share_one_blob(client, login, blob_dir):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    first = _upload(client, headers, chat_id, CONTENT)["attachment"]
+    second = _upload(client, headers, chat_id, CONTENT)["attachment"]
+
+    assert first["id"] != second["id"]
+    assert first["sha256"] == second["sha256"]
+    assert len(os.listdir(blob_dir / "objects" / first["sha256"][:2])) == 1
+
+def test_download_honors_range_and_conditional_headers(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    attachment = _upload(client, headers, chat_id, CONTENT)["attachment"]
+    path = f"/chats/{chat_id}/attachments/{attachment['id']}"
+
+    response = client.get(path, headers=headers)
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    etag = response.headers["etag"]
+
+    response = client.get(path, headers={**headers, "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(CONTENT)}"
+    assert response.content == CONTENT[100:200]
+
+    response = client.get(path, headers={**headers, "Range": "bytes=-10"})
+    assert response.content == CONTENT[-10:]
+
+    response = client.get(path, headers={**headers, "Range": f"bytes={len(CONTENT)}-"})
+    assert response.status_code == 416
+
+    response = client.get(path, headers={**headers, "Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200
+
+    response = client.get(path, headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+def test_attachments_require_membership(client, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat(client, headers)
+    attachment = _upload(client, headers, chat_id, CONTENT)["attachment"]
+
+    assert client.get(f"/chats/{chat_id}/attachments/{attachment['id']}", headers=other_headers).status_code == 403
+    response = client.post(f"/chats/{chat_id}/uploads", json={"filename": "x", "size": 1}, headers=other_headers)
+    assert response.status_code == 403
+
+def test_busy_retries_leave_no_orphaned_parts(client, session, login, blob_dir, monkeypatch):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    commit, attempts = session.commit, []
+
+    def busy_once():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise OperationalError("COMMIT", {}, sqlite3.OperationalError("database is locked"))
+        commit()
+
+    monkeypatch.setattr(session, "commit", busy_once)
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "notes.bin", "size": 10},
+                         headers=headers).json()["upload"]
+    assert len(attempts) == 2
+    assert os.listdir(blob_dir / "uploads") == [f"{upload['id']}.part"]
+
+def test_appends_to_one_upload_take_turns(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "race.bin", "size": 4},
+                         headers=headers).json()["upload"]
+    held = blobs.open_part(upload["id"])
+    waiter = {}
+    thread = threading.Thread(target=lambda: waiter.update(part=blobs.open_part(upload["id"])))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()  # blocked on the lock
+
+    held.write(b"data")
+    held.flush()
+    blobs.commit_part(upload["id"])
+    held.close()
+    thread.join()
+    # the part was moved into the object store while the waiter waited for it
+    assert waiter["part"] is None
+
+def test_append_racing_a_completed_upload_returns_its_attachment(client, login, monkeypatch):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "race.bin", "size": 4},
+                         headers=headers).json()["upload"]
+    path = f"/chats/{chat_id}/uploads/{upload['id']}"
+    open_part = blobs.open_part
+
+    def complete_first(upload_id):
+        # another request finishes the upload while this one waits for the lock
+        monkeypatch.setattr(blobs, "open_part", open_part)
+        assert client.put(path, params={"offset": 0}, content=b"data", headers=headers).status_code == 200
+        return open_part(upload_id)
+
+    monkeypatch.setattr(blobs, "open_part", complete_first)
+    response = client.put(path, params={"offset": 0}, content=b"data", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["upload"]["attachment"]["sha256"] == hashlib.sha256(b"data").hexdigest()
+
+def test_oversized_chunks_are_rejected(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    upload = client.post(f"/chats/{chat_id}/uploads", json={"filename": "small.bin", "size": 10},
+                         headers=headers).json()["upload"]
+
+    response = client.put(f"/chats/{chat_id}/uploads/{upload['id']}", params={"offset": 0}, content=b"x" * 11,
+                          headers=headers)
+    assert response.status_code == 413
+    assert client.get(f"/chats/{chat_id}/uploads/{upload['id']}", headers=headers).json()["upload"]["offset"] == 0
+
+def test_unreferenced_blobs_are_collected(client, session, login, blob_dir):
+    from backend import database as db
+
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    attachment = _upload(client, headers, chat_id, CONTENT)["attachment"]
+    kept = _upload(client, headers, chat_id, b"keep me")["attachment"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "keep", "attachment_ids": [kept["id"]]}, headers=headers)
+    message = client.post(f"/chats/{chat_id}/messages", json={"text": "gone", "attachment_ids": [attachment["id"]]},
+                          headers=headers).json()["message"]
+    client.delete(f"/chats/{chat_id}/messages/{message['id']}", headers=headers)
+
+    assert list(db.collect_blobs(session)) == []  # both blobs are still within the grace period
+    for sha256 in (attachment["sha256"], kept["sha256"]):
+        os.utime(blobs.object_path(sha256), (0, 0))
+    assert list(db.collect_blobs(session)) == [2]
+    assert not os.path.exists(blobs.object_path(attachment["sha256"]))
+    assert os.path.exists(blobs.object_path(kept["sha256"]))
+
+def test_collection_keeps_an_object_an_upload_reused_after_it_was_listed(client, login):
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    sha256 = _upload(client, headers, chat_id, CONTENT)["attachment"]["sha256"]
+    os.utime(blobs.object_path(sha256), (0, 0))
+    assert sha256 in blobs.iter_objects()
+
+    # the same content is uploaded between the collection's reference check and its delete
+    _upload(client, headers, chat_id, CONTENT)
+    assert not blobs.remove_object(sha256)
+    assert os.path.exists(blobs.object_path(sha256))
+
+    os.utime(blobs.object_path(sha256), (0, 0))
+    assert blobs.remove_object(sha256)
+    assert not os.path.exists(blobs.object_path(sha256))
+
+def test_expired_uploads_are_deleted_with_their_parts(client, session, login):
+    from backend import database as db
+
+    headers = login("ripley")
+    chat_id = _chat(client, headers)
+    stale, active, recent = [
+        client.post(f"/chats/{chat_id}/uploads", json={"filename": "part.bin", "size": 10},
+                    headers=headers).json()["upload"]["id"]
+        for _ in range(3)
+    ]
+    for upload_id in (stale, active):
+        session.get(UploadInDB, upload_id).created_at = datetime.now() - timedelta(days=2)
+    session.commit()
+    os.utime(blobs.part_path(stale), (0, 0))
+
+    assert list(db.expire_uploads(session)) == [1]
+    assert not os.path.exists(blobs.part_path(stale))
+    assert client.get(f"/chats/{chat_id}/uploads/{stale}", headers=headers).status_code == 404
+    # a part appended to within the expiry time is kept, and so is an upload started recently
+    assert os.path.exists(blobs.part_path(active)) and os.path.exists(blobs.part_path(recent))
+
+def test_zero_copy_send_receives_the_file_object(tmp_path):
+    path = tmp_path / "blob"
+    path.write_bytes(CONTENT)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = FileRangeResponse(str(path), 10, 100, 206, {}, "application/octet-stream")
+    scope = {"type": "http", "extensions": {"http.response.zerocopysend": {}}}
+    asyncio.run(response(scope, None, send))
+    assert sent[1]["file"].name == str(path)
+    assert (sent[1]["offset"], sent[1]["count"]) == (10, 100)
+
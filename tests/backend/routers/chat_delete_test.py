@@ -0,0 +1,64 @@
+from sqlmodel import func, select
+
+from backend import database as db
+from backend.entities import ChatDeletionInDB, ChatInDB, ChatSummaryInDB, MessageInDB, UserChatLinkInDB, UserInDB
+
+def _chat_with_messages(client, headers, count):
+    chat_id = client.post("/chats", json={"name": "doomed"}, headers=headers).json()["chat"]["id"]
+    for index in range(count):
+        client.post(f"/chats/{chat_id}/messages", json={"text": f"message {index}"}, headers=headers)
+    return chat_id
+
+def _count(session, model, *conditions):
+    return session.exec(select(func.count()).select_from(model).where(*conditions)).one()
+
+def test_owner_deletes_chat_with_everything_in_it(client, session, login, run_jobs):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat_with_messages(client, headers, 5)
+    client.put(f"/chats/{chat_id}/users/2", headers=headers)
+
+    response = client.delete(f"/chats/{chat_id}", headers=headers)
+    assert response.status_code == 202
+    job = response.json()["job"]
+    assert job["kind"] == "purge_chat"
+    assert job["status"] == "queued"
+
+    # the chat is gone for everyone before its messages are purged
+    assert client.get(f"/chats/{chat_id}", headers=headers).status_code == 404
+    assert client.get("/chats", headers=other_headers).json()["chats"] == []
+    assert _count(session, UserChatLinkInDB, UserChatLinkInDB.chat_id == chat_id) == 0
+    assert _count(session, ChatSummaryInDB, ChatSummaryInDB.chat_id == chat_id) == 0
+
+    assert run_jobs() == 1
+    job = client.get(f"/jobs/{job['id']}", headers=headers).json()["job"]
+    assert job["status"] == "succeeded"
+    assert job["completed"] == job["total"] == 5
+    assert job["percent"] == 100.0
+    session.expire_all()
+    assert _count(session, MessageInDB, MessageInDB.chat_id == chat_id) == 0
+    assert _count(session, ChatDeletionInDB) == 0
+    assert session.get(ChatInDB, chat_id) is None
+
+def test_only_the_owner_can_delete_a_chat(client, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat_with_messages(client, headers, 1)
+    client.put(f"/chats/{chat_id}/users/2", headers=headers)
+
+    assert client.delete(f"/chats/{chat_id}", headers=other_headers).status_code == 403
+    assert client.get(f"/chats/{chat_id}", headers=headers).status_code == 200
+
+def test_purge_removes_messages_in_chunks(client, session, login):
+    headers = login("ripley")
+    chat_id = _chat_with_messages(client, headers, 7)
+    kept_id = _chat_with_messages(client, headers, 2)
+
+    db.delete_chat(chat_id, session.get(UserInDB, 1), session)
+    assert _count(session, MessageInDB, MessageInDB.chat_id == chat_id) == 7
+
+    chunks = []
+    assert db.purge_deleted_chat(chat_id, session, chunk_size=3, on_chunk=chunks.append) == 7
+    assert chunks == [3, 6, 7]
+    assert session.get(ChatInDB, chat_id) is None
+    assert _count(session, MessageInDB, MessageInDB.chat_id == kept_id) == 2
@@ -0,0 +1,79 @@
+from sqlalchemy import event
+
+from backend import database as db
+from backend.query_analyzer import plan_flags
+
+def _create_chat(client, headers, name):
+    return client.post("/chats", json={"name": name}, headers=headers).json()["chat"]["id"]
+
+def test_recent_chats_are_ordered_by_last_activity(client, login):
+    headers = login("ripley")
+    first = _create_chat(client, headers, "first")
+    second = _create_chat(client, headers, "second")
+    client.post(f"/chats/{first}/messages", json={"text": "hello there"}, headers=headers)
+
+    response = client.get("/chats", params={"sort": "recent"}, headers=headers)
+    assert response.status_code == 200
+    chats = response.json()["chats"]
+    assert [chat["id"] for chat in chats] == [first, second]
+    assert chats[0]["last_message"]["text"] == "hello there"
+    assert chats[0]["last_message"]["user"]["username"] == "ripley"
+    assert "last_message" not in chats[1]
+
+def test_recent_chats_are_paginated(client, login):
+    headers = login("ripley")
+    chat_ids = [_create_chat(client, headers, f"chat {index}") for index in range(5)]
+    for chat_id in chat_ids:
+        client.post(f"/chats/{chat_id}/messages", json={"text": "ping"}, headers=headers)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"sort": "recent", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/chats", params=params, headers=headers).json()
+        assert page["meta"]["count"] == 5
+        seen.extend(chat["id"] for chat in page["chats"])
+        cursor = page.get("next_cursor")
+        if cursor is None:
+            break
+
+    assert seen == list(reversed(chat_ids))
+
+def test_recent_chats_are_read_from_the_members_index(client, login, session):
+    ripley, kane = login("ripley"), login("kane")
+    older = _create_chat(client, ripley, "older")
+    newer = _create_chat(client, ripley, "newer")
+    client.post(f"/chats/{older}/messages", json={"text": "ping"}, headers=ripley)
+    kane_id = client.get("/users/me", headers=kane).json()["user"]["id"]
+    # a member who joins later sees the chat at its last activity
+    client.put(f"/chats/{newer}/users/{kane_id}", headers=ripley)
+    client.put(f"/chats/{older}/users/{kane_id}", headers=ripley)
+    chats = client.get("/chats", params={"sort": "recent"}, headers=kane).json()["chats"]
+    assert [chat["id"] for chat in chats] == [older, newer]
+
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(session.get_bind(), "before_cursor_execute", capture)
+    try:
+        db.get_all_chats(session.get(db.UserInDB, kane_id), session, sort="recent", limit=1)
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", capture)
+
+    statement, parameters = statements[-1]
+    cursor = session.connection().connection.driver_connection.cursor()
+    plan = [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    assert "ix_user_chat_links_user_id_last_activity_at_chat_id" in plan[0]
+    assert plan_flags(plan) == ["SEARCH"]
+
+def test_deleting_last_message_rewinds_preview(client, login):
+    headers = login("ripley")
+    chat_id = _create_chat(client, headers, "nostromo")
+    client.post(f"/chats/{chat_id}/messages", json={"text": "first"}, headers=headers)
+    message_id = client.post(f"/chats/{chat_id}/messages", json={"text": "second"}, headers=headers).json()["message"]["id"]
+    client.delete(f"/chats/{chat_id}/messages/{message_id}", headers=headers)
+
+    chats = client.get("/chats", params={"sort": "recent"}, headers=headers).json()["chats"]
+    assert chats[0]["last_message"]["text"] == "first"
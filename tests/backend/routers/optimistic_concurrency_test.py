@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session
+
+from backend import contention
+from backend import database as db
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(contention, "retry_base_seconds", 0)
+    contention.reset_stats()
+
+def _message(client, headers):
+    chat_id = client.post("/chats", json={"name": "edits"}, headers=headers).json()["chat"]["id"]
+    response = client.post(f"/chats/{chat_id}/messages", json={"text": "first"}, headers=headers)
+    return chat_id, response.json()["message"]["id"], response.headers["etag"]
+
+def test_if_match_guards_message_edits(client, login):
+    headers = login("ripley")
+    chat_id, message_id, etag = _message(client, headers)
+    path = f"/chats/{chat_id}/messages/{message_id}"
+    assert etag == '"1"'
+
+    response = client.put(path, json={"text": "second"}, headers={**headers, "If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"2"'
+
+    # another client still holding the first version loses
+    response = client.put(path, json={"text": "third"}, headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+    assert response.json()["detail"]["version"] == 2
+    assert client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"][0]["text"] == "second"
+
+    assert client.put(path, json={"text": "x"}, headers={**headers, "If-Match": "nonsense"}).status_code == 412
+    assert client.put(path, json={"text": "any"}, headers={**headers, "If-Match": "*"}).status_code == 200
+
+def test_chat_and_user_edits_return_etags(client, login):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "before"}, headers=headers).json()["chat"]["id"]
+    assert client.get(f"/chats/{chat_id}", headers=headers).headers["etag"] == '"1"'
+    response = client.put(f"/chats/{chat_id}", json={"name": "after"}, headers={**headers, "If-Match": '"1"'})
+    assert (response.status_code, response.headers["etag"]) == (200, '"2"')
+
+    assert client.get("/users/me", headers=headers).headers["etag"] == '"1"'
+    response = client.put("/users/me", json={"username": "ellen"}, headers={**headers, "If-Match": 'W/"1"'})
+    assert (response.status_code, response.headers["etag"]) == (200, '"2"')
+
+def test_concurrent_edit_is_a_conflict(client, session, login):
+    headers = login("ripley")
+    chat_id, message_id, _ = _message(client, headers)
+    message = db.get_message_by_id(message_id, session)
+    # another request commits an edit of the message after this one read it
+    connection = session.connection().connection.driver_connection
+    connection.execute("UPDATE messages SET text = 'theirs', version = version + 1")
+    connection.commit()
+
+    with pytest.raises(HTTPException) as error:
+        db.update_message(message_id, "mine", session)
+    assert error.value.status_code == 409
+    assert error.value.detail["version"] == 2
+    assert message.text == "theirs"
+    assert contention.stats()["conflicts"] == {"messages": 1}
+
+def test_busy_writes_are_retried_with_backoff():
+    calls = []
+
+    @contention.retry_on_busy
+    def write(session: Session):
+        calls.append(session)
+        if len(calls) < 3:
+            raise OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))
+        return "written"
+
+    session = Session()
+    assert write(session) == "written"
+    assert len(calls) == 3
+    assert contention.stats()["retries"] == {"write": 2}
+
+    with pytest.raises(HTTPException) as error:
+        contention.retry_on_busy(_always_locked)(session=session)
+    assert error.value.status_code == 503
+    assert contention.stats()["exhausted"] == {"_always_locked": 1}
+
+def _always_locked(session: Session):
+    raise OperationalError("UPDATE", {}, sqlite3.OperationalError("database is locked"))
@@ -0,0 +1,31 @@
+def _chat_with_member(client, owner_headers, member_id):
+    chat_id = client.post("/chats", json={"name": "lobby"}, headers=owner_headers).json()["chat"]["id"]
+    client.put(f"/chats/{chat_id}/users/{member_id}", headers=owner_headers)
+    return chat_id
+
+def test_members_see_online_and_typing_users(client, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat_with_member(client, headers, 2)
+
+    assert client.post("/users/me/heartbeat", headers=headers).status_code == 204
+    assert client.put(f"/chats/{chat_id}/typing", json={"typing": True}, headers=other_headers).status_code == 204
+
+    presence = client.get(f"/chats/{chat_id}/presence", headers=headers).json()
+    assert presence == {"chat_id": chat_id, "online": [1, 2], "typing": [2]}
+
+    client.put(f"/chats/{chat_id}/typing", json={"typing": False}, headers=other_headers)
+    assert client.get(f"/chats/{chat_id}/presence", headers=headers).json()["typing"] == []
+
+def test_presence_requires_membership_and_follows_membership_changes(client, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat_with_member(client, headers, 2)
+    assert client.get(f"/chats/{chat_id}/presence", headers=other_headers).status_code == 200
+
+    client.delete(f"/chats/{chat_id}/users/2", headers=headers)
+    assert client.get(f"/chats/{chat_id}/presence", headers=other_headers).status_code == 403
+    assert client.put(f"/chats/{chat_id}/typing", json={"typing": True}, headers=other_headers).status_code == 403
+
+def test_presence_requires_a_valid_token(client):
+    assert client.post("/users/me/heartbeat", headers={"Authorization": "Bearer nope"}).status_code == 401
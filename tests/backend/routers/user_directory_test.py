@@ -0,0 +1,63 @@
+from backend import database as db
+
+def _register(login, *usernames):
+    for username in usernames:
+        login(username)
+
+def test_search_matches_username_prefix_ignoring_case(client, login):
+    _register(login, "Ripley", "ripper", "dallas", "lambert")
+
+    response = client.get("/users/search", params={"q": "rip"})
+    assert response.status_code == 200
+    assert [user["username"] for user in response.json()["users"]] == ["Ripley", "ripper"]
+    assert response.json()["meta"]["count"] == 2
+
+def test_search_respects_limit_and_email_flag(client, login):
+    _register(login, "ash", "ashley", "parker")
+
+    response = client.get("/users/search", params={"q": "as", "limit": 1})
+    assert [user["username"] for user in response.json()["users"]] == ["ash"]
+
+    assert client.get("/users/search", params={"q": "parker@"}).json()["users"] == []
+    response = client.get("/users/search", params={"q": "parker@", "email": True})
+    assert [user["username"] for user in response.json()["users"]] == ["parker"]
+
+def test_batch_lookup_by_ids(client, login):
+    _register(login, "ripley", "dallas", "kane")
+
+    response = client.get("/users", params={"ids": "3,1,99"})
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()["users"]] == [1, 3]
+    assert response.json()["meta"]["count"] == 2
+
+    response = client.get("/users", params={"ids": "1,banana"})
+    assert response.status_code == 422
+    assert response.json()["detail"]["error"] == "invalid_ids"
+
+def test_users_are_paginated_by_cursor(client, login):
+    _register(login, "ripley", "dallas", "kane", "ash", "parker")
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/users", params=params).json()
+        assert page["meta"]["count"] == 5
+        seen.extend(user["id"] for user in page["users"])
+        cursor = page.get("next_cursor")
+        if cursor is None:
+            break
+
+    assert seen == [1, 2, 3, 4, 5]
+    assert client.get("/users", params={"cursor": "nope"}).status_code == 422
+
+def test_users_are_paged_by_default(client, session):
+    db.create_users([{"username": f"crew{index:03d}", "email": f"crew{index}@example.com", "hashed_password": "x"}
+                     for index in range(101)], session)
+
+    page = client.get("/users").json()
+    assert (page["meta"]["count"], len(page["users"])) == (101, 100)
+    assert len(client.get("/users", params={"cursor": page["next_cursor"]}).json()["users"]) == 1
+    assert client.get("/users", params={"limit": 1001}).status_code == 422
@@ -0,0 +1,43 @@
+from backend import database as db
+from backend.rows import UserRow
+
+def _chat(client, headers, name):
+    return client.post("/chats", json={"name": name}, headers=headers).json()["chat"]["id"]
+
+def test_messages_share_one_user_dict_per_author(client, session, login):
+    headers = login("ripley")
+    other_headers = login("dallas")
+    chat_id = _chat(client, headers, "crew")
+    client.put(f"/chats/{chat_id}/users/2", headers=headers)
+    for index in range(3):
+        client.post(f"/chats/{chat_id}/messages", json={"text": f"ripley {index}"}, headers=headers)
+        client.post(f"/chats/{chat_id}/messages", json={"text": f"dallas {index}"}, headers=other_headers)
+
+    messages = db.get_all_messages_from_chat(chat_id, session)
+    assert [message["text"] for message in messages[:2]] == ["ripley 0", "dallas 0"]
+    ripley = [message["user"] for message in messages if message["user"]["id"] == 1]
+    assert len(ripley) == 3
+    assert all(user is ripley[0] for user in ripley)
+    assert set(ripley[0]) == {"id", "username", "email", "created_at"}
+
+def test_collection_queries_return_compact_rows(client, session, login):
+    headers = login("ripley")
+    login("dallas")
+    first = _chat(client, headers, "first")
+    second = _chat(client, headers, "second")
+    client.post(f"/chats/{second}/messages", json={"text": "hello"}, headers=headers)
+
+    users, _ = db.get_all_users(session)
+    assert all(type(user) is UserRow for user in users)
+    assert not hasattr(users[0], "hashed_password")
+    assert not hasattr(users[0], "__dict__")
+
+    chats, _ = db.get_all_chats(db.get_user_by_id(1, session), session)
+    assert [chat.id for chat in chats] == [first, second]
+    # the owner and the author of the last message are the same row
+    assert chats[0].owner is chats[1].owner is chats[1].last_message.user
+
+    response = client.get("/chats", headers=headers).json()
+    assert response["chats"][1]["last_message"]["text"] == "hello"
+    assert "hashed_password" not in response["chats"][0]["owner"]
+    assert [user["username"] for user in client.get(f"/chats/{first}/users", headers=headers).json()["users"]] == ["ripley"]
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from backend.single_flight import SingleFlight
+
+def _blocking_load(release: threading.Event, calls: list, value=b"body"):
+    def load():
+        calls.append(threading.current_thread().name)
+        release.wait(5)
+        return value
+    return load
+
+def _wait_for_followers(flight: SingleFlight, count: int):
+    for _ in range(500):
+        if flight.stats()["followers"] >= count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("followers never joined")
+
+def test_concurrent_identical_reads_share_one_load():
+    flight = SingleFlight()
+    release, calls = threading.Event(), []
+    load = _blocking_load(release, calls)
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = [pool.submit(flight.do, 1, "messages", load) for _ in range(5)]
+        _wait_for_followers(flight, 4)
+        release.set()
+        bodies = [result.result() for result in results]
+
+    assert len(calls) == 1
+    assert all(body is bodies[0] for body in bodies)
+    assert flight.stats()["leaders"] == 1
+    assert flight.stats()["in_flight"] == 0
+
+def test_reads_after_an_invalidation_do_not_join_an_older_load():
+    flight = SingleFlight()
+    release, calls = threading.Event(), []
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        stale = pool.submit(flight.do, 1, "messages", _blocking_load(release, calls, b"old"))
+        while not calls:
+            threading.Event().wait(0.01)
+        flight.invalidate(1)
+        fresh = pool.submit(flight.do, 1, "messages", lambda: b"new")
+        assert fresh.result(5) == b"new"
+        release.set()
+        assert stale.result(5) == b"old"
+
+    # other chats and keys never share a load
+    assert flight.do(2, "messages", lambda: b"two") == b"two"
+    assert flight.do(1, "chat", lambda: b"chat") == b"chat"
+
+def test_followers_load_themselves_when_the_leader_fails_or_is_slow():
+    flight = SingleFlight(wait_seconds=5)
+    started, release = threading.Event(), threading.Event()
+
+    def failing_load():
+        started.set()
+        release.wait(5)
+        raise LookupError("no chat")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, 1, "chat", failing_load)
+        started.wait(5)
+        follower = pool.submit(flight.do, 1, "chat", lambda: b"own")
+        _wait_for_followers(flight, 1)
+        release.set()
+        with pytest.raises(LookupError):
+            leader.result(5)
+        assert follower.result(5) == b"own"
+    assert flight.stats()["failures"] == 1
+
+    flight.wait_seconds = 0.01
+    release.clear()
+    calls = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, 1, "chat", _blocking_load(release, calls))
+        while not calls:
+            threading.Event().wait(0.01)
+        assert flight.do(1, "chat", lambda: b"impatient") == b"impatient"
+        release.set()
+        leader.result(5)
+    assert flight.stats()["timeouts"] == 1
+
+def test_coalesced_routes_answer_like_before(client, login):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "crew"}, headers=headers).json()["chat"]["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "hello"}, headers=headers)
+
+    response = client.get(f"/chats/{chat_id}", params={"include": ["users", "messages"]}, headers=headers)
+    assert response.headers["etag"] == '"1"'
+    assert response.json()["meta"] == {"message_count": 1, "user_count": 1}
+    assert [message["text"] for message in response.json()["messages"]] == ["hello"]
+
+    # a write between two reads is always visible to the second
+    client.post(f"/chats/{chat_id}/messages", json={"text": "again"}, headers=headers)
+    messages = client.get(f"/chats/{chat_id}/messages", headers=headers).json()
+    assert messages["meta"]["count"] == 2
+    assert client.get(f"/chats/{chat_id}/messages", headers=login("dallas")).status_code == 403
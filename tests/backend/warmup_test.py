@@ -0,0 +1,73 @@
+import subprocess
+import sys
+import threading
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT
+from sqlmodel import SQLModel, create_engine
+
+from backend import auth, warmup
+
+@pytest.fixture(autouse=True)
+def not_ready():
+    warmup.reset()
+    yield
+    warmup.reset()
+
+def test_readiness_flips_after_warmup(client, session):
+    assert client.get("/health/live").status_code == 200
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["detail"]["error"] == "not_ready"
+
+    warmup.run(session.get_bind())
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert {"crypto", "statements", "pool", "total"} <= set(response.json()["phases_ms"])
+    assert response.json()["statements"] > 0
+
+def test_warmup_runs_in_the_background(client, session, monkeypatch):
+    release = threading.Event()
+    warm_up = auth.warm_up
+
+    def slow_warm_up(session):
+        release.wait(5)
+        warm_up(session)
+
+    monkeypatch.setattr(auth, "warm_up", slow_warm_up)
+    thread = warmup.start(session.get_bind())
+    assert client.get("/health/ready").status_code == 503
+
+    release.set()
+    thread.join(5)
+    assert client.get("/health/ready").status_code == 200
+
+def test_hot_reads_after_warmup_use_cached_statements(client, session, login):
+    headers = login("ripley")
+    chat_id = client.post("/chats", json={"name": "warm"}, headers=headers).json()["chat"]["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"text": "hi"}, headers=headers)
+    warmup.run(session.get_bind())
+
+    cache_hits = []
+    event.listen(session.get_bind(), "after_cursor_execute",
+                 lambda connection, cursor, statement, parameters, context, many: cache_hits.append(context.cache_hit))
+    assert client.get("/chats", params={"sort": "recent", "limit": 5}, headers=headers).status_code == 200
+    assert client.get(f"/chats/{chat_id}/messages", headers=headers).status_code == 200
+    assert client.get("/users/search", params={"q": "rip"}).status_code == 200
+
+    assert cache_hits
+    assert set(cache_hits) == {CACHE_HIT}
+
+def test_warmup_opens_pooled_connections(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'warm.db'}", pool_size=3)
+    SQLModel.metadata.create_all(engine)
+
+    warmup.run(engine, connections=5)
+    assert engine.pool.checkedin() == 3
+    assert warmup.is_ready()
+
+def test_importing_the_app_leaves_crypto_libraries_unloaded():
+    script = "import sys, backend.main; print(sorted({'jose', 'passlib', 'argparse'} & set(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == "[]"